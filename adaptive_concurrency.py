@@ -0,0 +1,178 @@
+"""
+自适应并发控制: AIMD（加性增、乘性减）
+* 请求成功且延迟正常时，每轮并发上限加1（每个成功请求增加 1/上限）
+* 遇到 HTTP 429、5xx、超时/连接错误或延迟明显升高时，并发上限按比例下调
+* 同一轮拥塞中已发出的请求不会重复触发下调
+* 上限始终保持在配置的下限和上限之间
+* 线程池使用 AdaptiveConcurrency，asyncio 引擎使用 AsyncAdaptiveConcurrency
+* 多进程模式下用 SharedConcurrency / AsyncSharedConcurrency 包装，另外占用一个跨进程共享的名额，
+  所有进程同时进行的请求总数不超过共享上限
+"""
+
+import time
+import asyncio
+import threading
+
+# 请求结果分类
+SUCCESS = "success"    # 成功，可用于增加并发
+OVERLOAD = "overload"  # 上游过载 (429/5xx/超时/连接错误)，需要降低并发
+ERROR = "error"        # 其他失败 (如参数错误)，不影响并发上限
+
+def outcome_for_status(status_code):
+    """根据HTTP状态码判断请求结果分类"""
+    if status_code == 200:
+        return SUCCESS
+    if status_code == 429 or status_code >= 500:
+        return OVERLOAD
+    return ERROR
+
+class _AIMDState:
+    """AIMD 状态与调整逻辑，调用方负责加锁"""
+
+    def __init__(self, initial, min_limit, max_limit, decrease_factor=0.5,
+                 latency_tolerance=2.0, on_change=None):
+        self.min_limit = max(1, int(min_limit))
+        self.max_limit = max(self.min_limit, int(max_limit))
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance  # 当前延迟超过基线的倍数视为延迟升高，0表示不检测
+        self.on_change = on_change
+        self.in_flight = 0
+        self.baseline_latency = None  # 成功请求延迟的慢速均值
+        self.recent_latency = None    # 成功请求延迟的快速均值
+        self.last_decrease = 0.0
+
+    def current_limit(self):
+        return int(self.limit)
+
+    def _latency_rising(self, latency):
+        if self.baseline_latency is None:
+            self.baseline_latency = self.recent_latency = latency
+            return False
+        self.recent_latency = 0.7 * self.recent_latency + 0.3 * latency
+        rising = (self.latency_tolerance > 0 and
+                  self.recent_latency > self.baseline_latency * self.latency_tolerance)
+        # 基线缓慢跟随，上游长期变慢后不会一直下调
+        self.baseline_latency = 0.95 * self.baseline_latency + 0.05 * latency
+        return rising
+
+    def record(self, started, outcome, latency):
+        """记录一个请求的结果和延迟并调整并发上限"""
+        self.in_flight -= 1
+        now = time.monotonic()
+        old_limit = self.current_limit()
+
+        if outcome == SUCCESS and self._latency_rising(latency):
+            outcome = OVERLOAD
+
+        if outcome == SUCCESS:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        elif outcome == OVERLOAD and started >= self.last_decrease:
+            # 在上次下调之前发出的请求属于同一轮拥塞，不再重复下调
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self.last_decrease = now
+
+        new_limit = self.current_limit()
+        if new_limit != old_limit and self.on_change:
+            self.on_change(old_limit, new_limit, outcome)
+
+class AdaptiveConcurrency:
+    """线程安全的自适应并发闸门"""
+
+    def __init__(self, initial, min_limit, max_limit, **kwargs):
+        self.state = _AIMDState(initial, min_limit, max_limit, **kwargs)
+        self.condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return self.state.current_limit()
+
+    def acquire(self):
+        """等待空闲的并发名额，返回开始时间，用于release"""
+        with self.condition:
+            while self.state.in_flight >= self.state.current_limit():
+                self.condition.wait()
+            self.state.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started, outcome, latency):
+        """归还名额并根据请求结果和延迟调整上限"""
+        with self.condition:
+            self.state.record(started, outcome, latency)
+            self.condition.notify_all()
+
+class AsyncAdaptiveConcurrency:
+    """asyncio 引擎使用的自适应并发闸门（只能在同一事件循环中使用）"""
+
+    def __init__(self, initial, min_limit, max_limit, **kwargs):
+        self.state = _AIMDState(initial, min_limit, max_limit, **kwargs)
+        self.condition = asyncio.Condition()
+
+    @property
+    def limit(self):
+        return self.state.current_limit()
+
+    async def acquire(self):
+        async with self.condition:
+            while self.state.in_flight >= self.state.current_limit():
+                await self.condition.wait()
+            self.state.in_flight += 1
+            return time.monotonic()
+
+    async def release(self, started, outcome, latency):
+        async with self.condition:
+            self.state.record(started, outcome, latency)
+            self.condition.notify_all()
+
+class SharedConcurrency:
+    """在进程内的并发闸门之外再占用一个跨进程名额 (multiprocessing.Semaphore)"""
+
+    def __init__(self, gate, slots):
+        self.gate = gate
+        self.slots = slots
+
+    @property
+    def limit(self):
+        return self.gate.limit
+
+    def acquire(self):
+        started = self.gate.acquire()
+        self.slots.acquire()
+        return started
+
+    def release(self, started, outcome, latency):
+        self.slots.release()
+        self.gate.release(started, outcome, latency)
+
+class AsyncSharedConcurrency:
+    """SharedConcurrency 的 asyncio 版本，跨进程名额以轮询方式获取，不阻塞事件循环
+
+    名额已满时轮询间隔从 poll_interval 开始按指数增长，最长为 max_poll_interval
+    """
+
+    def __init__(self, gate, slots, poll_interval=0.01, max_poll_interval=0.2):
+        self.gate = gate
+        self.slots = slots
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+
+    @property
+    def limit(self):
+        return self.gate.limit
+
+    async def acquire(self):
+        started = await self.gate.acquire()
+        try:
+            delay = self.poll_interval
+            while not self.slots.acquire(False):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_poll_interval)
+        except BaseException:
+            # 等待期间被取消，归还进程内的名额
+            await self.gate.release(started, ERROR, 0)
+            raise
+        return started
+
+    async def release(self, started, outcome, latency):
+        self.slots.release()
+        await self.gate.release(started, outcome, latency)
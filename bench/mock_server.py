@@ -0,0 +1,257 @@
+"""
+本地模拟服务: 模拟 tu-zi 的 /v1/chat/completions 接口和图片 CDN，用于离线压测，不消耗 API 额度
+* 响应内容与 tu-zi 相同，图片以 [点击下载](地址) 链接给出，链接指向本服务的 /images/ 地址
+* 请求耗时和图片下载耗时按指定的分布随机生成：固定值、均匀分布、正态分布、对数正态分布或指数分布
+* 按比例注入 429（带 Retry-After）和 5xx 错误
+* 请求体中 "stream": true 时以 SSE 返回：生成期间定时发送进度，最后发送图片链接（--ignore-stream 时忽略该参数，按普通 JSON 返回）
+* 图片下载支持 Range 请求（断点续传）
+* /stats 返回各类请求的计数（JSON）
+
+用法: python bench/mock_server.py --port 18080 --latency lognormal:20,0.3 --rate-429 0.05
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHAT_PATH = "/v1/chat/completions"
+IMAGE_PATH = "/images/"
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+
+def parse_distribution(spec):
+    """解析耗时分布，返回生成随机耗时（秒）的函数
+
+    格式: 固定值 "2" 或 "fixed:2"、"uniform:最小,最大"、"normal:均值,标准差"、
+    "lognormal:中位数,sigma"、"exp:均值"，负数按0处理
+    """
+    name, _, params = spec.partition(":") if ":" in spec else ("fixed", "", spec)
+    try:
+        values = [float(value) for value in params.split(",")]
+    except ValueError:
+        raise ValueError(f"无法解析的耗时分布: {spec}")
+    generators = {
+        "fixed": (1, lambda v: v[0]),
+        "uniform": (2, lambda v: random.uniform(v[0], v[1])),
+        "normal": (2, lambda v: random.gauss(v[0], v[1])),
+        "lognormal": (2, lambda v: random.lognormvariate(math.log(v[0]), v[1]) if v[0] > 0 else 0.0),
+        "exp": (1, lambda v: random.expovariate(1.0 / v[0]) if v[0] > 0 else 0.0),
+    }
+    if name not in generators or len(values) != generators[name][0]:
+        raise ValueError(f"无法解析的耗时分布: {spec}")
+    generate = generators[name][1]
+    return lambda: max(0.0, generate(values))
+
+class MockStats:
+    """线程安全的计数器"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持 keep-alive，与真实服务一样复用连接
+
+    def log_message(self, format, *args):
+        pass  # 不输出访问日志
+
+    @property
+    def options(self):
+        return self.server.options
+
+    def send_body(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.stats.inc("bytes_out", len(body))
+
+    def send_error_json(self, status, message, headers=None):
+        self.server.stats.inc(f"status_{status}")
+        body = json.dumps({"error": {"message": message, "type": "mock_error"}}, ensure_ascii=False).encode("utf-8")
+        self.send_body(status, body, headers=headers)
+
+    def read_body(self):
+        """读取请求体，支持 Content-Length 和分块传输"""
+        length = self.headers.get("Content-Length")
+        if length is not None:
+            return self.rfile.read(int(length))
+        chunks = []
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return b"".join(chunks)
+
+    def do_POST(self):
+        stats = self.server.stats
+        body = self.read_body()
+        stats.inc("requests")
+        stats.inc("bytes_in", len(body))
+        if self.path.split("?", 1)[0] != CHAT_PATH:
+            self.send_error_json(404, "not found")
+            return
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            self.send_error_json(401, "missing api key")
+            return
+        try:
+            request = json.loads(body)
+        except ValueError:
+            self.send_error_json(400, "invalid json")
+            return
+
+        # 429 立即返回（限流），5xx 在生成耗时之后返回（上游故障）
+        roll = random.random()
+        if roll < self.options.rate_429:
+            self.send_error_json(429, "rate limit exceeded, please retry later",
+                                 {"Retry-After": f"{self.options.retry_after:g}"})
+            return
+        latency = self.server.latency()
+        if roll < self.options.rate_429 + self.options.rate_5xx:
+            time.sleep(latency)
+            self.send_error_json(random.choice((500, 502, 503)), "upstream error")
+            return
+
+        number = self.server.next_id()
+        result_id = f"chatcmpl-mock-{number}"
+        host = self.headers.get("Host") or f"{self.server.server_address[0]}:{self.server.server_address[1]}"
+        links = "".join(f"\n\n![图片](http://{host}{IMAGE_PATH}{number}-{i}.png)"
+                        f"\n\n[点击下载](http://{host}{IMAGE_PATH}{number}-{i}.png)"
+                        for i in range(self.options.links))
+        if request.get("stream") and not self.options.ignore_stream:
+            stats.inc("streams")
+            self.stream_response(result_id, request.get("model"), latency, links)
+            return
+        time.sleep(latency)
+        content = f"> 生成完成 ✅{links}"
+        stats.inc("status_200")
+        self.send_body(200, json.dumps({
+            "id": result_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        }, ensure_ascii=False).encode("utf-8"))
+
+    def stream_response(self, result_id, model, latency, links):
+        """SSE 响应：生成期间每隔 stream_interval 秒发送一次进度，最后发送图片链接和 [DONE]"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(data):
+            chunk = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+            self.server.stats.inc("bytes_out", len(chunk))
+
+        def delta(content):
+            send(json.dumps({"id": result_id, "object": "chat.completion.chunk", "model": model,
+                             "choices": [{"index": 0, "delta": {"content": content}}]}, ensure_ascii=False))
+
+        deadline = time.monotonic() + latency
+        delta("> 排队中\n\n> 生成中")
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(self.options.stream_interval, remaining))
+            delta(".")
+        delta(f"\n\n> 生成完成 ✅{links}")
+        send("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.server.stats.inc("status_200")
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/stats":
+            self.send_body(200, json.dumps(self.server.stats.snapshot()).encode("utf-8"))
+            return
+        if not path.startswith(IMAGE_PATH):
+            self.send_error_json(404, "not found")
+            return
+        self.server.stats.inc("images")
+        time.sleep(self.server.download_latency())
+        data = self.server.image
+        start = 0
+        byte_range = self.headers.get("Range", "")
+        if byte_range.startswith("bytes="):
+            start = int(byte_range[6:].split("-")[0] or 0)
+        if 0 < start < len(data):
+            self.send_body(206, data[start:], "image/png",
+                           {"Content-Range": f"bytes {start}-{len(data) - 1}/{len(data)}"})
+        else:
+            self.send_body(200, data, "image/png")
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # 压测时有大量并发连接，默认的连接队列太小会导致连接被拒绝后重试
+
+    def __init__(self, address, options):
+        super().__init__(address, MockHandler)
+        self.options = options
+        self.latency = parse_distribution(options.latency)
+        self.download_latency = parse_distribution(options.download_latency)
+        self.stats = MockStats()
+        self.image = PNG_HEADER + os.urandom(max(0, options.image_kb * 1024 - len(PNG_HEADER)))
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="tu-zi API 和图片 CDN 的本地模拟服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址，默认为 127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080, help="监听端口，默认为 18080")
+    parser.add_argument("--latency", default="lognormal:2,0.3",
+                        help="请求耗时分布（秒）：固定值、uniform:最小,最大、normal:均值,标准差、"
+                             "lognormal:中位数,sigma 或 exp:均值，默认为 lognormal:2,0.3")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="返回 429 的比例（0-1），默认为0")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="返回 500/502/503 的比例（0-1），默认为0")
+    parser.add_argument("--retry-after", type=float, default=1, help="429 响应的 Retry-After（秒），默认为1")
+    parser.add_argument("--links", type=int, default=2, help="每个响应中的图片链接数，默认为2")
+    parser.add_argument("--image-kb", type=int, default=256, help="图片大小（KB），默认为256")
+    parser.add_argument("--download-latency", default="uniform:0.05,0.2", help="图片下载耗时分布（秒），格式同 --latency")
+    parser.add_argument("--stream-interval", type=float, default=0.5, help="SSE 响应发送进度的间隔（秒），默认为0.5")
+    parser.add_argument("--ignore-stream", action="store_true", help="忽略请求中的 stream 参数，总是返回普通 JSON 响应")
+    return parser
+
+def main():
+    options = build_parser().parse_args()
+    try:
+        server = MockServer((options.host, options.port), options)
+    except ValueError as e:
+        print(f"错误：{e}")
+        sys.exit(2)
+    print(f"模拟服务已启动: http://{options.host}:{server.server_address[1]}{CHAT_PATH}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
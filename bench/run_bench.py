@@ -0,0 +1,289 @@
+"""
+离线压测: 启动本地模拟服务（bench/mock_server.py），用不同的任务数和并发数运行各个处理脚本，
+输出吞吐量（任务/秒）、任务耗时的 p50/p95/p99 和峰值内存
+* 每次运行在单独的临时目录中生成任务文件和输入图片，通过 API_URL 把请求指向模拟服务
+* 安装了 Pillow 时输入图片为可以解码的随机噪点 JPEG，可以测量图片预处理（IMAGE_PREPROCESS）；
+  未安装时只是带 JPEG 文件头的随机数据，此时不支持 IMAGE_PREPROCESS
+* 任务耗时取自任务日志（journal.jsonl）中每个任务从开始到结束（含下载图片）的时间
+* 峰值内存为运行中最大的单个进程的常驻内存（多进程模式下通常是工作进程），需要 Unix 系统
+* 其他配置（如 STREAMING_BODY、DOWNLOAD_WORKERS）沿用当前的环境变量和 .env
+
+用法: python bench/run_bench.py --runners batch,thread,asyncio --tasks 20,100 --concurrency 5,20
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from datetime import datetime
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# 可压测的处理方式：脚本、命令行参数和控制并发数的环境变量（None 表示不支持并发，只按任务数运行）
+RUNNERS = {
+    "batch": {"script": "gpt-4o-batch.py", "args": [], "concurrency_env": None},
+    "thread": {"script": "gpt-4o-concurrent.py", "args": ["--engine", "thread"], "concurrency_env": "MAX_WORKERS"},
+    "asyncio": {"script": "gpt-4o-concurrent.py", "args": ["--engine", "asyncio"], "concurrency_env": "ASYNC_CONCURRENCY"},
+    "processes": {"script": "gpt-4o-concurrent.py", "args": ["--engine", "thread", "--processes", "2"],
+                  "concurrency_env": "MAX_WORKERS"},
+}
+
+def parse_list(value, cast=str):
+    return [cast(item.strip()) for item in value.split(",") if item.strip()]
+
+def percentile(values, q):
+    """已排序列表的分位数（线性插值），列表为空时返回None"""
+    if not values:
+        return None
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def fetch_stats(url):
+    """模拟服务的请求计数"""
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.loads(response.read())
+
+def start_mock(args):
+    """启动模拟服务，返回进程和服务地址"""
+    command = [sys.executable, os.path.join(BENCH_DIR, "mock_server.py"), "--host", "127.0.0.1", "--port", str(args.port),
+               "--latency", args.latency, "--rate-429", str(args.rate_429), "--rate-5xx", str(args.rate_5xx),
+               "--links", str(args.links), "--image-kb", str(args.image_kb),
+               "--download-latency", args.download_latency]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    base_url = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            fetch_stats(base_url + "/stats")
+            return process, base_url
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError(f"模拟服务启动失败: {process.stderr.read().decode('utf-8', 'replace').strip()}")
+            if time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("模拟服务启动超时")
+            time.sleep(0.1)
+
+def write_input_image(path, input_kb):
+    """生成约 input_kb 大小的输入图片：有 Pillow 时为随机噪点的 JPEG，否则为带 JPEG 文件头的随机数据"""
+    size = max(1, input_kb * 1024)
+    if Image is None:
+        with open(path, "wb") as f:
+            f.write(b"\xff\xd8\xff\xe0" + os.urandom(max(0, size - 4)))
+        return
+    # 噪点图片几乎无法压缩，先按估计的边长生成一次，再按实际大小修正边长
+    edge = max(8, int((size / 1.5) ** 0.5))
+    for _ in range(2):
+        image = Image.frombytes("RGB", (edge, edge), os.urandom(edge * edge * 3))
+        image.save(path, format="JPEG", quality=90)
+        edge = max(8, int(edge * (size / os.path.getsize(path)) ** 0.5))
+
+def prepare_workdir(root, task_count, images_per_task, input_kb):
+    """在临时目录中生成输入图片和任务文件"""
+    images_dir = os.path.join(root, "input", "images")
+    os.makedirs(images_dir, exist_ok=True)
+    names = []
+    # 任务之间轮流引用4张图片，与实际任务中重复使用参考图的情况相同
+    for i in range(4 if images_per_task > 0 else 0):
+        name = f"bench_{i}.jpg"
+        write_input_image(os.path.join(images_dir, name), input_kb)
+        names.append(name)
+    tasks = [{"name": f"bench_{i}", "prompt": f"压测任务 {i}",
+              "images": [names[(i + j) % len(names)] for j in range(images_per_task)] if names else []}
+             for i in range(task_count)]
+    tasks_file = os.path.join(root, "input", "tasks.json")
+    with open(tasks_file, "w", encoding="utf-8") as f:
+        json.dump(tasks, f, ensure_ascii=False)
+    return tasks_file
+
+def run_environment(args, base_url, tasks_file, workdir, runner, concurrency):
+    """运行处理脚本的环境变量：请求指向模拟服务，关闭结果缓存、限流间隔等会影响测量的功能"""
+    env = dict(os.environ)
+    env.update({
+        "API_URL": base_url + "/v1/chat/completions",
+        "API_TOKEN": "bench",
+        "API_TOKENS": "",
+        "API_RATE_LIMIT": str(args.rate_limit),
+        "API_RPM": "0",
+        "API_DELAY": "0",
+        "RESULT_CACHE": "0",
+        "TASKS_FILE": tasks_file,
+        "JOURNAL_FILE": os.path.join(workdir, "output", "journal.jsonl"),
+        "TASK_QUEUE": "",
+        "PROCESSES": "1",
+        "METRICS_PORT": "0",
+        "TRACE_FILE": "",
+        "STREAM_RESPONSE": "1" if args.stream else "0",
+        "PYTHONIOENCODING": "utf-8",
+    })
+    if runner["concurrency_env"]:
+        env[runner["concurrency_env"]] = str(concurrency)
+    return env
+
+def task_latencies(journal_file):
+    """从任务日志计算每个任务从开始到结束的耗时，返回(已排序的耗时列表, 成功数, 失败数)"""
+    started, finished = {}, {}
+    if os.path.exists(journal_file):
+        with open(journal_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                when = datetime.fromisoformat(event["time"]).timestamp()
+                if event["event"] == "start":
+                    started.setdefault(event["key"], when)
+                else:
+                    finished[event["key"]] = (event["event"], when)
+    latencies = sorted(when - started[key] for key, (_, when) in finished.items() if key in started)
+    success = sum(1 for status, _ in finished.values() if status == "success")
+    return latencies, success, len(finished) - success
+
+def wait_child(process, timeout):
+    """等待子进程结束，返回(退出码, 峰值内存 MB)；超时时结束子进程"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if hasattr(os, "wait4"):
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                process.returncode = os.waitstatus_to_exitcode(status)
+                # Linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+                divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+                return process.returncode, usage.ru_maxrss / divisor
+        elif process.poll() is not None:
+            return process.returncode, None
+        time.sleep(0.05)
+    process.kill()
+    process.wait()
+    return None, None
+
+def run_once(args, base_url, name, task_count, concurrency):
+    """运行一次压测，返回结果"""
+    runner = RUNNERS[name]
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    try:
+        tasks_file = prepare_workdir(workdir, task_count, args.images_per_task, args.input_kb)
+        env = run_environment(args, base_url, tasks_file, workdir, runner, concurrency)
+        before = fetch_stats(base_url + "/stats")
+        command = [sys.executable, os.path.join(REPO_DIR, runner["script"]), *runner["args"]]
+        with open(os.path.join(workdir, "run.log"), "wb") as log:
+            start = time.monotonic()
+            process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+            returncode, peak_rss = wait_child(process, args.timeout)
+            elapsed = time.monotonic() - start
+        after = fetch_stats(base_url + "/stats")
+        latencies, success, failed = task_latencies(env["JOURNAL_FILE"])
+        if returncode != 0:
+            with open(os.path.join(workdir, "run.log"), "r", encoding="utf-8", errors="replace") as f:
+                tail = f.read()[-2000:]
+            print(f"警告：{name} 运行{'超时' if returncode is None else f'失败（退出码 {returncode}）'}，输出的最后部分:\n{tail}")
+        return {
+            "runner": name,
+            "tasks": task_count,
+            "concurrency": concurrency if runner["concurrency_env"] else 1,
+            "success": success,
+            "failed": failed,
+            "seconds": elapsed,
+            "tasks_per_second": (success + failed) / elapsed if elapsed > 0 else None,
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "peak_rss_mb": peak_rss,
+            "requests": after.get("requests", 0) - before.get("requests", 0),
+            "images": after.get("images", 0) - before.get("images", 0),
+            "returncode": returncode,
+        }
+    finally:
+        if args.keep:
+            print(f"运行目录已保留: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def format_value(value, spec):
+    return "-" if value is None else format(value, spec)
+
+def print_results(results):
+    print(f"\n{'方式':<10}{'任务数':>6}{'并发':>6}{'成功':>6}{'失败':>6}{'耗时(秒)':>9}{'任务/秒':>8}"
+          f"{'p50':>8}{'p95':>8}{'p99':>8}{'内存(MB)':>9}{'请求数':>6}")
+    for r in results:
+        print(f"{r['runner']:<12}{r['tasks']:>9}{r['concurrency']:>8}{r['success']:>8}{r['failed']:>8}"
+              f"{format_value(r['seconds'], '.1f'):>13}{format_value(r['tasks_per_second'], '.2f'):>11}"
+              f"{format_value(r['p50'], '.2f'):>8}{format_value(r['p95'], '.2f'):>8}{format_value(r['p99'], '.2f'):>8}"
+              f"{format_value(r['peak_rss_mb'], '.0f'):>13}{r['requests']:>9}")
+
+def main():
+    parser = argparse.ArgumentParser(description="使用本地模拟服务压测各处理脚本的吞吐量、耗时和内存")
+    parser.add_argument("--runners", default="batch,thread,asyncio",
+                        help=f"压测的处理方式，逗号分隔，可选 {', '.join(RUNNERS)}，默认为 batch,thread,asyncio")
+    parser.add_argument("--tasks", default="20,100", help="任务数，逗号分隔，默认为 20,100")
+    parser.add_argument("--concurrency", default="5,20", help="并发数，逗号分隔，默认为 5,20（batch 不使用）")
+    parser.add_argument("--images-per-task", type=int, default=1, help="每个任务的输入图片数，默认为1")
+    parser.add_argument("--input-kb", type=int, default=200, help="输入图片大小（KB），默认为200")
+    parser.add_argument("--rate-limit", type=float, default=0, help="API_RATE_LIMIT（请求间隔秒数），默认为0即不限流")
+    parser.add_argument("--stream", action="store_true", help="使用流式响应（STREAM_RESPONSE=1）")
+    parser.add_argument("--timeout", type=float, default=600, help="单次运行的超时（秒），默认为600")
+    parser.add_argument("--output", help="将结果保存为 JSON 文件")
+    parser.add_argument("--keep", action="store_true", help="保留每次运行的临时目录（含输出和运行日志）")
+    mock = parser.add_argument_group("模拟服务")
+    mock.add_argument("--port", type=int, default=18080, help="模拟服务端口，默认为 18080")
+    mock.add_argument("--latency", default="lognormal:2,0.3", help="请求耗时分布，格式见 mock_server.py，默认为 lognormal:2,0.3")
+    mock.add_argument("--rate-429", type=float, default=0.0, help="返回 429 的比例，默认为0")
+    mock.add_argument("--rate-5xx", type=float, default=0.0, help="返回 5xx 的比例，默认为0")
+    mock.add_argument("--links", type=int, default=2, help="每个响应中的图片链接数，默认为2")
+    mock.add_argument("--image-kb", type=int, default=256, help="下载的图片大小（KB），默认为256")
+    mock.add_argument("--download-latency", default="uniform:0.05,0.2", help="图片下载耗时分布，默认为 uniform:0.05,0.2")
+    args = parser.parse_args()
+
+    runners = parse_list(args.runners)
+    unknown = [name for name in runners if name not in RUNNERS]
+    if unknown:
+        parser.error(f"未知的处理方式: {', '.join(unknown)}")
+    task_counts = parse_list(args.tasks, int)
+    concurrencies = parse_list(args.concurrency, int)
+
+    try:
+        mock_process, base_url = start_mock(args)
+    except RuntimeError as e:
+        print(f"错误：{e}")
+        sys.exit(1)
+    print(f"模拟服务: {base_url}（请求耗时 {args.latency}，429 比例 {args.rate_429}，5xx 比例 {args.rate_5xx}）")
+    if Image is None and os.getenv("IMAGE_PREPROCESS", "0").lower() in ("1", "true", "yes"):
+        print("警告：未安装 Pillow，输入图片无法解码，压测不支持 IMAGE_PREPROCESS（pip install pillow）")
+
+    results = []
+    try:
+        for name in runners:
+            for task_count in task_counts:
+                for concurrency in concurrencies if RUNNERS[name]["concurrency_env"] else [1]:
+                    print(f"运行 {name}: {task_count} 个任务，并发 {concurrency}...", flush=True)
+                    result = run_once(args, base_url, name, task_count, concurrency)
+                    print(f"  {result['seconds']:.1f} 秒，{format_value(result['tasks_per_second'], '.2f')} 任务/秒，"
+                          f"成功 {result['success']}，失败 {result['failed']}", flush=True)
+                    results.append(result)
+    except KeyboardInterrupt:
+        print("\n已中断，输出已完成的结果")
+    finally:
+        mock_process.terminate()
+        mock_process.wait()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到: {args.output}")
+
+if __name__ == "__main__":
+    main()
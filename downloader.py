@@ -0,0 +1,249 @@
+"""
+下载阶段: 图片下载与API请求分离，使用独立的队列和工作线程
+* 请求线程拿到图片链接后提交到下载队列即可返回，慢速的CDN下载不再占用请求并发名额
+* 下载并发数由 DOWNLOAD_WORKERS 单独设置，与API并发数互不影响
+* 提交后返回 concurrent.futures.Future，线程池和 asyncio 引擎（asyncio.wrap_future）都可以等待
+* 图片按块写入磁盘，连接和读取分别设置超时，连接中断后用 Range 请求从断点继续
+* 先写入临时文件，完整下载后再重命名为最终文件名，不会留下同名的不完整文件
+* 同一次运行中相同的图片地址只下载一次，其余位置创建硬链接（不支持时复制）；
+  可选按内容哈希去重，不同地址下载到相同内容时也只保留一份数据
+"""
+
+import os
+import queue
+import re
+import shutil
+import hashlib
+import threading
+import requests
+from concurrent.futures import Future
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量获取配置
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))  # 下载线程数
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT", "10"))  # 建立连接超时 (秒)
+DOWNLOAD_READ_TIMEOUT = float(os.getenv("DOWNLOAD_READ_TIMEOUT", "60"))  # 两次收到数据之间的最长等待 (秒)
+DOWNLOAD_RESUME_ATTEMPTS = int(os.getenv("DOWNLOAD_RESUME_ATTEMPTS", "3"))  # 连接中断后最多续传次数
+DOWNLOAD_DEDUP_CONTENT = os.getenv("DOWNLOAD_DEDUP_CONTENT", "0").lower() in ("1", "true", "yes")  # 是否按内容哈希去重
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # 每次写入磁盘的字节数
+
+# 可以续传的网络错误
+RESUMABLE_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+class DownloadStage:
+    """下载队列和工作线程，线程在第一次提交时启动"""
+
+    def __init__(self, workers=DOWNLOAD_WORKERS):
+        self.workers = max(1, workers)
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"download-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, fn, *args):
+        """提交一个下载，fn(*args) 在下载线程中执行，返回 Future"""
+        self._start()
+        future = Future()
+        self.queue.put((future, fn, args))
+        return future
+
+    def pending(self):
+        """队列中等待下载的数量"""
+        return self.queue.qsize()
+
+    def shutdown(self):
+        """等待队列中的下载完成后停止工作线程"""
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+
+def when_all(futures, callback):
+    """所有 futures 完成后在最后完成的线程中调用 callback(结果列表)，返回得到其返回值的 Future"""
+    futures = list(futures)
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finish():
+        try:
+            combined.set_result(callback([future.result() for future in futures]))
+        except BaseException as e:
+            combined.set_exception(e)
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            finish()
+
+    if not futures:
+        finish()
+    for future in futures:
+        future.add_done_callback(on_done)
+    return combined
+
+def content_range_start(value):
+    """解析 Content-Range 头，返回 (起始位置, 总长度)，总长度未知时为None"""
+    m = re.match(r"bytes (\d+)-\d+/(\d+|\*)", value or "")
+    if not m:
+        return None, None
+    total = m.group(2)
+    return int(m.group(1)), None if total == "*" else int(total)
+
+def fetch_to_file(url, output_path, session=None):
+    """下载文件到 output_path，返回文件大小；失败时抛出异常且不会留下不完整的文件"""
+    session = session or requests
+    tmp_path = f"{output_path}.part"
+    received = 0
+    total = None
+    resumes = 0
+    try:
+        while True:
+            headers = {"Range": f"bytes={received}-"} if received else {}
+            try:
+                with session.get(url, headers=headers, stream=True,
+                                 timeout=(DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)) as response:
+                    response.raise_for_status()
+                    start, range_total = content_range_start(response.headers.get("Content-Range"))
+                    partial = response.status_code == 206
+                    if partial and received and start == received:
+                        mode = "ab"  # 从断点继续
+                    elif partial and start != 0:
+                        # 返回的范围与请求的不符，继续写入会错位：计为一次失败，下次不带 Range 从头下载
+                        requested, received, total = received, 0, None
+                        raise requests.ConnectionError(f"续传位置不符: 请求从 {requested} 字节开始，返回从 {start} 字节开始")
+                    else:
+                        # 首次请求，或服务端不支持续传（返回200或从0开始的206）时从头下载
+                        mode, received = "wb", 0
+                        length = response.headers.get("Content-Length")
+                        total = range_total or (int(length) if length and length.isdigit() else None)
+                    with open(tmp_path, mode) as f:
+                        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                            f.write(chunk)
+                            received += len(chunk)
+                if total is not None and received < total:
+                    raise requests.ConnectionError(f"连接提前关闭: 已接收 {received}/{total} 字节")
+                break
+            except RESUMABLE_ERRORS:
+                resumes += 1
+                if resumes > DOWNLOAD_RESUME_ATTEMPTS:
+                    raise
+        os.replace(tmp_path, output_path)
+        return received
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def link_file(src, dst):
+    """将 dst 替换为 src 的硬链接（不支持时复制）"""
+    tmp_path = f"{dst}.part"
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+class DownloadRegistry:
+    """本次运行的下载登记表（线程安全）：每个图片地址只下载一次"""
+
+    def __init__(self, dedup_content=DOWNLOAD_DEDUP_CONTENT):
+        self.dedup_content = dedup_content
+        self.by_url = {}  # 图片地址 -> 已下载的文件路径
+        self.by_hash = {}  # 内容哈希 -> 已下载的文件路径
+        self.pending = {}  # 正在下载的图片地址 -> threading.Event
+        self.lock = threading.Lock()
+        self.fetched = 0
+        self.linked = 0
+
+    def fetch(self, url, output_path, fetch):
+        """下载图片到 output_path，fetch(url, path) 执行实际下载
+
+        返回复用的已有文件路径；实际下载时返回None
+        """
+        while True:
+            with self.lock:
+                source = self.by_url.get(url)
+                if source is not None and os.path.exists(source):
+                    break
+                event = self.pending.get(url)
+                if event is None:
+                    # 由当前线程负责下载
+                    event = self.pending[url] = threading.Event()
+                    source = None
+                    break
+            # 其他线程正在下载同一地址，等待后重新查询（下载失败时由下一个线程重试）
+            event.wait()
+
+        if source is not None:
+            if source != output_path:
+                link_file(source, output_path)
+            with self.lock:
+                self.linked += 1
+            return source
+
+        try:
+            fetch(url, output_path)
+            source = self._dedup_content(output_path) if self.dedup_content else None
+        except BaseException:
+            with self.lock:
+                del self.pending[url]
+            event.set()
+            raise
+
+        with self.lock:
+            del self.pending[url]
+            self.by_url[url] = output_path
+            if source is None:
+                self.fetched += 1
+            else:
+                self.linked += 1
+        event.set()
+        return source
+
+    def _dedup_content(self, path):
+        """内容与已下载的文件相同时改为硬链接，返回该文件路径"""
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        with self.lock:
+            source = self.by_hash.setdefault(digest, path)
+        if source == path or not os.path.exists(source):
+            return None
+        link_file(source, path)
+        return source
+
+    def stats(self):
+        """返回 (实际下载次数, 复用已有文件次数)"""
+        with self.lock:
+            return self.fetched, self.linked
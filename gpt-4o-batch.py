@@ -10,12 +10,25 @@
 
 import os
 import base64
-import requests
 import json
 import time
 import re
+import argparse
 from dotenv import load_dotenv
 from datetime import datetime
+from http_session import get_session, close_session
+from downloader import DownloadStage, DownloadRegistry, DOWNLOAD_WORKERS, fetch_to_file
+from result_cache import ResultCache
+from image_cache import EncodedImageCache
+from image_preprocess import ImagePreprocessor, detect_mime
+from streaming_body import StreamingChatBody
+from sse_stream import SSEDecoder, ChatStreamAssembler, DOWNLOAD_LINK_PATTERN
+from task_journal import TaskJournal, JobPlanner, START, SUCCESS, FAILURE
+from task_scheduler import JobScheduler, SCHEDULE_LOOKAHEAD
+from task_source import TaskSource, default_tasks_file, is_jsonl
+from retry_policy import RetryBudget, RetryPolicy, classify_exception, classify_response, parse_retry_after
+from token_pool import create_token_pool, request_outcome, failure_cause, format_key_stats, KEY_ERRORS
+from metrics import Metrics, METRICS_PORT, start_metrics_server
 
 # 加载环境变量
 load_dotenv()
@@ -23,46 +36,247 @@ load_dotenv()
 # 目录配置
 INPUT_DIR = os.path.join(os.getcwd(), "input")
 OUTPUT_DIR = os.path.join(os.getcwd(), "output")
-TASKS_FILE = os.path.join(INPUT_DIR, "tasks.json")
+TASKS_FILE = os.getenv("TASKS_FILE") or default_tasks_file(INPUT_DIR)  # 存在 tasks.jsonl 时优先使用
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", os.path.join(OUTPUT_DIR, "journal.jsonl"))
 
 # 从环境变量获取配置
 DEFAULT_MODEL = os.getenv("MODEL", "gpt-4o-image-vip")
-API_URL = "https://api.tu-zi.com/v1/chat/completions"
+API_URL = os.getenv("API_URL", "https://api.tu-zi.com/v1/chat/completions")  # API 地址，压测时可指向本地模拟服务
 API_TOKEN = os.getenv("API_TOKEN")
+API_TOKENS = os.getenv("API_TOKENS")  # 多个API密钥（逗号分隔），设置后轮换使用（优先选择有限流令牌的密钥），出错的密钥暂停使用
 API_DELAY = float(os.getenv("API_DELAY", "2"))  # 默认2秒延迟
+STREAMING_BODY = os.getenv("STREAMING_BODY", "0").lower() in ("1", "true", "yes")  # 是否边读取图片边发送请求体
+STREAM_RESPONSE = os.getenv("STREAM_RESPONSE", "0").lower() in ("1", "true", "yes")  # 是否使用流式响应，图片链接出现时立即开始下载
+
+# 共享会话的连接池大小 (一个API请求加上各下载线程同时下载图片)
+SESSION_CONCURRENCY = DOWNLOAD_WORKERS + 1
+
+# 图片编码缓存 (同一张图片被多个任务引用时只编码一次)
+image_cache = EncodedImageCache()
+
+# 图片预处理 (开启 IMAGE_PREPROCESS 时上传前缩小并重新压缩图片)
+preprocessor = ImagePreprocessor()
+
+# 结果缓存 (相同模型、提示词和图片内容的任务直接复用结果)
+result_cache = ResultCache()
+
+# 全局重试预算 (避免重试放大上游故障)
+retry_budget = RetryBudget()
+
+# 下载阶段 (独立的队列和线程，同一任务的多张图片并行下载)
+download_stage = DownloadStage()
+
+# 下载登记表 (同一图片地址在本次运行中只下载一次)
+download_registry = DownloadRegistry()
+
+# 运行指标 (使用 --metrics-port 或 METRICS_PORT 时可通过本地 HTTP 端口查看)
+metrics = Metrics()
+metrics.set_function("gpt4o_download_queue_depth", lambda: download_stage.pending())
+
+# API 密钥池 (配置 API_TOKENS 时使用；任务之间已有 API_DELAY 间隔，只有单独配置了限流的密钥才会限流)
+try:
+    token_pool = create_token_pool(API_TOKENS, 0)
+except ValueError as e:
+    print(f"错误：API_TOKENS 配置有误: {e}")
+    exit(1)
 
 # 确保目录存在
 os.makedirs(INPUT_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # 验证API Token
-if not API_TOKEN:
+if not API_TOKEN and token_pool is None:
     print("错误：未设置API_TOKEN环境变量")
     print("请复制.env.template为.env并填写您的API密钥")
     exit(1)
 
 # 准备请求数据
+def resolve_image_path(image_path):
+    """支持相对路径（相对于input/images）和绝对路径"""
+    if not os.path.isabs(image_path):
+        return os.path.join(INPUT_DIR, "images", image_path)
+    return image_path
+
+def upload_image_path(image_path):
+    """返回实际上传的图片文件：开启预处理时为缩小和重新压缩后的缓存文件"""
+    return preprocessor.prepare(resolve_image_path(image_path))
+
+def image_mime(full_path):
+    """根据文件头判断图片类型"""
+    return detect_mime(full_path)
+
+def encode_image(full_path):
+    """读取图片并编码为data URL"""
+    with open(full_path, "rb") as img_file:
+        encoded_data = base64.b64encode(img_file.read()).decode("utf-8")
+    return f"data:{image_mime(full_path)};base64,{encoded_data}"
+
 def prepare_image_data(image_path):
-    """将图片转换为base64编码"""
+    """将图片转换为base64编码（同一张图片在本次运行中只编码一次）"""
     try:
-        # 支持相对路径和绝对路径
-        if not os.path.isabs(image_path):
-            full_path = os.path.join(INPUT_DIR, "images", image_path)
-        else:
-            full_path = image_path
-            
-        with open(full_path, "rb") as img_file:
-            encoded_data = base64.b64encode(img_file.read()).decode("utf-8")
-            # 自动检测图片类型
-            img_type = "png"  # 默认类型
-            if image_path.lower().endswith(".jpg") or image_path.lower().endswith(".jpeg"):
-                img_type = "jpeg"
-            print(f"已准备图片数据: {image_path}（内容已隐藏以确保安全）")
-            return f"data:image/{img_type};base64,{encoded_data}"
+        data_url = image_cache.get(upload_image_path(image_path), encode_image)
+        print(f"已准备图片数据: {image_path}（内容已隐藏以确保安全）")
+        return data_url
     except Exception as e:
         print(f"准备图片数据时出错: {image_path} - {e}")
         raise
 
+def build_request_body(model, prompt, images):
+    """构建请求体：默认为序列化后的JSON；开启STREAMING_BODY时为流式请求体，发送时才按块读取和编码图片"""
+    if STREAMING_BODY:
+        paths = [upload_image_path(img) for img in images]
+        return StreamingChatBody(model, prompt, [(path, image_mime(path)) for path in paths], stream=STREAM_RESPONSE)
+    
+    # 构建消息内容
+    message_content = [{"type": "text", "text": prompt}]
+    
+    # 添加图片到消息内容
+    for image_path in images:
+        image_data = prepare_image_data(image_path)
+        message_content.append({
+            "type": "image_url",
+            "image_url": {"url": image_data}
+        })
+    
+    data = {
+        "model": model,
+        "stream": STREAM_RESPONSE, 
+        "messages": [
+            {
+                "role": "user",
+                "content": message_content
+            }
+        ],
+    }
+    return json.dumps(data).encode("utf-8")
+
+def download_path(task_output_dir, result_id, choice_index, idx, image_url):
+    """图片保存路径：响应ID-choice序号-链接序号.扩展名"""
+    ext = "png"
+    m = re.search(r"\.([a-zA-Z0-9]+)(?:\?|$)", image_url)
+    if m:
+        ext = m.group(1).split("?")[0]
+        if len(ext) > 5:
+            ext = "png"
+    return os.path.join(task_output_dir, f"{result_id}-{choice_index}-{idx}.{ext}")
+
+def fetch_image(url, output_path):
+    """下载图片到文件，记录下载耗时和字节数"""
+    start = time.monotonic()
+    size = fetch_to_file(url, output_path, get_session(SESSION_CONCURRENCY))
+    metrics.observe("gpt4o_download_duration_seconds", time.monotonic() - start)
+    metrics.inc("gpt4o_download_bytes_total", size)
+    return size
+
+def download_image(image_url, output_path):
+    """下载图片并保存，返回是否成功"""
+    try:
+        print(f"正在下载图片: {image_url}")
+        source = download_registry.fetch(image_url, output_path, fetch_image)
+        if source is None:
+            print(f"图片已保存到: {output_path}")
+        else:
+            print(f"图片与已下载的 {source} 相同，已链接到: {output_path}")
+        metrics.inc("gpt4o_downloads_total", result="success")
+        return True
+    except Exception as e:
+        metrics.inc("gpt4o_downloads_total", result="failure")
+        print(f"无法下载图片数据: {image_url} - {e}")
+        return False
+
+def read_response(response, task_output_dir, downloads):
+    """读取响应，返回(响应文本, 是否按SSE解析)；流式响应边接收边解析，图片链接出现时立即提交下载
+
+    服务端未按流式返回时（如忽略 stream 参数返回 JSON）按普通响应处理，由调用方从响应中提取图片链接
+    """
+    try:
+        content_type = response.headers.get("Content-Type") or ""
+        if response.status_code != 200 or not (STREAM_RESPONSE and content_type.startswith("text/event-stream")):
+            return response.text, False
+        decoder, assembler = SSEDecoder(), ChatStreamAssembler()
+        for chunk in response.iter_content(chunk_size=None):
+            for data in decoder.feed(chunk):
+                for choice_index, idx, image_url in assembler.add(data):
+                    print(f"检测到图片链接，开始下载: {image_url}")
+                    output_path = download_path(task_output_dir, assembler.id or "noid", choice_index, idx, image_url)
+                    downloads.append(download_stage.submit(download_image, image_url, output_path))
+        return assembler.result_text(), True
+    finally:
+        response.close()
+
+def release_key(key, status_code=None, response_text=None):
+    """记录密钥的请求结果；返回密钥相关的错误分类（有其他密钥可以换用时），否则返回None"""
+    if key is None:
+        return None
+    category = request_outcome(status_code, response_text)
+    if token_pool.release(key, category):
+        print(f"密钥 {key.name} 连续出现错误（{category}），暂停使用 {token_pool.cooldown:.0f} 秒")
+    if category in KEY_ERRORS and len(token_pool.keys) > 1:
+        return category
+    return None
+
+def record_request(body, duration, category, status_code=None, response_text=None):
+    """记录一次API请求的指标"""
+    metrics.inc("gpt4o_requests_in_flight", -1)
+    metrics.inc("gpt4o_requests_total")
+    metrics.inc("gpt4o_upload_bytes_total", len(body))
+    metrics.observe("gpt4o_request_duration_seconds", duration)
+    cause = failure_cause(category, status_code, response_text)
+    if cause is not None:
+        metrics.inc("gpt4o_request_failures_total", cause=cause)
+
+def drop_downloads(downloads):
+    """放弃失败的响应中已提交的下载：尚未开始的取消，已开始的不再等待"""
+    for future in downloads:
+        future.cancel()
+
+def send_with_retry(body, headers, task_output_dir):
+    """发送API请求，可重试的错误按退避策略重试，返回(状态码, 响应文本, 下载列表, 是否按SSE解析)，请求始终出错时返回None
+
+    下载列表为流式响应中已提交的下载；重试时放弃前一次响应中的下载
+    """
+    policy = RetryPolicy(retry_budget)
+    
+    while True:
+        retry_after = None
+        downloads = []  # 本次请求的流式响应中已提交的下载
+        wait_start = time.monotonic()
+        key = token_pool.acquire() if token_pool is not None else None
+        if key is not None:
+            headers = dict(headers, Authorization=f"Bearer {key.token}")
+        request_start = time.monotonic()
+        metrics.set("gpt4o_rate_limiter_wait_seconds", request_start - wait_start)
+        metrics.inc("gpt4o_rate_limiter_wait_seconds_total", request_start - wait_start)
+        metrics.inc("gpt4o_requests_in_flight")
+        try:
+            response = get_session(SESSION_CONCURRENCY).post(API_URL, data=body, headers=headers, timeout=1200, stream=STREAM_RESPONSE)
+            response_text, streamed = read_response(response, task_output_dir, downloads)
+        except Exception as e:
+            print(f"发送请求时出错: {e}")
+            category = classify_exception(e)
+            record_request(body, time.monotonic() - request_start, category)
+            release_key(key)
+            drop_downloads(downloads)
+            result = None
+        else:
+            print(f"响应状态码: {response.status_code}")
+            category = classify_response(response.status_code, response_text)
+            record_request(body, time.monotonic() - request_start, category, response.status_code, response_text)
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            result = (response.status_code, response_text, downloads, streamed)
+            key_category = release_key(key, response.status_code, response_text)
+            if key_category:
+                # 密钥相关的错误换用其他密钥重试，不需要遵守该密钥的 Retry-After
+                category, retry_after = category or key_category, None
+        
+        delay = policy.next_delay(category, retry_after)
+        if delay is None:
+            return result
+        drop_downloads(downloads)
+        metrics.inc("gpt4o_retries_total", cause=category)
+        print(f"请求失败（{category}），{delay:.1f} 秒后进行第 {policy.attempt}/{policy.max_attempts} 次请求")
+        time.sleep(delay)
+
 def process_task(task, task_id):
     """处理单个任务"""
     # 获取任务参数
@@ -98,31 +312,18 @@ def process_task(task, task_id):
     for i, img in enumerate(images, 1):
         print(f"图片 {i} 路径: {img}")
     
-    # 构建消息内容
-    message_content = [{"type": "text", "text": prompt}]
+    # 查询结果缓存，命中时直接复用此前的响应和图片，不再请求API
+    cache_key = result_cache.key(model, prompt, [resolve_image_path(img) for img in images])
+    if result_cache.restore(cache_key, task_output_dir):
+        print("命中结果缓存，已复用此前的结果")
+        return True
     
-    # 添加图片到消息内容
-    for image_path in images:
-        try:
-            image_data = prepare_image_data(image_path)
-            message_content.append({
-                "type": "image_url",
-                "image_url": {"url": image_data}
-            })
-        except Exception as e:
-            print(f"处理图片时出错: {image_path} - {e}")
-            return False
-    
-    data = {
-        "model": model,
-        "stream": False, 
-        "messages": [
-            {
-                "role": "user",
-                "content": message_content
-            }
-        ],
-    }
+    # 构建请求体
+    try:
+        body = build_request_body(model, prompt, images)
+    except Exception as e:
+        print(f"处理图片时出错: {e}")
+        return False
     
     # 添加调试信息
     print(f"请求数据已准备好（图片内容已隐藏）。")
@@ -133,30 +334,37 @@ def process_task(task, task_id):
         "Content-Type": "application/json",
     }
     
+    # downloads 为按SSE解析的响应中已开始的下载
+    response = send_with_retry(body, headers, task_output_dir)
+    if response is None:
+        return False
+    status_code, response_text, downloads, streamed = response
+    
     try:
-        response = requests.post(API_URL, json=data, headers=headers, timeout=1200)
-        print(f"响应状态码: {response.status_code}")
-        
         # 保存原始响应
         with open(os.path.join(task_output_dir, "response.json"), "w", encoding="utf-8") as f:
-            f.write(response.text)
+            f.write(response_text)
     except Exception as e:
-        print(f"发送请求时出错: {e}")
+        print(f"保存响应时出错: {e}")
+        drop_downloads(downloads)
         return False
     
     # 处理响应
-    if response.status_code != 200:
-        print(f"API 错误: {response.status_code} - {response.text}")
+    if status_code != 200:
+        print(f"API 错误: {status_code} - {response_text}")
+        drop_downloads(downloads)
         return False
     
     try:
-        result = response.json()
+        result = json.loads(response_text)
     except Exception as e:
         print(f"解析响应 JSON 时出错: {e}")
+        drop_downloads(downloads)
         return False
     
     if "error" in result:
         print(f"API 错误: {result['error']['message']}")
+        drop_downloads(downloads)
         return False
     
     # 保存文本响应
@@ -173,41 +381,31 @@ def process_task(task, task_id):
     
     # 遍历result，提取content字段中的图片地址并保存
     if "choices" in result and isinstance(result["choices"], list):
-        download_count = 0
-        for choice in result["choices"]:
-            if "message" in choice and "content" in choice["message"]:
-                content = choice["message"]["content"]
-                print(f"正在处理内容: {content[:100]}...")  # 只显示内容的前100个字符
-
-                # 只提取 [点击下载](http...) 这种格式的图片链接
-                download_links = re.findall(r'\[点击下载\]\((https?://[^\s\)]+)\)', content)
-                for idx, image_url in enumerate(download_links):
-                    try:
-                        print(f"正在下载图片: {image_url}")
-                        image_data = requests.get(image_url).content
-                        ext = "png"
-                        m = re.search(r"\.([a-zA-Z0-9]+)(?:\?|$)", image_url)
-                        if m:
-                            ext = m.group(1).split("?")[0]
-                            if len(ext) > 5:
-                                ext = "png"
-                        file_name = f"{result.get('id', 'noid')}-{choice.get('index', idx)}-{idx}.{ext}"
-                        output_path = os.path.join(task_output_dir, file_name)
-                        with open(output_path, "wb") as f:
-                            f.write(image_data)
-                        print(f"图片已保存到: {output_path}")
-                        download_count += 1
-                    except Exception as e:
-                        print(f"无法下载图片数据: {image_url} - {e}")
+        # 图片交给下载阶段并行下载（按SSE解析的响应中链接出现时已提交），这里等待完成
+        if not streamed:
+            for choice in result["choices"]:
+                if "message" in choice and "content" in choice["message"]:
+                    content = choice["message"]["content"]
+                    print(f"正在处理内容: {content[:100]}...")  # 只显示内容的前100个字符
+
+                    for idx, image_url in enumerate(DOWNLOAD_LINK_PATTERN.findall(content)):
+                        output_path = download_path(task_output_dir, result.get('id', 'noid'), choice.get('index', idx), idx, image_url)
+                        downloads.append(download_stage.submit(download_image, image_url, output_path))
+        downloaded = [future.result() for future in downloads]
+        download_count = sum(downloaded)
         if download_count == 0:
             print("未成功下载任何图片。")
+        
+        # 至少有一张图片且所有图片均已下载时写入结果缓存
+        if downloaded and all(downloaded):
+            result_cache.store(cache_key, task_output_dir)
     else:
         print("返回值格式错误。")
     
     return True
 
 def load_tasks():
-    """从tasks.json加载任务列表"""
+    """加载任务：tasks.json 整体读入，tasks.jsonl 在处理过程中逐行读取"""
     # 如果任务文件不存在，创建一个示例
     if not os.path.exists(TASKS_FILE):
         # 确保images目录存在
@@ -229,7 +427,11 @@ def load_tasks():
         ]
         
         with open(TASKS_FILE, "w", encoding="utf-8") as f:
-            json.dump(example_tasks, f, ensure_ascii=False, indent=2)
+            if is_jsonl(TASKS_FILE):
+                for task in example_tasks:
+                    f.write(json.dumps(task, ensure_ascii=False) + "\n")
+            else:
+                json.dump(example_tasks, f, ensure_ascii=False, indent=2)
             
         print(f"已创建示例任务文件: {TASKS_FILE}")
         print("请在执行批处理前编辑此文件！")
@@ -237,9 +439,11 @@ def load_tasks():
     
     # 加载任务
     try:
-        with open(TASKS_FILE, "r", encoding="utf-8") as f:
-            tasks = json.load(f)
-        print(f"已加载 {len(tasks)} 个任务")
+        tasks = TaskSource(TASKS_FILE)
+        if tasks.total is None:
+            print(f"将逐行读取任务文件: {TASKS_FILE}")
+        else:
+            print(f"已加载 {tasks.total} 个任务")
         return tasks
     except Exception as e:
         print(f"加载任务文件失败: {e}")
@@ -247,39 +451,103 @@ def load_tasks():
 
 def main():
     """主函数，处理批量任务"""
+    parser = argparse.ArgumentParser(description="GPT-4o 批量处理工具")
+    parser.add_argument("--resume", action="store_true",
+                        help="根据任务日志续跑：跳过已成功的任务，只重新执行未完成或失败的任务")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="不使用结果缓存，所有任务都重新请求API")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="指标 HTTP 服务端口（Prometheus 格式 /metrics，JSON 格式 /metrics.json），默认读取METRICS_PORT环境变量")
+    args = parser.parse_args()
+    if args.no_cache:
+        result_cache.enabled = False
+    
     print("=== GPT-4o 批量处理工具 ===")
+    if preprocessor.unavailable:
+        print("警告：图片预处理需要安装 Pillow（pip install pillow），本次将上传原图")
+    if args.metrics_port > 0:
+        try:
+            server = start_metrics_server(metrics.snapshot, args.metrics_port)
+            host, port = server.server_address[:2]
+            print(f"指标服务: http://{host}:{port}/metrics（JSON: /metrics.json）")
+        except OSError as e:
+            print(f"警告：无法启动指标服务（端口 {args.metrics_port}）: {e}")
     
-    # 加载任务
+    # 加载任务 (tasks.jsonl 在处理过程中逐行读取)
     tasks = load_tasks()
     
-    # 任务总数
-    total_tasks = len(tasks)
+    # 任务总数 (逐行读取时未知)
+    total_tasks = tasks.total
     success_count = 0
+    processed_count = 0
+    
+    # 生成任务键，续跑时跳过已完成的任务
+    journal = TaskJournal(JOURNAL_FILE)
+    planner = JobPlanner(journal, args.resume)
+    if args.resume:
+        print("续跑模式：将跳过任务日志中已成功的任务")
+    
+    # 清理过期和超出容量的结果缓存
+    result_cache.evict()
+    
+    # 按优先级和截止时间调度，已整体读入的任务全部参与排序
+    scheduler = JobScheduler(planner.jobs(tasks), 0 if total_tasks is not None else SCHEDULE_LOOKAHEAD)
     
     # 处理每个任务
-    for idx, task in enumerate(tasks, 1):
-        print(f"\n[{idx}/{total_tasks}] 开始处理任务...")
+    for job in scheduler:
+        idx = job["idx"]
+        position = f"{idx}/{total_tasks}" if total_tasks is not None else f"{idx}"
         
-        task_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{idx}"
-        success = process_task(task, task_id)
+        # 为API限流在任务之间添加间隔(可选)
+        if processed_count > 0:
+            delay = API_DELAY  # 使用环境变量中的延迟设置
+            print(f"等待 {delay} 秒后继续下一个任务...")
+            time.sleep(delay)
+        processed_count += 1
+        
+        print(f"\n[{position}] 开始处理任务...")
+        
+        # 续跑时沿用原任务ID
+        task_id = job["task_id"] or f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{idx}"
+        journal.record(job["key"], START, task_id)
+        success = process_task(job["task"], task_id)
+        journal.record(job["key"], SUCCESS if success else FAILURE, task_id)
+        metrics.inc("gpt4o_tasks_total", result="success" if success else "failure")
         
         if success:
             success_count += 1
-            print(f"任务 {idx}/{total_tasks} 处理成功")
+            print(f"任务 {position} 处理成功")
         else:
-            print(f"任务 {idx}/{total_tasks} 处理失败")
-            
-        # 为API限流添加间隔(可选)
-        if idx < total_tasks:
-            delay = API_DELAY  # 使用环境变量中的延迟设置
-            print(f"等待 {delay} 秒后继续下一个任务...")
-            time.sleep(delay)
-    
+            print(f"任务 {position} 处理失败")
+
+    # 释放连接池
+    close_session()
+    download_stage.shutdown()
+    preprocessor.shutdown()
+    journal.close()
+
     # 输出结果统计
     print("\n=== 批量处理完成 ===")
-    print(f"总任务数: {total_tasks}")
+    print(f"总任务数: {planner.count}")
+    if planner.skipped:
+        print(f"跳过任务: {planner.skipped}（此前已完成）")
+    if tasks.invalid_lines:
+        print(f"无法解析的任务行: {len(tasks.invalid_lines)}（行号: {', '.join(map(str, tasks.invalid_lines[:10]))}）")
+    if scheduler.late:
+        print(f"开始时已超过截止时间的任务: {scheduler.late}")
     print(f"成功任务: {success_count}")
-    print(f"失败任务: {total_tasks - success_count}")
+    print(f"失败任务: {processed_count - success_count}")
+    if result_cache.hits:
+        print(f"命中结果缓存: {result_cache.hits}")
+    hits, misses, _, _ = image_cache.stats()
+    if hits + misses:
+        print(f"图片编码缓存: 命中 {hits} 次，编码 {misses} 次")
+    fetched, linked = download_registry.stats()
+    if linked:
+        print(f"图片下载: 下载 {fetched} 张，重复的 {linked} 张已链接到已下载的文件")
+    if token_pool is not None:
+        for name, key_stats in token_pool.stats().items():
+            print(format_key_stats(name, key_stats))
     print(f"处理结果保存在: {OUTPUT_DIR}")
 
 if __name__ == "__main__":
@@ -7,18 +7,48 @@
 * 批处理配置存放在input/tasks.json中
 * 下载的图片和结果将保存在output目录中
 * 并发版本可以同时处理多个任务，提高效率
+* 支持 asyncio 引擎（--engine asyncio，需安装aiohttp），单个事件循环即可同时保持上千个长时间请求
+* 支持多进程模式（--processes N），多个工作进程共用同一个限流器和并发上限
+* 支持 SQLite 任务队列（--queue），多台机器上的任意数量的进程可以共同处理同一批任务
 """
 
 import os
 import base64
-import requests
 import json
 import time
 import re
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import asyncio
+import queue
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 from datetime import datetime
+from rate_limiter import create_rate_limiter
+from adaptive_concurrency import (AdaptiveConcurrency, AsyncAdaptiveConcurrency, SharedConcurrency,
+                                  AsyncSharedConcurrency, OVERLOAD, ERROR, outcome_for_status)
+from retry_policy import RetryBudget, RetryPolicy, classify_exception, classify_response, parse_retry_after
+from task_journal import TaskJournal, JobPlanner, START, SUCCESS, FAILURE
+from task_source import TaskSource, default_tasks_file, is_jsonl
+from task_queue import TaskQueue
+from task_scheduler import JobScheduler, SCHEDULE_LOOKAHEAD
+from token_pool import create_token_pool, request_outcome, failure_cause, format_key_stats, KEY_ERRORS
+from result_cache import ResultCache
+from image_cache import EncodedImageCache
+from image_preprocess import ImagePreprocessor, detect_mime
+from streaming_body import StreamingChatBody
+from sse_stream import SSEDecoder, ChatStreamAssembler, DOWNLOAD_LINK_PATTERN
+from http_session import get_session, close_session, create_async_session
+from metrics import Metrics, METRICS_PORT, merge_snapshots, latency_summary, start_metrics_server
+from tracing import Tracer, TracedBody, TRACE_FILE, NULL_SPAN, write_trace, summary_lines
+from log_writer import LogWriter
+from downloader import DownloadStage, DownloadRegistry, DOWNLOAD_WORKERS, when_all, fetch_to_file
+
+try:
+    import aiohttp  # asyncio 引擎使用的非阻塞HTTP客户端
+except ImportError:
+    aiohttp = None
 
 # 加载环境变量
 load_dotenv()
@@ -26,81 +56,191 @@ load_dotenv()
 # 目录配置
 INPUT_DIR = os.path.join(os.getcwd(), "input")
 OUTPUT_DIR = os.path.join(os.getcwd(), "output")
-TASKS_FILE = os.path.join(INPUT_DIR, "tasks.json")
+TASKS_FILE = os.getenv("TASKS_FILE") or default_tasks_file(INPUT_DIR)  # 存在 tasks.jsonl 时优先使用
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", os.path.join(OUTPUT_DIR, "journal.jsonl"))
 
 # 从环境变量获取配置
 DEFAULT_MODEL = os.getenv("MODEL", "gpt-4o-image-vip")
-API_URL = "https://api.tu-zi.com/v1/chat/completions"
+API_URL = os.getenv("API_URL", "https://api.tu-zi.com/v1/chat/completions")  # API 地址，压测时可指向本地模拟服务
 API_TOKEN = os.getenv("API_TOKEN")
+API_TOKENS = os.getenv("API_TOKENS")  # 多个API密钥（逗号分隔），设置后使用密钥池
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", "5"))  # 默认最大并发数为5
 API_RATE_LIMIT = float(os.getenv("API_RATE_LIMIT", "0.5"))  # 默认每秒最多2个请求 (0.5秒间隔)
+API_BURST = int(os.getenv("API_BURST", "1"))  # 突发容量：空闲时可立即发送的请求数
+API_RPM = int(os.getenv("API_RPM", "0"))  # 每分钟最多请求数，0 表示不限制
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "0").lower() in ("1", "true", "yes")  # 是否根据上游状态自动调整并发数
+CONCURRENCY_MIN = int(os.getenv("CONCURRENCY_MIN", "1"))  # 自适应并发下限
+CONCURRENCY_MAX = int(os.getenv("CONCURRENCY_MAX", "0"))  # 自适应并发上限，0 表示初始并发数的2倍
+CONCURRENCY_LATENCY_TOLERANCE = float(os.getenv("CONCURRENCY_LATENCY_TOLERANCE", "2.0"))  # 延迟超过基线的倍数视为过载，0 表示不检测
+STREAMING_BODY = os.getenv("STREAMING_BODY", "0").lower() in ("1", "true", "yes")  # 是否边读取图片边发送请求体
+STREAM_RESPONSE = os.getenv("STREAM_RESPONSE", "0").lower() in ("1", "true", "yes")  # 是否使用流式响应，图片链接出现时立即开始下载
+ENGINE = os.getenv("ENGINE", "thread")  # 执行引擎: thread 或 asyncio
+ASYNC_CONCURRENCY = int(os.getenv("ASYNC_CONCURRENCY", "1000"))  # asyncio 引擎的最大并发请求数
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "0"))  # 同时在处理中（含下载中）的最大任务数，0 表示并发上限的2倍加下载线程数
+PROCESSES = int(os.getenv("PROCESSES", "1"))  # 工作进程数，大于1时启用多进程模式
+TASK_QUEUE = os.getenv("TASK_QUEUE")  # SQLite 任务队列文件，设置后从队列领取任务
 
-# 创建一个线程安全的锁，用于输出打印
-print_lock = threading.Lock()
+# 日志 (工作线程只把日志放入队列，由后台线程输出到控制台和 LOG_FILE，输出慢时不阻塞请求)
+log = LogWriter()
 
-# 创建一个令牌桶，用于API限流
-class TokenBucket:
-    def __init__(self, rate_limit):
-        self.rate_limit = rate_limit  # 时间间隔
-        self.last_request_time = 0
-        self.lock = threading.Lock()
-        
-    def consume(self):
-        with self.lock:
-            current_time = time.time()
-            time_since_last = current_time - self.last_request_time
-            
-            if time_since_last < self.rate_limit:
-                sleep_time = self.rate_limit - time_since_last
-                time.sleep(sleep_time)
-                
-            self.last_request_time = time.time()
-            return True
+# 实例化令牌桶 (所有线程和 asyncio 引擎共用；多进程模式下工作进程替换为主进程创建的共享令牌桶)
+token_bucket = create_rate_limiter(API_RATE_LIMIT, API_BURST, API_RPM)
+
+# API 密钥池 (配置 API_TOKENS 时使用，每个密钥有独立的限流器和并发上限，不再使用上面的令牌桶)
+try:
+    token_pool = create_token_pool(API_TOKENS, API_RATE_LIMIT, API_BURST, API_RPM)
+except ValueError as e:
+    print(f"错误：API_TOKENS 配置有误: {e}")
+    exit(1)
+
+# 多进程模式下由主进程传入：跨进程共享的并发名额，以及向主进程汇报进度和统计的队列
+shared_slots = None
+progress_queue = None
+
+# SQLite 任务队列 (使用 --queue 时设置，任务结果同时写入队列)
+task_queue = None
+
+# 任务日志 (记录任务开始、成功和失败，用于 --resume 续跑)
+journal = TaskJournal(JOURNAL_FILE)
+
+# 图片编码缓存 (同一张图片被多个任务引用时只编码一次)
+image_cache = EncodedImageCache()
+
+# 图片预处理 (开启 IMAGE_PREPROCESS 时上传前缩小并重新压缩图片)
+preprocessor = ImagePreprocessor(warn=log.warning)
+
+# 结果缓存 (相同模型、提示词和图片内容的任务直接复用结果)
+result_cache = ResultCache()
+
+# 全局重试预算 (所有任务共用，避免重试放大上游故障)
+retry_budget = RetryBudget()
+
+# 下载阶段 (独立的队列和线程，两种引擎共用，下载不占用请求并发名额)
+download_stage = DownloadStage()
+
+# 下载登记表 (同一图片地址在本次运行中只下载一次)
+download_registry = DownloadRegistry()
 
-# 实例化令牌桶
-token_bucket = TokenBucket(API_RATE_LIMIT)
+# 运行指标 (多进程模式下主进程在 worker_metrics 中保存各工作进程最近汇报的快照)
+metrics = Metrics()
+metrics.set_function("gpt4o_download_queue_depth", lambda: download_stage.pending())
+worker_metrics = {}
+
+# 指标 HTTP 服务 (使用 --metrics-port 时启动；多进程模式下在创建工作进程之后才启动)
+metrics_server = None
+
+# 阶段耗时追踪 (使用 --trace 或 TRACE_FILE 时记录；多进程模式下主进程在 worker_traces 中收集各工作进程的记录)
+tracer = Tracer(bool(TRACE_FILE))
+worker_traces = []
 
 # 确保目录存在
 os.makedirs(INPUT_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # 验证API Token
-if not API_TOKEN:
+if not API_TOKEN and token_pool is None:
     print("错误：未设置API_TOKEN环境变量")
     print("请复制.env.template为.env并填写您的API密钥")
     exit(1)
 
-# 线程安全的打印函数
-def safe_print(*args, **kwargs):
-    with print_lock:
-        print(*args, **kwargs)
+def task_log(ctx, level, message, **fields):
+    """记录任务相关的日志，控制台输出带任务名称和ID，JSON 日志中任务信息为单独的字段"""
+    log.log(level, message, task=ctx["task_idx"], task_name=ctx["task_name"], task_id=ctx["task_id"], **fields)
 
 # 准备请求数据
+def resolve_image_path(image_path):
+    """支持相对路径（相对于input/images）和绝对路径"""
+    if not os.path.isabs(image_path):
+        return os.path.join(INPUT_DIR, "images", image_path)
+    return image_path
+
+def upload_image_path(image_path):
+    """返回实际上传的图片文件：开启预处理时为缩小和重新压缩后的缓存文件"""
+    return preprocessor.prepare(resolve_image_path(image_path))
+
+def image_mime(full_path):
+    """根据文件头判断图片类型"""
+    return detect_mime(full_path)
+
+def encode_image(full_path):
+    """读取图片并编码为data URL"""
+    with open(full_path, "rb") as img_file:
+        encoded_data = base64.b64encode(img_file.read()).decode("utf-8")
+    return f"data:{image_mime(full_path)};base64,{encoded_data}"
+
 def prepare_image_data(image_path):
-    """将图片转换为base64编码"""
+    """将图片转换为base64编码（同一张图片在本次运行中只编码一次）"""
     try:
-        # 支持相对路径和绝对路径
-        if not os.path.isabs(image_path):
-            full_path = os.path.join(INPUT_DIR, "images", image_path)
-        else:
-            full_path = image_path
-            
-        with open(full_path, "rb") as img_file:
-            encoded_data = base64.b64encode(img_file.read()).decode("utf-8")
-            # 自动检测图片类型
-            img_type = "png"  # 默认类型
-            if image_path.lower().endswith(".jpg") or image_path.lower().endswith(".jpeg"):
-                img_type = "jpeg"
-            safe_print(f"已准备图片数据: {image_path}（内容已隐藏以确保安全）")
-            return f"data:image/{img_type};base64,{encoded_data}"
+        with tracer.span("encode_image", image=image_path):
+            data_url = image_cache.get(upload_image_path(image_path), encode_image)
+        log.debug(f"已准备图片数据: {image_path}（内容已隐藏以确保安全）", image=image_path)
+        return data_url
     except Exception as e:
-        safe_print(f"准备图片数据时出错: {image_path} - {e}")
+        log.error(f"准备图片数据时出错: {image_path} - {e}", image=image_path)
         raise
 
-def process_task(task, task_idx, total_tasks):
-    """处理单个任务"""
-    # 生成任务ID
-    task_id = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{task_idx}"
+def stage(ctx, name):
+    """记录任务某一阶段的耗时（未开启追踪时不记录）"""
+    if not tracer.enabled:
+        return NULL_SPAN
+    return tracer.span(name, ctx.get("trace_track"), task=ctx["task_idx"], task_name=ctx["task_name"])
+
+def trace_request(ctx, data, request_start, headers_received=None):
+    """记录一次请求的上传、等待服务端和读取响应阶段，未收到响应时记录为 request_error"""
+    if not tracer.enabled:
+        return
+    now = time.monotonic()
+    track, args = ctx.get("trace_track"), {"task": ctx["task_idx"], "task_name": ctx["task_name"]}
+    if headers_received is None:
+        tracer.record("request_error", request_start, now, track, **args)
+        return
+    # 服务端在请求体发送完之前就返回时，上传阶段计到收到响应为止
+    sent = min(data.sent or headers_received, headers_received)
+    tracer.record("upload", request_start, sent, track, **args)
+    tracer.record("server_wait", sent, headers_received, track, **args)
+    tracer.record("response", headers_received, now, track, **args)
+
+def task_result(ctx, success):
+    """构建任务结果"""
+    return {"success": success, "task_id": ctx["task_id"], "task_name": ctx["task_name"],
+            "task_idx": ctx["task_idx"], "task_key": ctx["task_key"]}
+
+def build_request_body(model, prompt, images):
+    """构建请求体：默认为序列化后的JSON；开启STREAMING_BODY时为流式请求体，发送时才按块读取和编码图片"""
+    if STREAMING_BODY:
+        paths = [upload_image_path(img) for img in images]
+        return StreamingChatBody(model, prompt, [(path, image_mime(path)) for path in paths], stream=STREAM_RESPONSE)
+    
+    # 构建消息内容
+    message_content = [{"type": "text", "text": prompt}]
+    
+    # 添加图片到消息内容
+    for image_path in images:
+        image_data = prepare_image_data(image_path)
+        message_content.append({
+            "type": "image_url",
+            "image_url": {"url": image_data}
+        })
+    
+    data = {
+        "model": model,
+        "stream": STREAM_RESPONSE, 
+        "messages": [
+            {
+                "role": "user",
+                "content": message_content
+            }
+        ],
+    }
+    return json.dumps(data).encode("utf-8")
+
+def prepare_task(job, total_tasks):
+    """准备任务：创建输出目录、保存任务信息并构建请求数据，失败时请求数据为None"""
+    task, task_idx = job["task"], job["idx"]
+    
+    # 生成任务ID (续跑时沿用原任务ID)
+    task_id = job["task_id"] or f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{task_idx}"
+    journal.record(job["key"], START, task_id)
     
     # 获取任务参数
     task_name = task.get("name", f"任务_{task_id}")
@@ -112,6 +252,15 @@ def process_task(task, task_idx, total_tasks):
     task_output_dir = os.path.join(OUTPUT_DIR, f"{task_id}_{task_name}")
     os.makedirs(task_output_dir, exist_ok=True)
     
+    ctx = {
+        "task_id": task_id,
+        "task_key": job["key"],
+        "task_name": task_name,
+        "task_idx": task_idx,
+        "task_output_dir": task_output_dir,
+        "downloads": [],  # 响应成功后要等待的下载（流式响应模式下包括接收响应时已开始的下载）
+    }
+    
     # 保存任务信息
     with open(os.path.join(task_output_dir, "task_info.json"), "w", encoding="utf-8") as f:
         json.dump({
@@ -125,130 +274,446 @@ def process_task(task, task_idx, total_tasks):
     
     # 验证图片数量
     if len(images) > 10:
-        safe_print(f"错误：任务 {task_name} (ID: {task_id}) 的图片数量不能超过10张")
-        return {"success": False, "task_id": task_id, "task_name": task_name, "task_idx": task_idx}
+        task_log(ctx, "error", "图片数量不能超过10张", images=len(images))
+        return ctx, None
     
     # 添加调试信息
-    safe_print(f"\n[{task_idx}/{total_tasks}] 处理任务: {task_name} (ID: {task_id})")
-    safe_print(f"使用的模型: {model}")
-    safe_print(f"图片数量: {len(images)}")
+    position = f"{task_idx}/{total_tasks}" if total_tasks is not None else f"{task_idx}"
+    task_log(ctx, "info", f"[{position}] 开始处理，模型: {model}，图片数量: {len(images)}", model=model, images=len(images))
     for i, img in enumerate(images, 1):
-        safe_print(f"图片 {i} 路径: {img}")
+        task_log(ctx, "debug", f"图片 {i} 路径: {img}", image=img)
     
-    # 构建消息内容
-    message_content = [{"type": "text", "text": prompt}]
+    # 查询结果缓存，命中时直接复用此前的响应和图片，不再请求API
+    ctx["cache_key"] = result_cache.key(model, prompt, [resolve_image_path(img) for img in images])
+    if result_cache.restore(ctx["cache_key"], task_output_dir):
+        task_log(ctx, "info", "命中结果缓存，已复用此前的结果")
+        ctx["cached"] = True
+        return ctx, None
     
-    # 添加图片到消息内容
-    for image_path in images:
-        try:
-            image_data = prepare_image_data(image_path)
-            message_content.append({
-                "type": "image_url",
-                "image_url": {"url": image_data}
-            })
-        except Exception as e:
-            safe_print(f"处理图片时出错: {image_path} - {e}")
-            return {"success": False, "task_id": task_id, "task_name": task_name, "task_idx": task_idx}
-    
-    data = {
-        "model": model,
-        "stream": False, 
-        "messages": [
-            {
-                "role": "user",
-                "content": message_content
-            }
-        ],
-    }
+    # 构建请求体
+    try:
+        body = build_request_body(model, prompt, images)
+    except Exception as e:
+        task_log(ctx, "error", f"处理图片时出错: {e}")
+        return ctx, None
     
     # 添加调试信息
-    safe_print(f"任务 {task_name} (ID: {task_id}) 请求数据已准备好（图片内容已隐藏）。")
+    task_log(ctx, "debug", "请求数据已准备好（图片内容已隐藏）。")
+    return ctx, body
+
+def save_text(path, text):
+    """保存文本文件"""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+def parse_response(ctx, status_code, response_text):
+    """校验API响应，成功时返回解析后的JSON，否则返回None"""
+    if status_code != 200:
+        # 完整的响应已保存在 response.json 中，日志只记录开头部分
+        task_log(ctx, "error", f"API 错误: {status_code} - {response_text[:500]}", status=status_code)
+        return None
     
-    # 发送请求前等待令牌 (限流)
-    token_bucket.consume()
+    try:
+        result = json.loads(response_text)
+    except Exception as e:
+        task_log(ctx, "error", f"解析响应 JSON 时出错: {e}")
+        return None
+    
+    if "error" in result:
+        task_log(ctx, "error", f"API 错误: {result['error']['message']}")
+        return None
     
-    # 发送请求
-    headers = {
-        "Authorization": f"Bearer {API_TOKEN}",
+    return result
+
+def extract_text_content(result):
+    """提取所有choice的文本内容，格式错误时返回None"""
+    if "choices" not in result or not isinstance(result["choices"], list):
+        return None
+    
+    text_content = ""
+    for choice in result["choices"]:
+        if "message" in choice and "content" in choice["message"]:
+            text_content += choice["message"]["content"] + "\n\n"
+    return text_content
+
+def download_path(ctx, result_id, choice_index, idx, image_url):
+    """图片保存路径：响应ID-choice序号-链接序号.扩展名"""
+    ext = "png"
+    m = re.search(r"\.([a-zA-Z0-9]+)(?:\?|$)", image_url)
+    if m:
+        ext = m.group(1).split("?")[0]
+        if len(ext) > 5:
+            ext = "png"
+    return os.path.join(ctx["task_output_dir"], f"{result_id}-{choice_index}-{idx}.{ext}")
+
+def extract_download_links(ctx, result):
+    """提取content字段中的图片下载链接，返回(图片地址, 保存路径)列表"""
+    links = []
+    for choice in result["choices"]:
+        if "message" in choice and "content" in choice["message"]:
+            content = choice["message"]["content"]
+            task_log(ctx, "debug", f"正在处理内容: {content[:100]}...")  # 只显示内容的前100个字符
+
+            for idx, image_url in enumerate(DOWNLOAD_LINK_PATTERN.findall(content)):
+                links.append((image_url, download_path(ctx, result.get('id', 'noid'), choice.get('index', idx), idx, image_url)))
+    return links
+
+def fetch_image(url, output_path, session):
+    """下载图片到文件，记录下载耗时和字节数"""
+    start = time.monotonic()
+    size = fetch_to_file(url, output_path, session)
+    metrics.observe("gpt4o_download_duration_seconds", time.monotonic() - start)
+    metrics.inc("gpt4o_download_bytes_total", size)
+    return size
+
+def download_image(ctx, image_url, output_path):
+    """在下载线程中下载图片并保存，返回是否成功"""
+    try:
+        task_log(ctx, "debug", f"正在下载图片: {image_url}", url=image_url)
+        session = get_session(MAX_WORKERS + DOWNLOAD_WORKERS)
+        with tracer.span("download", task=ctx["task_idx"], url=image_url):
+            source = download_registry.fetch(image_url, output_path, lambda url, path: fetch_image(url, path, session))
+        if source is None:
+            task_log(ctx, "info", f"图片已保存到: {output_path}", url=image_url, path=output_path)
+        else:
+            task_log(ctx, "info", f"图片与已下载的 {source} 相同，已链接到: {output_path}", url=image_url, path=output_path)
+        metrics.inc("gpt4o_downloads_total", result="success")
+        return True
+    except Exception as e:
+        metrics.inc("gpt4o_downloads_total", result="failure")
+        task_log(ctx, "error", f"无法下载图片数据: {image_url} - {e}", url=image_url)
+        return False
+
+def finish_downloads(ctx, downloaded):
+    """任务的所有图片下载结束后：至少有一张图片且所有图片均已下载时写入结果缓存，返回任务结果"""
+    download_count = sum(downloaded)
+    if download_count == 0:
+        task_log(ctx, "warning", "未成功下载任何图片。")
+    if downloaded and all(downloaded):
+        result_cache.store(ctx["cache_key"], ctx["task_output_dir"])
+    task_log(ctx, "info", "处理完成", downloaded=download_count)
+    return task_result(ctx, True)
+
+def drop_downloads(ctx, downloads):
+    """放弃失败的响应中已提交的下载：尚未开始的取消，已开始的不再等待"""
+    if not downloads:
+        return
+    cancelled = sum(future.cancel() for future in downloads)
+    task_log(ctx, "debug", f"响应未成功，放弃其中的 {len(downloads)} 个下载（{cancelled} 个尚未开始，已取消）")
+
+def hand_off_downloads(ctx, result, streamed):
+    """把图片链接交给下载阶段（按SSE解析的响应中链接出现时已提交），返回下载结束后得到任务结果的 Future"""
+    if not streamed:
+        for image_url, output_path in extract_download_links(ctx, result):
+            ctx["downloads"].append(download_stage.submit(download_image, ctx, image_url, output_path))
+    return when_all(ctx["downloads"], lambda downloaded: finish_downloads(ctx, downloaded))
+
+def is_event_stream(content_type):
+    """判断是否为SSE响应（服务端未按流式返回时按普通响应处理）"""
+    return STREAM_RESPONSE and (content_type or "").startswith("text/event-stream")
+
+def report_link(ctx, assembler, link):
+    """流式响应中检测到新链接，返回(图片地址, 保存路径)"""
+    choice_index, idx, image_url = link
+    task_log(ctx, "info", f"检测到图片链接，开始下载: {image_url}", url=image_url)
+    return image_url, download_path(ctx, assembler.id or "noid", choice_index, idx, image_url)
+
+def read_response(ctx, response, downloads):
+    """读取响应，返回(响应文本, 是否按SSE解析)；流式响应边接收边解析，图片链接出现时立即提交下载并加入 downloads"""
+    try:
+        if response.status_code != 200 or not is_event_stream(response.headers.get("Content-Type")):
+            return response.text, False
+        decoder, assembler = SSEDecoder(), ChatStreamAssembler()
+        for chunk in response.iter_content(chunk_size=None):
+            for data in decoder.feed(chunk):
+                for link in assembler.add(data):
+                    downloads.append(download_stage.submit(download_image, ctx, *report_link(ctx, assembler, link)))
+        return assembler.result_text(), True
+    finally:
+        response.close()
+
+async def read_response_async(ctx, response, downloads):
+    """read_response 的 asyncio 版本"""
+    if response.status != 200 or not is_event_stream(response.headers.get("Content-Type")):
+        return await response.text(), False
+    decoder, assembler = SSEDecoder(), ChatStreamAssembler()
+    async for chunk in response.content.iter_any():
+        for data in decoder.feed(chunk):
+            for link in assembler.add(data):
+                downloads.append(download_stage.submit(download_image, ctx, *report_link(ctx, assembler, link)))
+    return assembler.result_text(), True
+
+def request_headers(key=None):
+    """构建API请求头，使用密钥池时使用选中的密钥"""
+    return {
+        "Authorization": f"Bearer {key.token if key is not None else API_TOKEN}",
         "Content-Type": "application/json",
     }
+
+def acquire_key():
+    """等待限流令牌；使用密钥池时选择负载最低的可用密钥并返回，否则返回None"""
+    start = time.monotonic()
+    if token_pool is None:
+        token_bucket.acquire()
+        key = None
+    else:
+        key = token_pool.acquire()
+    record_limiter_wait(time.monotonic() - start)
+    return key
+
+async def acquire_key_async():
+    """acquire_key 的 asyncio 版本"""
+    start = time.monotonic()
+    if token_pool is None:
+        await token_bucket.acquire_async()
+        key = None
+    else:
+        key = await token_pool.acquire_async()
+    record_limiter_wait(time.monotonic() - start)
+    return key
+
+def record_limiter_wait(wait):
+    """记录等待限流令牌的时间，之后开始发送请求"""
+    metrics.set("gpt4o_rate_limiter_wait_seconds", wait)
+    metrics.inc("gpt4o_rate_limiter_wait_seconds_total", wait)
+    metrics.inc("gpt4o_requests_in_flight")
+
+def record_request(body, duration, category, status_code=None, response_text=None):
+    """记录一次API请求的指标"""
+    metrics.inc("gpt4o_requests_in_flight", -1)
+    metrics.inc("gpt4o_requests_total")
+    metrics.inc("gpt4o_upload_bytes_total", len(body))
+    metrics.observe("gpt4o_request_duration_seconds", duration)
+    cause = failure_cause(category, status_code, response_text)
+    if cause is not None:
+        metrics.inc("gpt4o_request_failures_total", cause=cause)
+
+def release_key(key, status_code=None, response_text=None):
+    """记录密钥的请求结果；返回密钥相关的错误分类（有其他密钥可以换用时），否则返回None"""
+    if key is None:
+        return None
+    category = request_outcome(status_code, response_text)
+    if token_pool.release(key, category):
+        log.warning(f"密钥 {key.name} 连续出现错误（{category}），暂停使用 {token_pool.cooldown:.0f} 秒",
+                    key=key.name, cause=category)
+    if category in KEY_ERRORS and len(token_pool.keys) > 1:
+        return category
+    return None
+
+def report_retry(ctx, category, delay, policy):
+    """输出重试信息"""
+    metrics.inc("gpt4o_retries_total", cause=category)
+    task_log(ctx, "warning", f"请求失败（{category}），{delay:.1f} 秒后进行第 {policy.attempt}/{policy.max_attempts} 次请求",
+             cause=category, delay=round(delay, 3), attempt=policy.attempt)
+
+def send_with_retry(ctx, body, gate):
+    """发送API请求，可重试的错误按退避策略重试，返回(状态码, 响应文本, 下载列表, 是否按SSE解析)，请求始终出错时返回None
+
+    下载列表为流式响应中已提交的下载；重试时放弃前一次响应中的下载，调用方在响应解析成功后才等待这些下载
+    """
+    policy = RetryPolicy(retry_budget)
     
-    try:
-        response = requests.post(API_URL, json=data, headers=headers, timeout=1200)
-        safe_print(f"任务 {task_name} (ID: {task_id}) 响应状态码: {response.status_code}")
+    while True:
+        # 等待并发名额，再等待令牌 (限流)
+        with stage(ctx, "concurrency_wait"):
+            started = gate.acquire()
+        with stage(ctx, "rate_limit_wait"):
+            key = acquire_key()
+        
+        request_start = time.monotonic()
+        retry_after = None
+        downloads = []  # 本次请求的流式响应中已提交的下载
+        # 追踪时请求体按块发送以记录上传结束的时间，并在收到响应头后返回以区分等待服务端和读取响应
+        data = TracedBody(body) if tracer.enabled else body
+        try:
+            response = get_session(MAX_WORKERS + DOWNLOAD_WORKERS).post(API_URL, data=data, headers=request_headers(key),
+                                                                        timeout=1200, stream=STREAM_RESPONSE or tracer.enabled)
+            headers_received = time.monotonic()
+            response_text, streamed = read_response(ctx, response, downloads)
+        except Exception as e:
+            trace_request(ctx, data, request_start)
+            category = classify_exception(e)
+            gate.release(started, OVERLOAD if category else ERROR, time.monotonic() - request_start)
+            record_request(body, time.monotonic() - request_start, category)
+            release_key(key)
+            task_log(ctx, "warning", f"发送请求时出错: {e}")
+            drop_downloads(ctx, downloads)
+            result = None
+        else:
+            trace_request(ctx, data, request_start, headers_received)
+            category = classify_response(response.status_code, response_text)
+            outcome = OVERLOAD if category else outcome_for_status(response.status_code)
+            gate.release(started, outcome, time.monotonic() - request_start)
+            record_request(body, time.monotonic() - request_start, category, response.status_code, response_text)
+            task_log(ctx, "info", f"响应状态码: {response.status_code}", status=response.status_code)
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            result = (response.status_code, response_text, downloads, streamed)
+            key_category = release_key(key, response.status_code, response_text)
+            if key_category:
+                # 密钥相关的错误换用其他密钥重试，不需要遵守该密钥的 Retry-After
+                category, retry_after = category or key_category, None
         
+        delay = policy.next_delay(category, retry_after)
+        if delay is None:
+            return result
+        drop_downloads(ctx, downloads)
+        report_retry(ctx, category, delay, policy)
+        with stage(ctx, "retry_wait"):
+            time.sleep(delay)
+
+async def send_with_retry_async(ctx, body, session, gate):
+    """send_with_retry 的 asyncio 版本"""
+    policy = RetryPolicy(retry_budget)
+    
+    while True:
+        # 等待并发名额，再等待令牌 (限流)
+        with stage(ctx, "concurrency_wait"):
+            started = await gate.acquire()
+        with stage(ctx, "rate_limit_wait"):
+            key = await acquire_key_async()
+        
+        request_start = time.monotonic()
+        retry_after = None
+        downloads = []  # 本次请求的流式响应中已提交的下载
+        traced = TracedBody(body) if tracer.enabled else None
+        try:
+            if isinstance(body, StreamingChatBody) or traced is not None:
+                # 异步迭代的请求体需要显式声明长度，否则会使用分块传输
+                data = (traced or body).aiter()
+                headers = dict(request_headers(key), **{"Content-Length": str(len(body))})
+            else:
+                data, headers = body, request_headers(key)
+            async with session.post(API_URL, data=data, headers=headers,
+                                    timeout=aiohttp.ClientTimeout(total=1200)) as response:
+                headers_received = time.monotonic()
+                status_code = response.status
+                response_text, streamed = await read_response_async(ctx, response, downloads)
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        except Exception as e:
+            trace_request(ctx, traced, request_start)
+            category = classify_exception(e)
+            await gate.release(started, OVERLOAD if category else ERROR, time.monotonic() - request_start)
+            record_request(body, time.monotonic() - request_start, category)
+            release_key(key)
+            task_log(ctx, "warning", f"发送请求时出错: {e}")
+            drop_downloads(ctx, downloads)
+            result = None
+        else:
+            trace_request(ctx, traced, request_start, headers_received)
+            category = classify_response(status_code, response_text)
+            outcome = OVERLOAD if category else outcome_for_status(status_code)
+            await gate.release(started, outcome, time.monotonic() - request_start)
+            record_request(body, time.monotonic() - request_start, category, status_code, response_text)
+            task_log(ctx, "info", f"响应状态码: {status_code}", status=status_code)
+            result = (status_code, response_text, downloads, streamed)
+            key_category = release_key(key, status_code, response_text)
+            if key_category:
+                # 密钥相关的错误换用其他密钥重试，不需要遵守该密钥的 Retry-After
+                category, retry_after = category or key_category, None
+        
+        delay = policy.next_delay(category, retry_after)
+        if delay is None:
+            return result
+        drop_downloads(ctx, downloads)
+        report_retry(ctx, category, delay, policy)
+        with stage(ctx, "retry_wait"):
+            await asyncio.sleep(delay)
+
+def process_task(job, total_tasks, gate):
+    """处理单个任务，返回任务结果；有图片需要下载时返回下载结束后得到任务结果的 Future"""
+    with tracer.span("prepare", task=job["idx"]):
+        ctx, body = prepare_task(job, total_tasks)
+    if body is None:
+        return task_result(ctx, ctx.get("cached", False))
+    
+    # 发送请求（可重试的错误按退避策略重试）
+    response = send_with_retry(ctx, body, gate)
+    if response is None:
+        return task_result(ctx, False)
+    status_code, response_text, downloads, streamed = response
+    
+    try:
         # 保存原始响应
-        with open(os.path.join(task_output_dir, "response.json"), "w", encoding="utf-8") as f:
-            f.write(response.text)
+        with stage(ctx, "write"):
+            save_text(os.path.join(ctx["task_output_dir"], "response.json"), response_text)
     except Exception as e:
-        safe_print(f"任务 {task_name} (ID: {task_id}) 发送请求时出错: {e}")
-        return {"success": False, "task_id": task_id, "task_name": task_name, "task_idx": task_idx}
+        task_log(ctx, "error", f"保存响应时出错: {e}")
+        drop_downloads(ctx, downloads)
+        return task_result(ctx, False)
     
     # 处理响应
-    if response.status_code != 200:
-        safe_print(f"任务 {task_name} (ID: {task_id}) API 错误: {response.status_code} - {response.text}")
-        return {"success": False, "task_id": task_id, "task_name": task_name, "task_idx": task_idx}
+    with stage(ctx, "parse"):
+        result = parse_response(ctx, status_code, response_text)
+    if result is None:
+        drop_downloads(ctx, downloads)
+        return task_result(ctx, False)
+    
+    # 保存文本响应
+    text_content = extract_text_content(result)
+    if text_content is None:
+        task_log(ctx, "error", "返回值格式错误。")
+        drop_downloads(ctx, downloads)
+    else:
+        with stage(ctx, "write"):
+            save_text(os.path.join(ctx["task_output_dir"], "response_text.md"), text_content)
+        
+        # 下载content字段中的图片（在下载阶段进行，不占用请求线程）
+        ctx["downloads"].extend(downloads)
+        return hand_off_downloads(ctx, result, streamed)
+    
+    task_log(ctx, "info", "处理完成")
+    return task_result(ctx, True)
+
+async def process_task_async(job, total_tasks, session, gate):
+    """异步处理单个任务：网络请求在事件循环中等待，图片编码和文件写入交给线程池，返回值同 process_task"""
+    loop = asyncio.get_running_loop()
+    track = tracer.task_track(job["idx"])
+    with tracer.span("prepare", track, task=job["idx"]):
+        ctx, body = await loop.run_in_executor(None, prepare_task, job, total_tasks)
+    ctx["trace_track"] = track
+    if body is None:
+        return task_result(ctx, ctx.get("cached", False))
+    
+    # 发送请求（可重试的错误按退避策略重试）
+    response = await send_with_retry_async(ctx, body, session, gate)
+    if response is None:
+        return task_result(ctx, False)
+    status_code, response_text, downloads, streamed = response
     
     try:
-        result = response.json()
+        # 保存原始响应
+        with stage(ctx, "write"):
+            await loop.run_in_executor(None, save_text, os.path.join(ctx["task_output_dir"], "response.json"), response_text)
     except Exception as e:
-        safe_print(f"任务 {task_name} (ID: {task_id}) 解析响应 JSON 时出错: {e}")
-        return {"success": False, "task_id": task_id, "task_name": task_name, "task_idx": task_idx}
+        task_log(ctx, "error", f"保存响应时出错: {e}")
+        drop_downloads(ctx, downloads)
+        return task_result(ctx, False)
     
-    if "error" in result:
-        safe_print(f"任务 {task_name} (ID: {task_id}) API 错误: {result['error']['message']}")
-        return {"success": False, "task_id": task_id, "task_name": task_name, "task_idx": task_idx}
+    # 处理响应
+    with stage(ctx, "parse"):
+        result = parse_response(ctx, status_code, response_text)
+    if result is None:
+        drop_downloads(ctx, downloads)
+        return task_result(ctx, False)
     
     # 保存文本响应
-    if "choices" in result and isinstance(result["choices"], list):
-        # 提取文本内容
-        text_content = ""
-        for choice in result["choices"]:
-            if "message" in choice and "content" in choice["message"]:
-                text_content += choice["message"]["content"] + "\n\n"
-                
-        # 保存文本内容
-        with open(os.path.join(task_output_dir, "response_text.md"), "w", encoding="utf-8") as f:
-            f.write(text_content)
-    
-    # 遍历result，提取content字段中的图片地址并保存
-    if "choices" in result and isinstance(result["choices"], list):
-        download_count = 0
-        for choice in result["choices"]:
-            if "message" in choice and "content" in choice["message"]:
-                content = choice["message"]["content"]
-                safe_print(f"任务 {task_name} (ID: {task_id}) 正在处理内容: {content[:100]}...")  # 只显示内容的前100个字符
-
-                # 只提取 [点击下载](http...) 这种格式的图片链接
-                download_links = re.findall(r'\[点击下载\]\((https?://[^\s\)]+)\)', content)
-                for idx, image_url in enumerate(download_links):
-                    try:
-                        safe_print(f"任务 {task_name} (ID: {task_id}) 正在下载图片: {image_url}")
-                        image_data = requests.get(image_url).content
-                        ext = "png"
-                        m = re.search(r"\.([a-zA-Z0-9]+)(?:\?|$)", image_url)
-                        if m:
-                            ext = m.group(1).split("?")[0]
-                            if len(ext) > 5:
-                                ext = "png"
-                        file_name = f"{result.get('id', 'noid')}-{choice.get('index', idx)}-{idx}.{ext}"
-                        output_path = os.path.join(task_output_dir, file_name)
-                        with open(output_path, "wb") as f:
-                            f.write(image_data)
-                        safe_print(f"任务 {task_name} (ID: {task_id}) 图片已保存到: {output_path}")
-                        download_count += 1
-                    except Exception as e:
-                        safe_print(f"任务 {task_name} (ID: {task_id}) 无法下载图片数据: {image_url} - {e}")
-        if download_count == 0:
-            safe_print(f"任务 {task_name} (ID: {task_id}) 未成功下载任何图片。")
+    text_content = extract_text_content(result)
+    if text_content is None:
+        task_log(ctx, "error", "返回值格式错误。")
+        drop_downloads(ctx, downloads)
     else:
-        safe_print(f"任务 {task_name} (ID: {task_id}) 返回值格式错误。")
+        with stage(ctx, "write"):
+            await loop.run_in_executor(None, save_text, os.path.join(ctx["task_output_dir"], "response_text.md"), text_content)
+        
+        # 下载content字段中的图片（在下载阶段进行，不占用请求并发名额）
+        ctx["downloads"].extend(downloads)
+        return hand_off_downloads(ctx, result, streamed)
     
-    safe_print(f"任务 {task_name} (ID: {task_id}) 处理完成")
-    return {"success": True, "task_id": task_id, "task_name": task_name, "task_idx": task_idx}
+    task_log(ctx, "info", "处理完成")
+    return task_result(ctx, True)
 
 def load_tasks():
-    """从tasks.json加载任务列表"""
+    """加载任务：tasks.json 整体读入，tasks.jsonl 在处理过程中逐行读取"""
     # 如果任务文件不存在，创建一个示例
     if not os.path.exists(TASKS_FILE):
         # 确保images目录存在
@@ -270,7 +735,11 @@ def load_tasks():
         ]
         
         with open(TASKS_FILE, "w", encoding="utf-8") as f:
-            json.dump(example_tasks, f, ensure_ascii=False, indent=2)
+            if is_jsonl(TASKS_FILE):
+                for task in example_tasks:
+                    f.write(json.dumps(task, ensure_ascii=False) + "\n")
+            else:
+                json.dump(example_tasks, f, ensure_ascii=False, indent=2)
             
         print(f"已创建示例任务文件: {TASKS_FILE}")
         print("请在执行批处理前编辑此文件！")
@@ -278,88 +747,538 @@ def load_tasks():
     
     # 加载任务
     try:
-        with open(TASKS_FILE, "r", encoding="utf-8") as f:
-            tasks = json.load(f)
-        print(f"已加载 {len(tasks)} 个任务")
+        tasks = TaskSource(TASKS_FILE)
+        if tasks.total is None:
+            print(f"将逐行读取任务文件: {TASKS_FILE}")
+        else:
+            print(f"已加载 {tasks.total} 个任务")
         return tasks
     except Exception as e:
         print(f"加载任务文件失败: {e}")
         exit(1)
 
-def main():
-    """主函数，处理批量任务"""
-    print("=== GPT-4o 并发批量处理工具 ===")
+def print_progress(completed, success_count, failed_count, total_tasks, start_time):
+    """输出进度信息和预估剩余时间（任务总数未知时只输出已完成数量）"""
+    if progress_queue is not None:
+        # 工作进程只汇报本进程的计数和指标，由主进程合并后输出
+        progress_queue.put(("progress", os.getpid(), (success_count, failed_count, metrics.snapshot())))
+        return
+    elapsed = time.time() - start_time
+    count, p50, p95, p99 = latency_summary(metrics_snapshot(), "gpt4o_request_duration_seconds")
+    latency = f"请求耗时: p50 {p50:.1f} 秒, p95 {p95:.1f} 秒, p99 {p99:.1f} 秒" if count else None
     
-    # 加载任务
-    tasks = load_tasks()
-    
-    # 任务总数
-    total_tasks = len(tasks)
-    print(f"总共 {total_tasks} 个任务，将使用最多 {min(MAX_WORKERS, total_tasks)} 个并发线程")
+    if completed > 0 and total_tasks is None:
+        lines = [f"\n进度: 已完成 {completed} 个任务"]
+    elif completed > 0:
+        lines = [f"\n进度: {completed}/{total_tasks} ({completed/total_tasks*100:.1f}%)"]
+    else:
+        return
+    lines.append(f"已完成: {success_count} 成功, {failed_count} 失败")
+    lines.append(f"平均每任务耗时: {elapsed / completed:.1f} 秒")
+    if latency:
+        lines.append(latency)
+    if total_tasks is not None:
+        # 格式化剩余时间
+        m, s = divmod(int(elapsed / completed * (total_tasks - completed)), 60)
+        h, m = divmod(m, 60)
+        lines.append(f"预计剩余时间: {h:d}小时 {m:02d}分 {s:02d}秒")
     
-    # 结果统计
-    results = []
+    # 输出进度信息（与日志按顺序输出，不受控制台速率限制）
+    log.echo("\n".join(lines))
+    log.record("进度", completed=completed, success=success_count, failed=failed_count, total=total_tasks,
+               elapsed=round(elapsed, 3), p50=p50, p95=p95, p99=p99)
+
+def metrics_snapshot():
+    """本进程和各工作进程的指标合并后的快照"""
+    return merge_snapshots([metrics.snapshot(), *worker_metrics.copy().values()])
+
+def start_metrics(port, announce=True):
+    """启动指标 HTTP 服务（端口为0或已启动时不启动）"""
+    global metrics_server
+    if port <= 0 or metrics_server is not None:
+        return
+    try:
+        metrics_server = start_metrics_server(metrics_snapshot, port)
+    except OSError as e:
+        print(f"警告：无法启动指标服务（端口 {port}）: {e}")
+        return
+    if announce:
+        host, port = metrics_server.server_address[:2]
+        print(f"指标服务: http://{host}:{port}/metrics（JSON: /metrics.json）")
+
+def stop_metrics():
+    """停止指标 HTTP 服务，返回此前是否在运行"""
+    global metrics_server
+    if metrics_server is None:
+        return False
+    metrics_server.shutdown()
+    metrics_server.server_close()
+    metrics_server = None
+    return True
+
+def worker_count(limit, total_jobs):
+    """并发数不超过待处理任务数，任务数未知时按上限"""
+    return limit if total_jobs is None else min(limit, total_jobs)
+
+def in_flight_window(max_limit):
+    """提交窗口：已提交但未完成的任务数上限，完成一个再从任务来源读取并提交下一个"""
+    if MAX_IN_FLIGHT > 0:
+        return MAX_IN_FLIGHT
+    return max_limit * 2 + DOWNLOAD_WORKERS
+
+def concurrency_bounds(initial):
+    """计算并发闸门的(初始值, 下限, 上限)，未开启自适应时固定为初始值"""
+    if not ADAPTIVE_CONCURRENCY:
+        return initial, initial, initial
+    ceiling = CONCURRENCY_MAX or initial * 2
+    return min(initial, ceiling), min(CONCURRENCY_MIN, ceiling), ceiling
+
+def report_limit_change(old_limit, new_limit, outcome):
+    """输出并发上限调整信息"""
+    if new_limit < old_limit:
+        log.warning(f"检测到上游压力（{outcome}），并发上限下调: {old_limit} -> {new_limit}", limit=new_limit)
+    else:
+        log.info(f"上游状态良好，并发上限上调: {old_limit} -> {new_limit}", limit=new_limit)
+
+def finish_job(job, result):
+    """将任务结果写入任务日志（从任务队列领取的任务同时写入队列），返回是否成功"""
+    success = result["success"]
+    metrics.inc("gpt4o_tasks_total", result="success" if success else "failure")
+    journal.record(job["key"], SUCCESS if success else FAILURE, result["task_id"])
+    if "queue_id" in job:
+        task_queue.complete(job, success)
+    return success
+
+def fail_job(job, error):
+    """记录处理过程中发生异常的任务"""
+    log.error(f"任务 {job['idx']} 发生异常: {error}", task=job["idx"], task_id=job["task_id"])
+    metrics.inc("gpt4o_tasks_total", result="failure")
+    journal.record(job["key"], FAILURE, job["task_id"], error=str(error))
+    if "queue_id" in job:
+        task_queue.complete(job, False, str(error))
+
+def run_threaded(jobs, total_tasks, total_jobs, start_time):
+    """使用线程池执行任务，返回(成功数, 失败数)；total_tasks、total_jobs 未知时为None"""
     success_count = 0
     failed_count = 0
     
-    # 创建进度统计信息
-    start_time = time.time()
+    initial, min_limit, max_limit = concurrency_bounds(MAX_WORKERS)
+    gate = AdaptiveConcurrency(initial, min_limit, max_limit,
+                               latency_tolerance=CONCURRENCY_LATENCY_TOLERANCE,
+                               on_change=report_limit_change)
+    if shared_slots is not None:
+        gate = SharedConcurrency(gate, shared_slots)
     
-    # 使用线程池执行任务
-    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, total_tasks)) as executor:
-        # 提交所有任务
-        future_to_task = {executor.submit(process_task, task, idx + 1, total_tasks): (idx + 1, task) 
-                         for idx, task in enumerate(tasks)}
+    jobs = iter(jobs)
+    window = in_flight_window(max_limit)
+    
+    # 线程数按并发上限创建，实际同时发出的请求数由并发闸门控制
+    with ThreadPoolExecutor(max_workers=worker_count(max_limit, total_jobs)) as executor:
+        pending = {}
+        
+        def fill():
+            """按需从任务来源读取任务，保持已提交未完成的任务数不超过提交窗口"""
+            while len(pending) < window:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                pending[executor.submit(process_task, job, total_tasks, gate)] = job
+            metrics.set("gpt4o_tasks_in_flight", len(pending))
+        
+        fill()
         
-        # 处理完成的任务
-        for future in as_completed(future_to_task):
-            idx, task = future_to_task[future]
-            try:
-                result = future.result()
-                results.append(result)
-                
-                if result["success"]:
+        # 处理完成的任务，每完成一个补充提交新任务
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                try:
+                    result = future.result()
+                    if isinstance(result, Future):
+                        # 请求已完成，图片仍在下载阶段，下载结束后再统计
+                        pending[result] = job
+                        continue
+                    if finish_job(job, result):
+                        success_count += 1
+                    else:
+                        failed_count += 1
+                        
+                    print_progress(success_count + failed_count, success_count, failed_count, total_jobs, start_time)
+                            
+                except Exception as e:
+                    fail_job(job, e)
+                    failed_count += 1
+            fill()
+    
+    return success_count, failed_count
+
+async def run_asyncio(jobs, total_tasks, total_jobs, start_time):
+    """使用asyncio事件循环执行任务，返回(成功数, 失败数)；total_tasks、total_jobs 未知时为None"""
+    success_count = 0
+    failed_count = 0
+    initial, min_limit, max_limit = concurrency_bounds(ASYNC_CONCURRENCY)
+    gate = AsyncAdaptiveConcurrency(initial, min_limit, max_limit,
+                                    latency_tolerance=CONCURRENCY_LATENCY_TOLERANCE,
+                                    on_change=report_limit_change)
+    if shared_slots is not None:
+        gate = AsyncSharedConcurrency(gate, shared_slots)
+    concurrency = worker_count(max_limit, total_jobs)
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def run_one(job):
+        try:
+            async with semaphore:
+                result = await process_task_async(job, total_tasks, session, gate)
+            if isinstance(result, Future):
+                # 请求名额已释放，等待下载阶段结束
+                result = await asyncio.wrap_future(result)
+            return job, result, None
+        except Exception as e:
+            return job, None, e
+    
+    jobs = iter(jobs)
+    window = in_flight_window(max_limit)
+    pending = set()
+    loop = asyncio.get_running_loop()
+    
+    async def fill():
+        """按需从任务来源读取任务，保持已提交未完成的任务数不超过提交窗口
+
+        读取文件或从多进程任务队列获取任务可能阻塞，在线程池中执行
+        """
+        while len(pending) < window:
+            job = await loop.run_in_executor(None, next, jobs, None)
+            if job is None:
+                break
+            pending.add(asyncio.ensure_future(run_one(job)))
+        metrics.set("gpt4o_tasks_in_flight", len(pending))
+    
+    async with create_async_session(concurrency) as session:
+        await fill()
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                job, result, error = future.result()
+                if error is None and finish_job(job, result):
                     success_count += 1
+                elif error is None:
+                    failed_count += 1
                 else:
+                    fail_job(job, error)
                     failed_count += 1
                     
-                # 计算进度和预估剩余时间
-                completed = success_count + failed_count
-                elapsed = time.time() - start_time
-                
-                if completed > 0:
-                    avg_time_per_task = elapsed / completed
-                    remaining_tasks = total_tasks - completed
-                    estimated_remaining = avg_time_per_task * remaining_tasks
-                    
-                    # 格式化剩余时间
-                    m, s = divmod(int(estimated_remaining), 60)
-                    h, m = divmod(m, 60)
-                    
-                    # 输出进度信息
-                    with print_lock:
-                        print(f"\n进度: {completed}/{total_tasks} ({completed/total_tasks*100:.1f}%)")
-                        print(f"已完成: {success_count} 成功, {failed_count} 失败")
-                        print(f"平均每任务耗时: {avg_time_per_task:.1f} 秒")
-                        print(f"预计剩余时间: {h:d}小时 {m:02d}分 {s:02d}秒")
-                        
-            except Exception as e:
-                with print_lock:
-                    print(f"任务 {idx} 发生异常: {e}")
-                failed_count += 1
+                print_progress(success_count + failed_count, success_count, failed_count, total_jobs, start_time)
+            await fill()
+    
+    return success_count, failed_count
+
+def collect_stats(success_count, failed_count):
+    """汇总本进程的统计信息"""
+    hits, misses, _, _ = image_cache.stats()
+    fetched, linked = download_registry.stats()
+    return {"success": success_count, "failed": failed_count, "cache_hits": result_cache.hits,
+            "image_hits": hits, "image_misses": misses, "fetched": fetched, "linked": linked,
+            "keys": token_pool.stats() if token_pool is not None else {}}
+
+def add_stats(total, stats):
+    """将 stats 中的各项计数累加到 total（按密钥的统计逐项累加）"""
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            add_stats(total.setdefault(name, {}), value)
+        else:
+            total[name] = total.get(name, 0) + value
+    return total
+
+def stats_delta(after, before):
+    """两次统计之间的差值"""
+    return {name: stats_delta(value, before.get(name, {})) if isinstance(value, dict) else value - before.get(name, 0)
+            for name, value in after.items()}
+
+def run_engine(engine, jobs, total_tasks, total_jobs, start_time):
+    """使用指定引擎执行任务，结束后关闭下载阶段等资源，返回本次执行的统计信息"""
+    before = collect_stats(0, 0)
+    if engine == "asyncio":
+        success_count, failed_count = asyncio.run(run_asyncio(jobs, total_tasks, total_jobs, start_time))
+    else:
+        try:
+            success_count, failed_count = run_threaded(jobs, total_tasks, total_jobs, start_time)
+        finally:
+            close_session()
+    download_stage.shutdown()
+    preprocessor.shutdown()
+    journal.close()
+    log.flush()  # 工作进程退出时不会等待后台线程，结束前写出全部日志
+    return stats_delta(collect_stats(success_count, failed_count), before)
+
+def worker_main(engine, total_tasks, job_queue, event_queue, limiter, pool, slots, window, queue_store, settings):
+    """工作进程入口：从任务队列获取任务并用单进程模式相同的引擎执行，结束后把统计信息发送给主进程
+
+    settings 为主进程根据命令行参数得到的设置（是否追踪耗时、是否使用结果缓存），
+    显式传入而不依赖 fork 复制的全局变量，工作进程以 spawn 方式启动时同样生效
+    """
+    global token_bucket, token_pool, shared_slots, progress_queue, MAX_IN_FLIGHT, task_queue
+    token_bucket, token_pool, shared_slots, progress_queue = limiter, pool, slots, event_queue
+    MAX_IN_FLIGHT = window
+    task_queue = queue_store
+    tracer.enabled = settings["trace"]
+    result_cache.enabled = settings["cache"]
+    stats = run_engine(engine, iter(job_queue.get, None), total_tasks, None, time.time())
+    event_queue.put(("metrics", os.getpid(), metrics.snapshot()))
+    if tracer.enabled:
+        event_queue.put(("trace", os.getpid(), tracer.export()))
+    event_queue.put(("stats", os.getpid(), stats))
+
+def run_processes(processes, engine, jobs, total_tasks, total_jobs, start_time, metrics_port=0):
+    """多进程模式：主进程读取任务并通过队列分发给工作进程，合并各进程的进度，返回合计的统计信息
+
+    工作进程共用主进程创建的共享令牌桶和跨进程并发名额，总请求速率和并发数与单进程模式的配置相同；
+    指标服务和日志的后台线程在创建工作进程之后才启动，子进程不会复制到这些线程持有的锁
+    """
+    max_limit = worker_count(concurrency_bounds(ASYNC_CONCURRENCY if engine == "asyncio" else MAX_WORKERS)[2], total_jobs)
+    limiter = create_rate_limiter(API_RATE_LIMIT, API_BURST, API_RPM, shared=True)
+    pool = create_token_pool(API_TOKENS, API_RATE_LIMIT, API_BURST, API_RPM, shared=True)
+    slots = multiprocessing.BoundedSemaphore(max_limit)
+    window = in_flight_window(max_limit)
+    # 任务队列有界，主进程只比工作进程多读取一个提交窗口的任务
+    job_queue = multiprocessing.Queue(maxsize=window)
+    event_queue = multiprocessing.Queue()
+    
+    # 提交窗口按进程平分，避免先启动的进程取走大部分任务
+    worker_window = -(-window // processes)
+    settings = {"trace": tracer.enabled, "cache": result_cache.enabled}
+    workers = [multiprocessing.Process(target=worker_main, name=f"worker-{i + 1}",
+                                       args=(engine, total_tasks, job_queue, event_queue, limiter, pool, slots,
+                                             worker_window, task_queue, settings))
+               for i in range(processes)]
+    # 创建工作进程前停止后台线程（任务队列模式下可能已是第二轮），创建之后再启动
+    restarted = stop_metrics()
+    log.stop()
+    for worker in workers:
+        worker.start()
+    start_metrics(metrics_port, announce=not restarted)
+    
+    def feed():
+        for job in jobs:
+            job_queue.put(job)
+        for _ in workers:
+            job_queue.put(None)
+    
+    # 在启动工作进程之后再启动读取任务的线程
+    threading.Thread(target=feed, name="feeder", daemon=True).start()
+    
+    progress = {}  # 进程ID -> (成功数, 失败数)
+    results = {}  # 进程ID -> 统计信息
+    while len(results) < len(workers):
+        try:
+            kind, pid, payload = event_queue.get(timeout=1)
+        except queue.Empty:
+            if any(worker.is_alive() for worker in workers) or not event_queue.empty():
+                continue
+            break  # 所有工作进程都已退出，部分进程没有发送统计信息
+        if kind == "progress":
+            success_count, failed_count, worker_metrics[pid] = payload
+            progress[pid] = (success_count, failed_count)
+            success_count = sum(s for s, _ in progress.values())
+            failed_count = sum(f for _, f in progress.values())
+            print_progress(success_count + failed_count, success_count, failed_count, total_jobs, start_time)
+        elif kind == "metrics":
+            worker_metrics[pid] = payload
+        elif kind == "trace":
+            worker_traces.extend(payload)
+        else:
+            results[pid] = payload
+    
+    for worker in workers:
+        worker.join()
+        if worker.exitcode != 0:
+            log.warning(f"警告：工作进程 {worker.name} 异常退出（退出码 {worker.exitcode}），其未完成的任务可使用 --resume 续跑",
+                        worker=worker.name, exitcode=worker.exitcode)
+    
+    stats = {name: {} if isinstance(value, dict) else 0 for name, value in collect_stats(0, 0).items()}
+    for worker_stats in results.values():
+        add_stats(stats, worker_stats)
+    log.flush()
+    return stats
+
+def run_jobs(args, jobs, total_tasks, total_jobs, start_time):
+    """按命令行参数在当前进程或多个工作进程中执行任务，返回统计信息"""
+    if args.processes > 1:
+        return run_processes(args.processes, args.engine, jobs, total_tasks, total_jobs, start_time, args.metrics_port)
+    return run_engine(args.engine, jobs, total_tasks, total_jobs, start_time)
+
+def run_queue(args, start_time):
+    """从任务队列领取任务直到队列中的任务全部结束，返回统计信息
+
+    没有可领取的任务但其他工作进程仍在处理时继续等待，其租约过期（如进程崩溃）后接手这些任务
+    """
+    heartbeat = task_queue.start_heartbeat()
+    try:
+        stats = run_jobs(args, task_queue.jobs(), None, None, start_time)
+        while True:
+            released = task_queue.release()
+            if released:
+                log.warning(f"有 {released} 个已领取的任务未记录结果，已放回任务队列")
+            counts = task_queue.counts()
+            if counts["running"]:
+                log.info(f"其他工作进程正在处理 {counts['running']} 个任务，等待其完成或租约过期...")
+            if not task_queue.wait_for_work():
+                return stats
+            log.info("任务队列中有新的可领取任务，继续处理")
+            add_stats(stats, run_jobs(args, task_queue.jobs(), None, None, start_time))
+    finally:
+        heartbeat.set()
+
+def main():
+    """主函数，处理批量任务"""
+    parser = argparse.ArgumentParser(description="GPT-4o 并发批量处理工具")
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default=ENGINE,
+                        help="执行引擎：thread（线程池）或 asyncio（单事件循环），默认读取ENGINE环境变量")
+    parser.add_argument("--resume", action="store_true",
+                        help="根据任务日志续跑：跳过已成功的任务，只重新执行未完成或失败的任务")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="不使用结果缓存，所有任务都重新请求API")
+    parser.add_argument("--processes", type=int, default=PROCESSES,
+                        help="工作进程数，大于1时由多个进程共同处理任务，默认读取PROCESSES环境变量")
+    parser.add_argument("--queue", default=TASK_QUEUE,
+                        help="SQLite 任务队列文件：从队列领取任务，多台机器可共用同一个队列，默认读取TASK_QUEUE环境变量")
+    parser.add_argument("--enqueue", action="store_true",
+                        help="将任务文件中的任务导入 --queue 指定的任务队列后退出")
+    parser.add_argument("--requeue-failed", action="store_true",
+                        help="处理前将任务队列中失败的任务重新排队")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="指标 HTTP 服务端口（Prometheus 格式 /metrics，JSON 格式 /metrics.json），默认读取METRICS_PORT环境变量")
+    parser.add_argument("--trace", default=TRACE_FILE,
+                        help="记录各阶段耗时并保存为 Chrome trace-event JSON 文件，默认读取TRACE_FILE环境变量")
+    args = parser.parse_args()
+    if args.no_cache:
+        result_cache.enabled = False
+    tracer.enabled = bool(args.trace)
+    if (args.enqueue or args.requeue_failed) and not args.queue:
+        parser.error("--enqueue 和 --requeue-failed 需要同时指定 --queue")
+    
+    print("=== GPT-4o 并发批量处理工具 ===")
+    if preprocessor.unavailable:
+        print("警告：图片预处理需要安装 Pillow（pip install pillow），本次将上传原图")
+    if not args.enqueue and args.processes <= 1:
+        start_metrics(args.metrics_port)  # 多进程模式下在创建工作进程之后启动
+    
+    if args.queue:
+        run_queue_mode(args)
+        return
+    
+    # 加载任务 (tasks.jsonl 在处理过程中逐行读取)
+    tasks = load_tasks()
+    
+    # 生成任务键，续跑时跳过已完成的任务
+    planner = JobPlanner(journal, args.resume)
+    jobs = planner.jobs(tasks)
+    total_jobs = None  # 待处理任务数，逐行读取时未知
+    if tasks.total is not None:
+        # tasks.json 已整体读入，提前生成全部任务以便显示进度
+        jobs = list(jobs)
+        total_jobs = len(jobs)
+        if args.resume:
+            print(f"续跑模式：跳过 {planner.skipped} 个已完成的任务，剩余 {total_jobs} 个任务")
+        if not jobs:
+            print("没有需要处理的任务")
+            return
+    elif args.resume:
+        print("续跑模式：将跳过任务日志中已成功的任务")
+    # 按优先级和截止时间调度，已整体读入的任务全部参与排序
+    scheduler = JobScheduler(jobs, 0 if total_jobs is not None else SCHEDULE_LOOKAHEAD)
+    summary = f"总共 {total_jobs} 个任务" if total_jobs is not None else "逐行读取任务"
+    
+    # 清理过期和超出容量的结果缓存
+    result_cache.evict()
+    
+    # 创建进度统计信息
+    start_time = time.time()
+    print_start(args, summary, total_jobs)
+    stats = run_jobs(args, scheduler, tasks.total, total_jobs, start_time)
     
+    # 输出结果统计
+    print("\n=== 批量处理完成 ===")
+    print(f"总任务数: {planner.count}")
+    if planner.skipped:
+        print(f"跳过任务: {planner.skipped}（此前已完成）")
+    if tasks.invalid_lines:
+        print(f"无法解析的任务行: {len(tasks.invalid_lines)}（行号: {', '.join(map(str, tasks.invalid_lines[:10]))}）")
+    if scheduler.late:
+        print(f"开始时已超过截止时间的任务: {scheduler.late}")
+    print_summary(stats, start_time)
+    finish_trace(args.trace)
+
+def run_queue_mode(args):
+    """任务队列模式：导入任务，或从队列领取任务并处理"""
+    global task_queue
+    task_queue = TaskQueue(args.queue)
+    if args.enqueue:
+        tasks = load_tasks()
+        added, skipped = task_queue.add(tasks)
+        print(f"已将 {added} 个任务加入任务队列: {args.queue}")
+        if skipped:
+            print(f"跳过 {skipped} 个已在队列中的任务")
+        if tasks.invalid_lines:
+            print(f"无法解析的任务行: {len(tasks.invalid_lines)}（行号: {', '.join(map(str, tasks.invalid_lines[:10]))}）")
+        return
+    if args.requeue_failed:
+        print(f"已将 {task_queue.requeue_failed()} 个失败的任务重新排队")
+    
+    result_cache.evict()
+    start_time = time.time()
+    print_start(args, f"从任务队列 {args.queue} 领取任务（工作进程: {task_queue.worker}）", None)
+    stats = run_queue(args, start_time)
+    
+    counts = task_queue.counts()
+    print("\n=== 批量处理完成 ===")
+    print(f"任务队列: 共 {sum(counts.values())} 个任务，成功 {counts['success']}，失败 {counts['failure']}，"
+          f"等待 {counts['queued']}，处理中 {counts['running']}")
+    print_summary(stats, start_time)
+    finish_trace(args.trace)
+
+def print_start(args, summary, total_jobs):
+    """输出执行方式（引擎、并发数和进程数）"""
+    if args.engine == "asyncio":
+        if aiohttp is None:
+            print("错误：asyncio 引擎需要安装 aiohttp（pip install aiohttp）")
+            exit(1)
+        print(f"{summary}，将使用 asyncio 引擎，最多 {worker_count(concurrency_bounds(ASYNC_CONCURRENCY)[2], total_jobs)} 个并发请求")
+    else:
+        print(f"{summary}，将使用最多 {worker_count(concurrency_bounds(MAX_WORKERS)[2], total_jobs)} 个并发线程")
+    if args.processes > 1:
+        print(f"多进程模式：{args.processes} 个工作进程共用上述并发上限和请求速率限制")
+
+def finish_trace(path):
+    """保存阶段耗时追踪并输出各阶段的耗时汇总（未开启追踪时不输出）"""
+    if not tracer.enabled:
+        return
+    events = tracer.export() + worker_traces
+    write_trace(path, events)
+    print("\n=== 各阶段耗时 ===")
+    for line in summary_lines(events):
+        print(line)
+    print(f"阶段耗时追踪已保存到: {path}（可在 https://ui.perfetto.dev 或 chrome://tracing 中打开）")
+
+def print_summary(stats, start_time):
+    """输出本次处理的统计信息和总耗时"""
     # 计算总耗时
     total_time = time.time() - start_time
     m, s = divmod(int(total_time), 60)
     h, m = divmod(m, 60)
     
-    # 输出结果统计
-    print("\n=== 批量处理完成 ===")
-    print(f"总任务数: {total_tasks}")
-    print(f"成功任务: {success_count}")
-    print(f"失败任务: {failed_count}")
+    print(f"成功任务: {stats['success']}")
+    print(f"失败任务: {stats['failed']}")
+    if stats["cache_hits"]:
+        print(f"命中结果缓存: {stats['cache_hits']}")
+    if stats["image_hits"] + stats["image_misses"]:
+        print(f"图片编码缓存: 命中 {stats['image_hits']} 次，编码 {stats['image_misses']} 次")
+    if stats["linked"]:
+        print(f"图片下载: 下载 {stats['fetched']} 张，重复的 {stats['linked']} 张已链接到已下载的文件")
+    for name, key_stats in stats["keys"].items():
+        print(format_key_stats(name, key_stats))
     print(f"总耗时: {h:d}小时 {m:02d}分 {s:02d}秒")
     print(f"处理结果保存在: {OUTPUT_DIR}")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main() 
@@ -12,6 +12,7 @@ import base64
 import requests
 import time
 from dotenv import load_dotenv
+from downloader import fetch_to_file
 
 # 加载环境变量
 load_dotenv()
@@ -25,7 +26,7 @@ images = [
 
 # 从环境变量获取配置
 model = os.getenv("MODEL", "gpt-4o-image-vip")
-api_url = "https://api.tu-zi.com/v1/chat/completions"
+api_url = os.getenv("API_URL", "https://api.tu-zi.com/v1/chat/completions")
 api_token = os.getenv("API_TOKEN")
 
 # 验证API Token
@@ -95,7 +96,7 @@ headers = {
 try:
     response = requests.post(api_url, json=data, headers=headers, timeout=1200)
     print(f"响应状态码: {response.status_code}")
-    print(f"响应内容: {response.text}")
+    print(f"响应大小: {len(response.content)} 字节")  # 不输出完整的响应内容，图片链接等内容在下面解析后输出
 except Exception as e:
     print(f"发送请求时出错: {e}")
     raise
@@ -107,7 +108,6 @@ if response.status_code != 200:
 
 try:
     result = response.json()
-    print(f"响应 JSON 数据: {result}")
 except Exception as e:
     print(f"解析响应 JSON 时出错: {e}")
     exit()
@@ -122,14 +122,13 @@ if "choices" in result and isinstance(result["choices"], list):
     for choice in result["choices"]:
         if "message" in choice and "content" in choice["message"]:
             content = choice["message"]["content"]
-            print(f"正在处理内容: {content}")
+            print(f"正在处理内容: {content[:100]}...")  # 只显示内容的前100个字符
             # 只提取 [点击下载](http...) 这种格式的图片链接
             import re
             download_links = re.findall(r'\[点击下载\]\((https?://[^\s\)]+)\)', content)
             for idx, image_url in enumerate(download_links):
                 try:
                     print(f"正在下载图片: {image_url}")
-                    image_data = requests.get(image_url).content
                     ext = "png"
                     m = re.search(r"\.([a-zA-Z0-9]+)(?:\?|$)", image_url)
                     if m:
@@ -140,8 +139,7 @@ if "choices" in result and isinstance(result["choices"], list):
                     output_dir = os.path.join(os.getcwd(), "output")
                     os.makedirs(output_dir, exist_ok=True)
                     output_path = os.path.join(output_dir, file_name)
-                    with open(output_path, "wb") as f:
-                        f.write(image_data)
+                    fetch_to_file(image_url, output_path)  # 按块写入，支持超时和断点续传
                     print(f"图片已保存到: {output_path}")
                     download_count += 1
                 except Exception as e:
@@ -0,0 +1,63 @@
+"""
+HTTP 会话管理: 为API请求和图片下载提供共享的连接池
+* 同一进程内所有请求复用一个会话，按主机维护连接池并保持长连接（keep-alive），避免每次请求都重新进行TCP+TLS握手
+* 连接池大小默认按并发数设置，也可通过环境变量调整
+* asyncio 引擎使用对应的 aiohttp 会话
+"""
+
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量获取配置
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))  # 缓存的主机连接池数量
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "0"))  # 每个主机的最大连接数，0表示按并发数自动设置
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))  # 空闲长连接保持时间 (秒, asyncio 引擎使用)
+
+_session = None
+_session_lock = threading.Lock()
+
+def pool_maxsize(concurrency):
+    """计算每个主机的连接池大小"""
+    if HTTP_POOL_MAXSIZE > 0:
+        return HTTP_POOL_MAXSIZE
+    return max(1, concurrency)
+
+def get_session(concurrency=1):
+    """获取进程内共享的requests会话，首次调用时按并发数创建连接池"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=pool_maxsize(concurrency),
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+def close_session():
+    """关闭共享会话并释放所有连接"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+def create_async_session(concurrency):
+    """创建asyncio引擎使用的aiohttp会话（需要在事件循环中调用）"""
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(
+        limit=max(1, concurrency),
+        limit_per_host=pool_maxsize(concurrency),
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector)
@@ -0,0 +1,85 @@
+"""
+图片编码缓存: 同一次运行中每张图片只读取和base64编码一次
+* 以 (绝对路径, 修改时间, 文件大小) 为键，图片被修改后会重新编码
+* 按编码后的总字节数限制容量，超出时按LRU淘汰
+* 线程安全；多个线程同时请求同一张未缓存的图片时只编码一次，其余线程等待结果
+* asyncio 引擎在线程池中准备任务，同样适用
+* 容量为0时不缓存，直接编码，不加锁也不登记正在编码的图片
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量获取配置
+IMAGE_CACHE_MAX_MB = float(os.getenv("IMAGE_CACHE_MAX_MB", "512"))  # 编码缓存总大小上限 (MB)，0 表示不缓存
+
+class EncodedImageCache:
+    """进程内的图片编码结果缓存"""
+
+    def __init__(self, max_bytes=IMAGE_CACHE_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # 键 -> 编码结果
+        self.total_bytes = 0
+        self.pending = {}  # 正在编码的键 -> threading.Event
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cache_key(path):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+    def get(self, path, encode):
+        """返回图片的编码结果，未缓存时调用 encode(path) 编码并缓存"""
+        if self.max_bytes <= 0:
+            return encode(path)
+        key = self.cache_key(path)
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key]
+                event = self.pending.get(key)
+                if event is None:
+                    # 由当前线程负责编码
+                    event = self.pending[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # 其他线程正在编码同一张图片，等待后重新查询（编码失败时由下一个线程重试）
+            event.wait()
+
+        try:
+            value = encode(path)
+        except BaseException:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+            raise
+
+        with self.lock:
+            del self.pending[key]
+            self._put(key, value)
+        event.set()
+        return value
+
+    def _put(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= len(evicted)
+
+    def stats(self):
+        """返回 (命中次数, 未命中次数, 缓存条目数, 缓存字节数)"""
+        with self.lock:
+            return self.hits, self.misses, len(self.entries), self.total_bytes
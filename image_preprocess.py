@@ -0,0 +1,151 @@
+"""
+图片预处理: 上传前缩小尺寸并重新压缩，减少上传时间和上游处理时间
+* 按最长边缩放到 IMAGE_MAX_EDGE 以内，重新编码为 JPEG 或 WebP
+* 在进程池中执行，不占用发送请求的线程
+* 结果按源文件内容和参数的哈希缓存在磁盘上，再次运行时直接复用
+* 重新压缩后反而变大且无需缩放时保留原图
+* 预处理失败（格式不支持、文件损坏、像素数过多等）时输出警告并上传原图，失败不缓存
+* 通过文件头识别真实的图片类型，不再只依赖扩展名
+* 需要安装 Pillow（pip install pillow）；未安装时只做类型识别，不做预处理
+"""
+
+import os
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量获取配置
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "0").lower() in ("1", "true", "yes")  # 是否启用预处理
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "2048"))  # 最长边像素数
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").lower()  # 重新编码格式: jpeg 或 webp
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))  # 压缩质量 (1-100)
+IMAGE_PREPROCESS_DIR = os.getenv("IMAGE_PREPROCESS_DIR", os.path.join(os.getcwd(), "cache", "images"))
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", "0"))  # 预处理进程数，0 表示按CPU核数
+
+# 文件头 -> MIME 类型
+SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+]
+
+def detect_mime(path):
+    """根据文件头识别图片类型，无法识别时按扩展名判断"""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(16)
+    except OSError:
+        head = b""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, mime in SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    lower = path.lower()
+    if lower.endswith((".jpg", ".jpeg")):
+        return "image/jpeg"
+    if lower.endswith(".webp"):
+        return "image/webp"
+    return "image/png"
+
+def _process_image(src, dst, max_edge, fmt, quality):
+    """在子进程中执行：缩放并重新编码图片，写入 dst"""
+    tmp = f"{dst}.tmp-{os.getpid()}"
+    try:
+        with Image.open(src) as image:
+            image = ImageOps.exif_transpose(image)  # 按EXIF方向旋转，去掉方向信息后方向仍然正确
+            resized = max(image.size) > max_edge
+            if resized:
+                image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            if image.mode not in ("RGB", "L") and fmt == "jpeg":
+                image = image.convert("RGB")
+            image.save(tmp, format=fmt.upper(), quality=quality)
+        if not resized and os.path.getsize(tmp) >= os.path.getsize(src):
+            # 无需缩放且重新压缩没有变小，保留原图
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return dst
+
+class ImagePreprocessor:
+    """图片预处理器，返回处理后（缓存中）的文件路径"""
+
+    def __init__(self, enabled=IMAGE_PREPROCESS, cache_dir=IMAGE_PREPROCESS_DIR, max_edge=IMAGE_MAX_EDGE,
+                 fmt=IMAGE_FORMAT, quality=IMAGE_QUALITY, workers=PREPROCESS_WORKERS, warn=print):
+        self.enabled = enabled and Image is not None
+        self.unavailable = enabled and Image is None  # 已开启但未安装Pillow
+        self.cache_dir = cache_dir
+        self.max_edge = max_edge
+        self.fmt = "webp" if fmt == "webp" else "jpeg"
+        self.quality = quality
+        self.workers = workers or None
+        self.warn = warn  # 输出预处理失败的警告
+        self.failures = 0  # 预处理失败而上传原图的次数
+        self.executor = None
+        self.pending = {}  # 缓存文件路径 -> 进行中的Future
+        self.digests = {}  # (路径, 修改时间, 大小) -> 源文件哈希
+        self.lock = threading.Lock()
+
+    def _source_digest(self, path):
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            digest = self.digests.get(key)
+        if digest is None:
+            hasher = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+            hasher.update(f"|{self.max_edge}|{self.fmt}|{self.quality}".encode("utf-8"))
+            digest = hasher.hexdigest()
+            with self.lock:
+                self.digests[key] = digest
+        return digest
+
+    def prepare(self, path):
+        """返回上传时使用的文件路径：未启用或预处理失败时返回原路径，否则返回预处理后的缓存文件"""
+        if not self.enabled:
+            return path
+        dst = os.path.join(self.cache_dir, self._source_digest(path))
+        if os.path.exists(dst):
+            return dst
+        with self.lock:
+            future = self.pending.get(dst)
+            if future is None:
+                if self.executor is None:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    self.executor = ProcessPoolExecutor(max_workers=self.workers)
+                future = self.executor.submit(_process_image, path, dst, self.max_edge, self.fmt, self.quality)
+                self.pending[dst] = future
+        try:
+            return future.result()
+        except Exception as e:
+            # 预处理只是优化，失败时上传原图；不记录失败，下次仍会尝试
+            with self.lock:
+                self.failures += 1
+            self.warn(f"警告：图片预处理失败，将上传原图: {path} - {type(e).__name__}: {e}")
+            return path
+        finally:
+            with self.lock:
+                self.pending.pop(dst, None)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
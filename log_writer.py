@@ -0,0 +1,208 @@
+"""
+日志: 工作线程只把日志放入队列，由后台线程写入控制台和日志文件，终端或管道输出慢时不会阻塞请求和下载
+* 日志分为 debug、info、warning、error 四个级别，低于 LOG_LEVEL 的日志直接丢弃
+* 设置 LOG_FILE 时每条日志写入一行 JSON（时间、级别、进程、线程、内容，以及任务序号、名称、ID等字段）
+* 控制台每秒最多输出 LOG_CONSOLE_RATE 条日志（error 级别不受限制），超出的日志不在控制台显示，
+  每隔几秒输出一行省略的数量；日志文件不受此限制
+* 队列已满（后台线程跟不上）时丢弃新的日志并计数，不等待
+* 多进程模式下每个进程有各自的后台线程，日志文件以追加方式写入，多个进程可以写入同一个文件
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量获取配置
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info").lower()  # 日志级别: debug、info、warning 或 error
+LOG_FILE = os.getenv("LOG_FILE", "")  # JSON 日志文件（每行一条），为空表示只输出到控制台
+LOG_CONSOLE_RATE = int(os.getenv("LOG_CONSOLE_RATE", "50"))  # 控制台每秒最多输出的日志条数，0 表示不限制
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # 等待写入的日志条数上限
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+SUMMARY_INTERVAL = 5  # 输出省略数量的最短间隔 (秒)
+BATCH_SIZE = 1000  # 后台线程每次最多取出的日志条数
+
+# 日志条目的输出方式
+BOTH = "both"  # 控制台和日志文件
+CONSOLE = "console"  # 只输出到控制台，不限速
+FILE = "file"  # 只写入日志文件
+FLUSH = "flush"  # 输出省略数量，用于 flush
+STOP = "stop"  # 写出之前的日志后结束后台线程，用于 stop
+
+def level_value(level):
+    """日志级别对应的数值，无法识别的级别按 info"""
+    return LEVELS.get(str(level).lower(), LEVELS["info"])
+
+def console_line(message, fields):
+    """控制台输出的一行：任务相关的日志带任务名称和ID"""
+    if "task_name" in fields and "task_id" in fields:
+        return f"任务 {fields['task_name']} (ID: {fields['task_id']}) {message}"
+    return message
+
+class LogWriter:
+    """线程安全的非阻塞日志，调用方只把日志放入队列"""
+
+    def __init__(self, path=LOG_FILE, level=LOG_LEVEL, console_rate=LOG_CONSOLE_RATE, queue_size=LOG_QUEUE_SIZE):
+        self.path = path
+        self.level = level_value(level)
+        self.console_rate = console_rate
+        self.queue_size = queue_size
+        self.fd = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._reset()
+        if hasattr(os, "register_at_fork"):
+            # 子进程中不存在父进程的后台线程，重新创建队列，第一次记录日志时启动自己的后台线程
+            os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self.queue = queue.Queue(self.queue_size)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dropped = 0  # 队列已满而丢弃的条数
+        self.suppressed = 0  # 超出控制台速率而未显示的条数
+        self.window_start = self.last_summary = time.monotonic()
+        self.window_count = 0
+
+    def _put(self, entry):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                    self.thread.start()
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def log(self, level, message, **fields):
+        """记录一条日志，fields 为写入 JSON 日志的字段（含 task_name 和 task_id 时控制台输出带任务信息）"""
+        if level_value(level) < self.level:
+            return
+        self._put((BOTH, time.time(), level, message, fields, threading.current_thread().name))
+
+    def debug(self, message, **fields):
+        self.log("debug", message, **fields)
+
+    def info(self, message, **fields):
+        self.log("info", message, **fields)
+
+    def warning(self, message, **fields):
+        self.log("warning", message, **fields)
+
+    def error(self, message, **fields):
+        self.log("error", message, **fields)
+
+    def echo(self, text):
+        """原样输出到控制台（如进度信息），与日志按顺序输出，不受日志级别和速率限制"""
+        self._put((CONSOLE, time.time(), "info", text, {}, None))
+
+    def record(self, message, **fields):
+        """只写入日志文件的 info 事件（如进度统计），未设置 LOG_FILE 时不记录"""
+        if self.fd is None or LEVELS["info"] < self.level:
+            return
+        self._put((FILE, time.time(), "info", message, fields, threading.current_thread().name))
+
+    def flush(self):
+        """等待已记录的日志全部写出，并输出省略的数量"""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        try:
+            self.queue.put((FLUSH, 0, None, None, None, None), timeout=1)
+        except queue.Full:
+            pass
+        self.queue.join()
+
+    def stop(self):
+        """写出已记录的日志并结束后台线程（如创建子进程之前），之后再记录日志时重新启动后台线程"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is None or not thread.is_alive():
+            return
+        self.queue.put((STOP, 0, None, None, None, None))
+        thread.join()
+
+    def _run(self):
+        """后台线程：批量取出日志，写入日志文件和控制台"""
+        stop = False
+        while not stop:
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except queue.Empty:
+                batch = []  # 空闲时也检查是否需要输出省略的数量
+            while batch and batch[-1][0] != STOP and len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = bool(batch) and batch[-1][0] == STOP
+            try:
+                self._handle(batch)
+            except Exception:
+                pass  # 输出出错（如管道已关闭）时丢弃这批日志，后台线程继续运行
+            for _ in batch:
+                self.queue.task_done()
+
+    def _handle(self, batch):
+        lines, records = [], []
+        flush = False
+        now = time.monotonic()
+        for mode, created, level, message, fields, thread in batch:
+            if mode in (FLUSH, STOP):
+                flush = True
+                continue
+            if mode != CONSOLE and self.fd is not None:
+                records.append(json.dumps(dict({"time": datetime.fromtimestamp(created).isoformat(timespec="milliseconds"),
+                                                "level": level, "pid": os.getpid(), "thread": thread,
+                                                "message": message}, **fields), ensure_ascii=False, default=str))
+            if mode == FILE:
+                continue
+            if mode == BOTH and not self._allow(level, now):
+                self.suppressed += 1
+                continue
+            lines.append(message if mode == CONSOLE else console_line(message, fields))
+        self._write(lines, records, now, flush)
+
+    def _allow(self, level, now):
+        """控制台速率限制：每秒最多 console_rate 条，error 级别总是输出"""
+        if self.console_rate <= 0 or level_value(level) >= LEVELS["error"]:
+            return True
+        if now - self.window_start >= 1:
+            self.window_start, self.window_count = now, 0
+        self.window_count += 1
+        return self.window_count <= self.console_rate
+
+    def _write(self, lines, records, now, flush):
+        if records:
+            # 一次写入整批日志，多个进程追加写入同一个文件时各行不会交错
+            os.write(self.fd, ("\n".join(records) + "\n").encode("utf-8"))
+        with self.lock:
+            dropped = self.dropped
+        if (self.suppressed or dropped) and (flush or now - self.last_summary >= SUMMARY_INTERVAL):
+            with self.lock:
+                dropped, self.dropped = self.dropped, 0
+            elapsed = now - self.last_summary
+            if self.suppressed:
+                hint = f"完整日志见 {self.path}" if self.path else "设置 LOG_FILE 可保存完整日志"
+                lines.append(f"（日志较多：最近 {elapsed:.0f} 秒内有 {self.suppressed} 条日志未在控制台显示，{hint}）")
+            if dropped:
+                lines.append(f"（日志队列已满：最近 {elapsed:.0f} 秒内丢弃了 {dropped} 条日志）")
+            self.suppressed = dropped = 0
+        if not self.suppressed and not dropped:
+            self.last_summary = now
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
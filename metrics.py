@@ -0,0 +1,214 @@
+"""
+运行指标: 请求数、失败原因、重试、上传下载字节数等计数器，处理中请求数、队列长度等仪表，以及请求和下载耗时的直方图
+* METRICS_PORT 大于0时在后台启动本地 HTTP 服务：/metrics 为 Prometheus 文本格式，/metrics.json 为 JSON 快照
+* JSON 快照中的直方图附带按桶估算的 p50/p95/p99，不接入 Prometheus 也能查看尾延迟
+* 快照是普通的字典，多进程模式下工作进程把快照发送给主进程，由主进程合并后输出
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量获取配置
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 指标 HTTP 服务端口，0 表示不启动
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # 指标 HTTP 服务监听的地址
+
+# 直方图的桶上限 (秒)
+REQUEST_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600, 1200)
+DOWNLOAD_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+# 指标定义：类型、说明；直方图另有桶上限，仪表另有多进程合并方式（sum 或 max）
+METRICS = {
+    "gpt4o_requests_total": {"type": "counter", "help": "API请求次数（含重试）"},
+    "gpt4o_request_failures_total": {"type": "counter", "help": "失败的API请求次数，按原因分类"},
+    "gpt4o_retries_total": {"type": "counter", "help": "重试次数，按原因分类"},
+    "gpt4o_tasks_total": {"type": "counter", "help": "已完成的任务数，按结果分类"},
+    "gpt4o_upload_bytes_total": {"type": "counter", "help": "上传的请求体字节数"},
+    "gpt4o_download_bytes_total": {"type": "counter", "help": "下载的图片字节数"},
+    "gpt4o_downloads_total": {"type": "counter", "help": "图片下载次数，按结果分类"},
+    "gpt4o_rate_limiter_wait_seconds_total": {"type": "counter", "help": "等待限流令牌的累计时间（秒）"},
+    "gpt4o_requests_in_flight": {"type": "gauge", "help": "正在进行的API请求数", "merge": "sum"},
+    "gpt4o_rate_limiter_wait_seconds": {"type": "gauge", "help": "最近一次等待限流令牌的时间（秒）", "merge": "max"},
+    "gpt4o_tasks_in_flight": {"type": "gauge", "help": "已提交未完成的任务数（含下载中）", "merge": "sum"},
+    "gpt4o_download_queue_depth": {"type": "gauge", "help": "等待下载的图片数", "merge": "sum"},
+    "gpt4o_request_duration_seconds": {"type": "histogram", "help": "API请求耗时（秒）", "buckets": REQUEST_BUCKETS},
+    "gpt4o_download_duration_seconds": {"type": "histogram", "help": "图片下载耗时（秒）", "buckets": DOWNLOAD_BUCKETS},
+}
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+class Metrics:
+    """线程安全的指标集合"""
+
+    def __init__(self, definitions=METRICS):
+        self.definitions = definitions
+        self.lock = threading.Lock()
+        self.samples = {name: {} for name in definitions}  # 名称 -> {标签: 值}，直方图的值为 [各桶次数, 总和, 次数]
+        self.functions = {}  # 名称 -> 生成快照时调用的函数（仪表）
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """计数器或仪表增加 value（仪表可以为负数）"""
+        key = self._labels(labels)
+        with self.lock:
+            samples = self.samples[name]
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """设置仪表的值"""
+        key = self._labels(labels)
+        with self.lock:
+            self.samples[name][key] = value
+
+    def set_function(self, name, function):
+        """仪表的值在生成快照时由 function() 读取"""
+        self.functions[name] = function
+
+    def observe(self, name, value, **labels):
+        """直方图记录一个观测值"""
+        buckets = self.definitions[name]["buckets"]
+        key = self._labels(labels)
+        with self.lock:
+            sample = self.samples[name].get(key)
+            if sample is None:
+                sample = self.samples[name][key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            sample[0][bisect.bisect_left(buckets, value)] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    def snapshot(self):
+        """当前所有指标的快照 {名称: [(标签, 值)]}，直方图的值为 (各桶次数, 总和, 次数)"""
+        values = {name: function() for name, function in self.functions.items()}
+        with self.lock:
+            snapshot = {name: [(dict(key), (list(value[0]), value[1], value[2]) if isinstance(value, list) else value)
+                               for key, value in samples.items()]
+                        for name, samples in self.samples.items()}
+        for name, value in values.items():
+            snapshot[name] = [({}, value)]
+        return snapshot
+
+def merge_snapshots(snapshots, definitions=METRICS):
+    """合并多个进程的快照：计数器和直方图相加，仪表按定义相加或取最大值"""
+    merged = {}
+    for name, definition in definitions.items():
+        values = {}
+        for snapshot in snapshots:
+            for labels, value in snapshot.get(name, []):
+                key = tuple(sorted(labels.items()))
+                if key not in values:
+                    values[key] = value
+                elif definition["type"] == "histogram":
+                    counts, total, count = values[key]
+                    values[key] = ([a + b for a, b in zip(counts, value[0])], total + value[1], count + value[2])
+                elif definition.get("merge") == "max":
+                    values[key] = max(values[key], value)
+                else:
+                    values[key] = values[key] + value
+        merged[name] = [(dict(key), value) for key, value in values.items()]
+    return merged
+
+def histogram_quantile(buckets, counts, q):
+    """按桶内线性分布估算分位数，落在最后一个桶（超过最大上限）时返回最大上限"""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if seen + count >= rank and count:
+            if i == len(buckets):
+                return float(buckets[-1])
+            lower = buckets[i - 1] if i else 0.0
+            return lower + (buckets[i] - lower) * (rank - seen) / count
+        seen += count
+    return float(buckets[-1])
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+def render_prometheus(snapshot, definitions=METRICS):
+    """Prometheus 文本格式"""
+    lines = []
+    for name, definition in definitions.items():
+        lines.append(f"# HELP {name} {definition['help']}")
+        lines.append(f"# TYPE {name} {definition['type']}")
+        for labels, value in snapshot.get(name, []):
+            if definition["type"] != "histogram":
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(list(definition["buckets"]) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{format_labels(dict(labels, le=bound))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+def render_json(snapshot, started=None, definitions=METRICS):
+    """JSON 快照：计数器和仪表为数值，直方图为各桶次数、总和、次数和估算的分位数"""
+    now = time.time()
+    result = {"time": now, "uptime": now - started if started else None, "metrics": {}}
+    for name, definition in definitions.items():
+        samples = []
+        for labels, value in snapshot.get(name, []):
+            if definition["type"] == "histogram":
+                counts, total, count = value
+                value = {"buckets": dict(zip([str(b) for b in definition["buckets"]] + ["+Inf"], counts)),
+                         "sum": total, "count": count, "mean": total / count if count else None}
+                for q in QUANTILES:
+                    value[f"p{q * 100:g}"] = histogram_quantile(definition["buckets"], counts, q)
+            samples.append({"labels": labels, "value": value})
+        result["metrics"][name] = samples
+    return result
+
+def latency_summary(snapshot, name, definitions=METRICS):
+    """直方图（合并所有标签）的 (次数, p50, p95, p99)，用于进度输出"""
+    buckets = definitions[name]["buckets"]
+    counts = [0] * (len(buckets) + 1)
+    for _, value in snapshot.get(name, []):
+        counts = [a + b for a, b in zip(counts, value[0])]
+    return (sum(counts),) + tuple(histogram_quantile(buckets, counts, q) for q in QUANTILES)
+
+def start_metrics_server(snapshot, port=METRICS_PORT, host=METRICS_HOST):
+    """在后台线程启动指标 HTTP 服务，snapshot() 返回要输出的快照；端口被占用等错误时抛出 OSError"""
+    started = time.time()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/metrics":
+                body = render_prometheus(snapshot()).encode("utf-8")
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif path == "/metrics.json":
+                body = json.dumps(render_json(snapshot(), started), ensure_ascii=False).encode("utf-8")
+                content_type = "application/json; charset=utf-8"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # 不输出访问日志
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,170 @@
+"""
+API限流: 支持突发容量的令牌桶
+* 令牌按固定速率补充，桶满时最多可以立即发出 burst 个请求
+* 采用预约方式获取令牌：锁内只记账并计算需要等待的时间，等待在锁外进行，不会让所有线程排队等待同一个sleep
+* 同一个限流器可同时用于线程池（acquire）和 asyncio 引擎（acquire_async）
+* 可组合多个限流器，例如同时限制每秒和每分钟的请求数
+* SharedTokenBucket 的状态保存在共享内存中，多进程模式下所有进程共用同一个限流额度
+"""
+
+import time
+import asyncio
+import threading
+import multiprocessing
+
+class RateLimiter:
+    """限流器基类，子类实现 reserve/try_acquire/refund"""
+
+    def reserve(self, tokens=1):
+        """预约令牌并返回需要等待的秒数（0表示可立即发送）"""
+        raise NotImplementedError
+
+    def try_acquire(self, tokens=1):
+        """非阻塞获取令牌，成功返回True"""
+        raise NotImplementedError
+
+    def refund(self, tokens=1):
+        """归还令牌（例如预约后放弃发送）"""
+        raise NotImplementedError
+
+    def wait_time(self, tokens=1):
+        """现在预约令牌需要等待的秒数（0表示有令牌可用），不占用令牌"""
+        raise NotImplementedError
+
+    def acquire(self, tokens=1):
+        """阻塞直到获得令牌，返回实际等待的秒数"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens=1):
+        """在事件循环中等待令牌，返回实际等待的秒数"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def consume(self):
+        """兼容旧接口：获取一个令牌"""
+        self.acquire()
+        return True
+
+class TokenBucket(RateLimiter):
+    """令牌桶：每秒补充 rate 个令牌，最多存放 burst 个"""
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError("rate 必须大于0")
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst  # 初始为满桶，批次开始时可立即发出 burst 个请求
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.last_refill = now
+
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def reserve(self, tokens=1):
+        with self.lock:
+            self._refill()
+            # 令牌数允许为负，负数部分即为排在前面的预约
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def refund(self, tokens=1):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + tokens)
+
+    def wait_time(self, tokens=1):
+        with self.lock:
+            self._refill()
+            return max(0.0, (tokens - self.tokens) / self.rate)
+
+class SharedTokenBucket(TokenBucket):
+    """跨进程共享的令牌桶：令牌数和补充时间保存在共享内存中，创建子进程时作为参数传入即可共用
+
+    time.monotonic 在同一台主机的所有进程中使用同一个时钟
+    """
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError("rate 必须大于0")
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.state = multiprocessing.Array("d", [self.burst, time.monotonic()])  # [令牌数, 上次补充时间]
+        self.lock = self.state.get_lock()
+
+    @property
+    def tokens(self):
+        return self.state[0]
+
+    @tokens.setter
+    def tokens(self, value):
+        self.state[0] = value
+
+    @property
+    def last_refill(self):
+        return self.state[1]
+
+    @last_refill.setter
+    def last_refill(self, value):
+        self.state[1] = value
+
+class MultiRateLimiter(RateLimiter):
+    """组合多个限流器，只有全部满足时才放行；不包含任何限流器时不限流"""
+
+    def __init__(self, limiters):
+        self.limiters = list(limiters)
+
+    def try_acquire(self, tokens=1):
+        acquired = []
+        for limiter in self.limiters:
+            if not limiter.try_acquire(tokens):
+                for held in acquired:
+                    held.refund(tokens)
+                return False
+            acquired.append(limiter)
+        return True
+
+    def reserve(self, tokens=1):
+        return max((limiter.reserve(tokens) for limiter in self.limiters), default=0.0)
+
+    def refund(self, tokens=1):
+        for limiter in self.limiters:
+            limiter.refund(tokens)
+
+    def wait_time(self, tokens=1):
+        return max((limiter.wait_time(tokens) for limiter in self.limiters), default=0.0)
+
+def create_rate_limiter(interval, burst=1, per_minute=0, shared=False):
+    """根据配置创建限流器
+
+    interval: 平均请求间隔 (秒)，0 表示不按秒限流
+    burst: 突发容量，即空闲后可立即发送的请求数
+    per_minute: 每分钟最多请求数，0 表示不限制
+    shared: 是否创建可在多个进程间共用的限流器
+    """
+    bucket = SharedTokenBucket if shared else TokenBucket
+    limiters = []
+    if interval > 0:
+        limiters.append(bucket(1.0 / interval, burst))
+    if per_minute > 0:
+        limiters.append(bucket(per_minute / 60.0, per_minute))
+    if len(limiters) == 1:
+        return limiters[0]
+    return MultiRateLimiter(limiters)
@@ -0,0 +1,181 @@
+"""
+结果缓存: 按模型、提示词和输入图片内容缓存API结果，相同任务不再重复请求和计费
+* 缓存键为 model、prompt 以及每张输入图片原始字节的哈希，与文件名和任务名无关
+* 命中时将缓存的响应和已下载的图片硬链接（不支持时复制）到新任务的输出目录
+* 只缓存完全成功（响应正常、至少有一张图片且所有图片均已下载）的结果
+* 默认不启用：模型的输出是随机的，启用后相同的任务不会再重新生成，需要复用结果时设置 RESULT_CACHE=1
+* 按总大小和存放时间淘汰，超出容量时优先删除最久未使用的条目
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量获取配置
+RESULT_CACHE = os.getenv("RESULT_CACHE", "0").lower() in ("1", "true", "yes")  # 是否启用结果缓存
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(os.getcwd(), "cache", "results"))
+RESULT_CACHE_MAX_MB = float(os.getenv("RESULT_CACHE_MAX_MB", "5120"))  # 缓存总大小上限 (MB)
+RESULT_CACHE_MAX_AGE_DAYS = float(os.getenv("RESULT_CACHE_MAX_AGE_DAYS", "30"))  # 缓存最长保存天数
+
+META_FILE = "cache_meta.json"
+SKIP_FILES = ("task_info.json",)  # 与具体任务相关，不写入缓存
+EVICT_EVERY = 100  # 每写入多少条缓存检查一次容量
+
+def hash_file(path, hasher):
+    """按块读取文件内容写入哈希"""
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+
+def link_or_copy(src, dst):
+    """优先创建硬链接，跨文件系统等情况下退回复制"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+class ResultCache:
+    """磁盘结果缓存（线程安全）"""
+
+    def __init__(self, root=RESULT_CACHE_DIR, enabled=RESULT_CACHE,
+                 max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024,
+                 max_age=RESULT_CACHE_MAX_AGE_DAYS * 86400):
+        self.root = root
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.stores = 0
+        self.hits = 0
+        self.misses = 0
+        self.digests = {}  # (路径, 修改时间, 大小) -> 图片内容哈希
+
+    def _image_digest(self, path):
+        """图片内容的哈希，文件未修改时复用上次的结果"""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            digest = self.digests.get(key)
+        if digest is None:
+            hasher = hashlib.sha256()
+            hash_file(path, hasher)
+            digest = hasher.digest()
+            with self.lock:
+                self.digests[key] = digest
+        return digest
+
+    def key(self, model, prompt, image_paths):
+        """计算缓存键，未启用缓存或图片无法读取时返回None"""
+        if not self.enabled:
+            return None
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps([model, prompt], ensure_ascii=False).encode("utf-8"))
+        try:
+            for path in image_paths:
+                hasher.update(self._image_digest(path))
+        except OSError:
+            return None
+        return hasher.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def restore(self, key, target_dir):
+        """缓存命中时将结果链接到目标目录并返回True"""
+        if not self.enabled or key is None:
+            return False
+        entry = self._entry_dir(key)
+        meta_path = os.path.join(entry, META_FILE)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            for name in meta["files"]:
+                dst = os.path.join(target_dir, name)
+                if os.path.exists(dst):
+                    os.remove(dst)
+                link_or_copy(os.path.join(entry, name), dst)
+            # 记录最近使用时间，用于按LRU淘汰
+            os.utime(meta_path)
+        except (OSError, ValueError, KeyError):
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, source_dir):
+        """将任务输出目录中的结果写入缓存"""
+        if not self.enabled or key is None:
+            return
+        entry = self._entry_dir(key)
+        if os.path.exists(entry):
+            return
+        tmp_dir = f"{entry}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            files = []
+            size = 0
+            for name in os.listdir(source_dir):
+                src = os.path.join(source_dir, name)
+                if name in SKIP_FILES or not os.path.isfile(src):
+                    continue
+                # 写入缓存时复制，避免任务目录中的文件被覆盖时影响缓存内容
+                shutil.copy2(src, os.path.join(tmp_dir, name))
+                files.append(name)
+                size += os.path.getsize(src)
+            with open(os.path.join(tmp_dir, META_FILE), "w", encoding="utf-8") as f:
+                json.dump({"files": files, "size": size, "created": time.time()}, f)
+            # 先写临时目录再重命名，其他线程不会读到不完整的条目
+            os.rename(tmp_dir, entry)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        with self.lock:
+            self.stores += 1
+            check = self.stores % EVICT_EVERY == 0
+        if check:
+            self.evict()
+
+    def evict(self):
+        """删除过期条目，并在超出容量时按最久未使用的顺序删除"""
+        if not self.enabled or not os.path.isdir(self.root):
+            return 0
+        with self.lock:
+            now = time.time()
+            entries = []
+            removed = 0
+            for prefix in os.listdir(self.root):
+                prefix_dir = os.path.join(self.root, prefix)
+                if not os.path.isdir(prefix_dir):
+                    continue
+                for key in os.listdir(prefix_dir):
+                    entry = os.path.join(prefix_dir, key)
+                    meta_path = os.path.join(entry, META_FILE)
+                    try:
+                        with open(meta_path, "r", encoding="utf-8") as f:
+                            meta = json.load(f)
+                        last_used = os.path.getmtime(meta_path)
+                    except (OSError, ValueError):
+                        continue  # 正在写入的临时目录或损坏的条目
+                    if self.max_age > 0 and now - meta.get("created", now) > self.max_age:
+                        shutil.rmtree(entry, ignore_errors=True)
+                        removed += 1
+                        continue
+                    entries.append((last_used, meta.get("size", 0), entry))
+
+            total = sum(size for _, size, _ in entries)
+            for last_used, size, entry in sorted(entries):
+                if self.max_bytes <= 0 or total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+                removed += 1
+            return removed
@@ -0,0 +1,138 @@
+"""
+重试策略: 按错误类型分类重试，退避时间采用去相关抖动（decorrelated jitter）
+* 可重试的错误: 连接错误、超时、HTTP 429、HTTP 5xx、上游返回的"繁忙"类错误信息
+* 服务器返回 Retry-After 头时，至少等待该时间
+* 全局重试预算：重试次数不能超过正常请求数的一定比例，上游故障时不会因重试放大流量
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+import requests
+from dotenv import load_dotenv
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量获取配置
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))  # 每个任务最多请求次数（含首次），1 表示不重试
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "2"))  # 退避基础时间 (秒)
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "60"))  # 单次退避最长时间 (秒)
+RETRY_AFTER_MAX = float(os.getenv("RETRY_AFTER_MAX", "300"))  # Retry-After 最长遵守时间 (秒)
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))  # 每个正常请求可积累的重试额度
+RETRY_BUDGET_MIN = float(os.getenv("RETRY_BUDGET_MIN", "10"))  # 初始（保底）重试额度
+RETRY_BUSY_KEYWORDS = [k.strip().lower() for k in os.getenv(
+    "RETRY_BUSY_KEYWORDS", "busy,繁忙,overload,负载,稍后,try again,rate limit,排队"
+).split(",") if k.strip()]
+
+# 错误分类
+CONNECT_ERROR = "connect"
+TIMEOUT = "timeout"
+RATE_LIMITED = "429"
+SERVER_ERROR = "5xx"
+UPSTREAM_BUSY = "busy"
+
+def classify_exception(exc):
+    """判断请求异常是否可重试，返回错误分类或None"""
+    if isinstance(exc, requests.exceptions.ReadTimeout):
+        return TIMEOUT
+    # 连接阶段的超时 (ConnectTimeout) 按连接错误处理
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError)):
+        return CONNECT_ERROR
+    if isinstance(exc, (requests.exceptions.Timeout, asyncio.TimeoutError, TimeoutError)):
+        return TIMEOUT
+    if aiohttp is not None and isinstance(exc, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+        return CONNECT_ERROR
+    return None
+
+def error_message(response_text):
+    """提取响应中 result['error']['message']，不存在时返回None"""
+    try:
+        result = json.loads(response_text)
+        return str(result["error"]["message"])
+    except Exception:
+        return None
+
+def classify_response(status_code, response_text):
+    """判断响应是否需要重试，返回错误分类或None"""
+    if status_code == 429:
+        return RATE_LIMITED
+    if status_code >= 500:
+        return SERVER_ERROR
+    if status_code == 200 and '"error"' in response_text:
+        message = error_message(response_text)
+        if message and any(keyword in message.lower() for keyword in RETRY_BUSY_KEYWORDS):
+            return UPSTREAM_BUSY
+    return None
+
+def parse_retry_after(value):
+    """解析 Retry-After 头（秒数或HTTP日期），返回秒数或None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+class RetryBudget:
+    """全局重试预算：每个首次请求存入 ratio 个额度，每次重试消耗1个，额度最多积累 minimum 个"""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, minimum=RETRY_BUDGET_MIN):
+        self.ratio = ratio
+        self.capacity = max(minimum, 1.0)
+        self.balance = minimum
+        self.lock = threading.Lock()
+
+    def record_request(self):
+        """记录一次首次请求"""
+        with self.lock:
+            self.balance = min(self.capacity, self.balance + self.ratio)
+
+    def try_spend(self):
+        """尝试消耗一次重试额度"""
+        with self.lock:
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+            return False
+
+class RetryPolicy:
+    """单个任务的重试决策，每个任务创建一个实例"""
+
+    def __init__(self, budget, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY, retry_after_max=RETRY_AFTER_MAX):
+        self.budget = budget
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_after_max = retry_after_max
+        self.attempt = 1
+        self.last_delay = base_delay
+        self.budget.record_request()
+
+    def next_delay(self, category, retry_after=None):
+        """失败后调用：需要重试时返回等待秒数，否则返回None"""
+        if category is None or self.attempt >= self.max_attempts:
+            return None
+        if not self.budget.try_spend():
+            return None
+        self.attempt += 1
+        # 去相关抖动: delay = min(上限, random(基础时间, 上次等待 * 3))
+        delay = min(self.max_delay, random.uniform(self.base_delay, self.last_delay * 3))
+        self.last_delay = delay
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.retry_after_max))
+        return delay
@@ -0,0 +1,102 @@
+"""
+流式响应: 解析 chat/completions 的 SSE (server-sent events) 响应
+* 按收到的数据块增量解析事件，不等待整个响应结束
+* 将各个 delta 拼接为与非流式响应结构相同的结果，后续保存和解析流程不变
+* 每个 [点击下载](url) 链接完整出现时立即返回，调用方可以马上开始下载
+"""
+
+import re
+import json
+
+# 只提取 [点击下载](http...) 这种格式的图片链接
+DOWNLOAD_LINK_PATTERN = re.compile(r'\[点击下载\]\((https?://[^\s\)]+)\)')
+
+class SSEDecoder:
+    """SSE 增量解析器：输入字节块，输出已完整接收的事件数据"""
+
+    def __init__(self):
+        self.buffer = b""
+        self.data_lines = []
+
+    def feed(self, chunk):
+        """输入一个字节块，返回其中已完整接收的事件数据列表"""
+        self.buffer += chunk
+        events = []
+        while True:
+            end = self.buffer.find(b"\n")
+            if end < 0:
+                break
+            line = self.buffer[:end].rstrip(b"\r").decode("utf-8")
+            self.buffer = self.buffer[end + 1:]
+            if not line:
+                # 空行表示一个事件结束
+                if self.data_lines:
+                    events.append("\n".join(self.data_lines))
+                    self.data_lines = []
+            elif line.startswith("data:"):
+                self.data_lines.append(line[5:].lstrip(" "))
+        return events
+
+class ChatStreamAssembler:
+    """将流式响应的 chunk 拼接为完整结果，并检测新出现的下载链接"""
+
+    def __init__(self):
+        self.id = None
+        self.model = None
+        self.choices = {}  # choice序号 -> {"content", "finish_reason", "scan_pos", "links"}
+        self.error = None
+        self.done = False
+
+    def add(self, data):
+        """处理一个事件，返回新出现的链接 [(choice序号, 链接序号, 图片地址)]"""
+        if data == "[DONE]":
+            self.done = True
+            return []
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            return []
+        if "error" in chunk:
+            self.error = chunk["error"]
+            return []
+        self.id = self.id or chunk.get("id")
+        self.model = self.model or chunk.get("model")
+
+        links = []
+        for choice in chunk.get("choices") or []:
+            index = choice.get("index", 0)
+            state = self.choices.setdefault(index, {"content": "", "finish_reason": None, "scan_pos": 0, "links": 0})
+            if choice.get("finish_reason"):
+                state["finish_reason"] = choice["finish_reason"]
+            delta = (choice.get("delta") or {}).get("content")
+            if not delta:
+                continue
+            state["content"] += delta
+            # 只从上一个完整链接之后开始查找，未闭合的链接等后续内容到达后再匹配
+            for match in DOWNLOAD_LINK_PATTERN.finditer(state["content"], state["scan_pos"]):
+                links.append((index, state["links"], match.group(1)))
+                state["links"] += 1
+                state["scan_pos"] = match.end()
+        return links
+
+    def result(self):
+        """返回与非流式响应结构相同的结果"""
+        if self.error is not None:
+            return {"error": self.error}
+        return {
+            "id": self.id,
+            "object": "chat.completion",
+            "model": self.model,
+            "choices": [
+                {
+                    "index": index,
+                    "message": {"role": "assistant", "content": state["content"]},
+                    "finish_reason": state["finish_reason"],
+                }
+                for index, state in sorted(self.choices.items())
+            ],
+        }
+
+    def result_text(self):
+        """返回序列化后的结果，作为 response.json 保存"""
+        return json.dumps(self.result(), ensure_ascii=False)
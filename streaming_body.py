@@ -0,0 +1,72 @@
+"""
+流式请求体: 边读取图片边生成 chat/completions 请求的 JSON，直接写入连接
+* 图片按块读取并base64编码，每个进行中的请求只占用一个小缓冲区，不再在内存中保存
+  原始字节、base64字符串、data URL、消息字典和序列化JSON等多份完整副本
+* base64 编码后的长度可以预先计算，因此请求仍带有准确的 Content-Length
+* 请求体可重复迭代，重试时会重新读取图片
+"""
+
+import json
+import base64
+import asyncio
+import os
+
+CHUNK_SIZE = 3 * 64 * 1024  # 每次读取的字节数，取3的倍数使分块编码结果可以直接拼接
+
+class StreamingChatBody:
+    """chat/completions 请求体，图片内容在发送时按块读取和编码"""
+
+    def __init__(self, model, prompt, images, stream=False, chunk_size=CHUNK_SIZE):
+        """images 为 [(文件路径, MIME类型)] 列表"""
+        self.images = list(images)
+        self.chunk_size = chunk_size
+        head = json.dumps({"model": model, "stream": stream}, ensure_ascii=False)[:-1]
+        self.prefix = (head + ', "messages": [{"role": "user", "content": ['
+                       + json.dumps({"type": "text", "text": prompt}, ensure_ascii=False)).encode("utf-8")
+        self.suffix = b"]}]}"
+        self.length = len(self.prefix) + len(self.suffix)
+        for path, mime in self.images:
+            image_head, image_tail = self._image_parts(mime)
+            size = os.path.getsize(path)
+            self.length += len(image_head) + 4 * ((size + 2) // 3) + len(image_tail)
+
+    @staticmethod
+    def _image_parts(mime):
+        head = f', {{"type": "image_url", "image_url": {{"url": "data:{mime};base64,'.encode("utf-8")
+        return head, b'"}}'
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        yield self.prefix
+        for path, mime in self.images:
+            image_head, image_tail = self._image_parts(mime)
+            yield image_head
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b""):
+                    yield base64.b64encode(chunk)
+            yield image_tail
+        yield self.suffix
+
+    async def aiter(self):
+        """asyncio 引擎使用的异步迭代器，文件读取和编码在线程池中执行"""
+        loop = asyncio.get_running_loop()
+        yield self.prefix
+        for path, mime in self.images:
+            image_head, image_tail = self._image_parts(mime)
+            yield image_head
+            f = await loop.run_in_executor(None, open, path, "rb")
+            try:
+                while True:
+                    chunk = await loop.run_in_executor(None, self._read_encoded, f)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                f.close()
+            yield image_tail
+        yield self.suffix
+
+    def _read_encoded(self, f):
+        return base64.b64encode(f.read(self.chunk_size))
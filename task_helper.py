@@ -1,17 +1,27 @@
 """
 辅助脚本: 用于创建和管理GPT-4o批处理任务
+* 不带参数运行时进入交互式菜单
+* 命令行模式（images / csv 子命令）按通配符、目录扫描或CSV文件批量生成任务，
+  以 JSON Lines 格式追加写入任务文件，适合在自动化流程中调用
 """
 
 import os
+import sys
+import csv
+import glob
 import json
 import shutil
+import argparse
 from datetime import datetime
 
 # 目录配置
 INPUT_DIR = os.path.join(os.getcwd(), "input")
 TASKS_FILE = os.path.join(INPUT_DIR, "tasks.json")
 TASKS_EXAMPLE = os.path.join(INPUT_DIR, "tasks.json.example")
+TASKS_JSONL_FILE = os.path.join(INPUT_DIR, "tasks.jsonl")
 IMAGES_DIR = os.path.join(INPUT_DIR, "images")
+DEFAULT_MODEL = "gpt-4o-image-vip"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
 
 # 确保目录存在
 os.makedirs(INPUT_DIR, exist_ok=True)
@@ -21,16 +31,26 @@ def clear_screen():
     """清屏"""
     os.system('cls' if os.name == 'nt' else 'clear')
 
+def scan_images(directory, recursive=False):
+    """使用 os.scandir 逐个返回目录中的图片路径（每个目录内按文件名排序），不跟随目录的符号链接"""
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                yield entry.path
+        if recursive:
+            stack.extend(reversed(subdirs))
+
 def list_images():
     """列出images目录中的所有图片"""
     if not os.path.exists(IMAGES_DIR):
         return []
-    
-    images = []
-    for file in os.listdir(IMAGES_DIR):
-        if file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')):
-            images.append(file)
-    return images
+    return [os.path.basename(path) for path in scan_images(IMAGES_DIR)]
 
 def load_tasks():
     """加载当前任务列表"""
@@ -259,6 +279,125 @@ def backup_tasks():
     except Exception as e:
         print(f"备份任务文件时出错: {e}")
 
+def image_reference(path):
+    """任务中使用的图片路径：位于 images 目录下时使用相对路径，否则使用绝对路径"""
+    path = os.path.abspath(path)
+    try:
+        relative = os.path.relpath(path, IMAGES_DIR)
+    except ValueError:
+        return path  # Windows 下位于不同盘符
+    if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+        return path
+    return relative.replace(os.sep, "/")
+
+def glob_images(patterns):
+    """按通配符匹配图片（相对路径相对于 images 目录，支持 ** 递归匹配），按路径排序"""
+    for pattern in patterns:
+        if not os.path.isabs(pattern):
+            pattern = os.path.join(IMAGES_DIR, pattern)
+        paths = [path for path in glob.iglob(pattern, recursive=True)
+                 if path.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path)]
+        yield from sorted(paths)
+
+def image_tasks(paths, prompt, model, prefix=None):
+    """为每张图片生成一个任务，任务名称为 前缀_序号，未指定前缀时使用图片文件名"""
+    for i, path in enumerate(paths, 1):
+        name = f"{prefix}_{i}" if prefix else os.path.splitext(os.path.basename(path))[0]
+        yield {"name": name, "prompt": prompt, "images": [image_reference(path)], "model": model}
+
+def csv_tasks(csv_file, prompt, model):
+    """按CSV文件的每一行生成任务
+
+    列名: name, prompt, images（多张图片用分号分隔）, model；缺少 prompt 或 model 时使用命令行参数
+    """
+    with open(csv_file, "r", encoding="utf-8-sig", newline="") as f:
+        for line_no, row in enumerate(csv.DictReader(f), 2):
+            images = [img.strip() for img in (row.get("images") or "").split(";") if img.strip()]
+            task_prompt = (row.get("prompt") or "").strip() or prompt
+            if not task_prompt:
+                print(f"跳过第 {line_no} 行：缺少提示词", file=sys.stderr)
+                continue
+            yield {
+                "name": (row.get("name") or "").strip() or f"任务_{line_no - 1}",
+                "prompt": task_prompt,
+                "images": images,
+                "model": (row.get("model") or "").strip() or model,
+            }
+
+def append_tasks(tasks, output):
+    """以 JSON Lines 格式逐个追加任务，不读取也不重写已有内容，返回写入的任务数；output 为 - 时写到标准输出"""
+    if output == "-":
+        count = 0
+        for task in tasks:
+            sys.stdout.write(json.dumps(task, ensure_ascii=False) + "\n")
+            count += 1
+        return count
+    
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "ab") as f:
+        # 已有内容没有以换行结尾时先补一个换行，避免与新任务写在同一行
+        if f.tell() > 0:
+            with open(output, "rb") as existing:
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b"\n":
+                    f.write(b"\n")
+        count = 0
+        for task in tasks:
+            f.write((json.dumps(task, ensure_ascii=False) + "\n").encode("utf-8"))
+            count += 1
+    return count
+
+def run_cli(argv):
+    """命令行模式：批量生成任务并追加到 JSON Lines 任务文件"""
+    parser = argparse.ArgumentParser(description="GPT-4o 批处理任务生成工具（不带参数运行时进入交互式菜单）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    images_parser = subparsers.add_parser("images", help="为每张图片生成一个任务")
+    images_parser.add_argument("--prompt", required=True, help="提示词")
+    images_parser.add_argument("--glob", action="append", default=[],
+                               help="图片通配符（相对于 input/images，支持 **），可多次指定")
+    images_parser.add_argument("--dir", help="扫描的图片目录，未指定 --glob 和 --dir 时扫描 input/images")
+    images_parser.add_argument("--recursive", action="store_true", help="同时扫描子目录")
+    images_parser.add_argument("--name", help="任务名称前缀，默认使用图片文件名")
+    
+    csv_parser = subparsers.add_parser("csv", help="按CSV文件的每一行生成一个任务")
+    csv_parser.add_argument("file", help="CSV文件，列名为 name、prompt、images（分号分隔）、model")
+    csv_parser.add_argument("--prompt", default="", help="CSV中缺少提示词时使用的默认提示词")
+    
+    for subparser in (images_parser, csv_parser):
+        subparser.add_argument("--model", default=DEFAULT_MODEL, help=f"模型，默认为 {DEFAULT_MODEL}")
+        subparser.add_argument("--output", default=TASKS_JSONL_FILE,
+                               help="追加写入的 JSON Lines 任务文件，默认为 input/tasks.jsonl；- 表示标准输出")
+    args = parser.parse_args(argv)
+    
+    if args.output != "-" and not args.output.lower().endswith((".jsonl", ".ndjson")):
+        parser.error("只能追加到 JSON Lines 任务文件（.jsonl 或 .ndjson）")
+    
+    if args.command == "images":
+        if args.glob:
+            paths = glob_images(args.glob)
+        else:
+            directory = args.dir or IMAGES_DIR
+            if not os.path.isdir(directory):
+                parser.error(f"图片目录不存在: {directory}")
+            paths = scan_images(directory, args.recursive)
+        tasks = image_tasks(paths, args.prompt, args.model, args.name)
+    else:
+        tasks = csv_tasks(args.file, args.prompt, args.model)
+    
+    try:
+        count = append_tasks(tasks, args.output)
+    except (OSError, csv.Error) as e:
+        print(f"生成任务失败: {e}", file=sys.stderr)
+        return 1
+    if args.output != "-":
+        print(f"已追加 {count} 个任务到 {args.output}")
+        if os.path.abspath(args.output) == TASKS_JSONL_FILE and load_tasks():
+            # 运行脚本在 tasks.jsonl 存在时优先使用它，交互式菜单编辑的 tasks.json 不会再被执行
+            print(f"注意：{TASKS_FILE} 中也有任务，运行脚本默认只处理 {TASKS_JSONL_FILE}，"
+                  f"可设置 TASKS_FILE 环境变量选择任务文件", file=sys.stderr)
+    return 0
+
 def main_menu():
     """主菜单"""
     while True:
@@ -269,6 +408,8 @@ def main_menu():
         print(f"当前有 {len(tasks)} 个任务")
         print(f"图片目录: {IMAGES_DIR}")
         print(f"任务文件: {TASKS_FILE}\n")
+        if os.path.exists(TASKS_JSONL_FILE):
+            print(f"注意：存在 {TASKS_JSONL_FILE}，运行脚本默认处理该文件而不是这里编辑的任务（可设置 TASKS_FILE 环境变量选择任务文件）\n")
         
         print("1. 查看所有任务")
         print("2. 创建新任务")
@@ -310,4 +451,6 @@ def main_menu():
             input("\n按回车键继续...")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
     main_menu() 
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""
+任务日志: 以追加方式记录每个任务的开始、成功和失败，用于中断后续跑（--resume）
+* 每个任务使用稳定的任务键（由任务内容计算），与任务在文件中的位置和运行时间无关
+* 日志为 JSON Lines 格式，每行一个事件，写入后立即刷新，进程崩溃也只会丢失最后一行
+* 续跑时跳过已成功的任务，未完成或失败的任务沿用原任务ID（输出到原目录）重新执行
+"""
+
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+
+# 事件类型
+START = "start"
+SUCCESS = "success"
+FAILURE = "failure"
+
+def task_fingerprint(task):
+    """根据任务内容计算哈希"""
+    canonical = json.dumps({
+        "name": task.get("name"),
+        "prompt": task.get("prompt", ""),
+        "images": task.get("images", []),
+        "model": task.get("model"),
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:16]
+
+class TaskKeyGenerator:
+    """生成稳定的任务键：内容哈希加上相同内容任务的出现序号"""
+
+    def __init__(self):
+        self.seen = {}
+
+    def key(self, task):
+        fingerprint = task_fingerprint(task)
+        occurrence = self.seen.get(fingerprint, 0)
+        self.seen[fingerprint] = occurrence + 1
+        return f"{fingerprint}-{occurrence}"
+
+class TaskJournal:
+    """追加写入的任务日志（线程安全）"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def load(self):
+        """读取已有日志，返回 {任务键: {"status": 最后状态, "task_id": 任务ID}}"""
+        states = {}
+        if not os.path.exists(self.path):
+            return states
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue  # 崩溃时可能留下不完整的最后一行
+                state = states.setdefault(event["key"], {})
+                state["status"] = event["event"]
+                if event.get("task_id"):
+                    state["task_id"] = event["task_id"]
+        return states
+
+    def record(self, key, event, task_id=None, **fields):
+        """追加一条事件"""
+        entry = {"time": datetime.now().isoformat(), "event": event, "key": key, "task_id": task_id}
+        entry.update(fields)
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self.file = open(self.path, "a", encoding="utf-8")
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class JobPlanner:
+    """为任务生成键；续跑时跳过已成功的任务并沿用未完成任务的任务ID
+
+    任务逐个生成，不需要先读入全部任务。每个 job 为 {"task", "idx", "key", "task_id"}，task_id 为None时表示新建
+    """
+
+    def __init__(self, journal, resume):
+        self.states = journal.load() if resume else {}
+        self.keys = TaskKeyGenerator()
+        self.count = 0  # 已读取的任务数
+        self.skipped = 0  # 因此前已成功而跳过的任务数
+
+    def jobs(self, tasks):
+        for task in tasks:
+            self.count += 1
+            key = self.keys.key(task)
+            state = self.states.get(key, {})
+            if state.get("status") == SUCCESS:
+                self.skipped += 1
+                continue
+            yield {"task": task, "idx": self.count, "key": key, "task_id": state.get("task_id")}
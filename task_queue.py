@@ -0,0 +1,247 @@
+"""
+任务队列: 基于 SQLite 的持久化任务队列，多个进程或多台机器可以共同处理同一批任务
+* 任务从现有的任务文件导入（name、prompt、images、model），按任务键去重，重复导入同一文件不会产生重复任务
+* 工作进程在事务中原子地领取任务，每次领取持有一段租约，处理期间由后台线程定时续租
+* 租约过期（进程崩溃、机器断开）的任务自动回到队列，由其他工作进程重新领取，多次过期后标记为失败
+* 每次状态变化（加入、领取、过期、成功、失败、重新排队）都记录在 events 表中
+* 按任务的优先级和截止时间领取（规则同 task_scheduler），等待时间从加入队列时算起
+* 多台机器共用时，数据库文件需放在支持文件锁的共享存储上，且各机器的时钟需要同步
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from dotenv import load_dotenv
+from task_journal import TaskKeyGenerator
+from task_scheduler import schedule_key
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量获取配置
+QUEUE_LEASE = float(os.getenv("QUEUE_LEASE", "300"))  # 领取任务的租约时长 (秒)
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))  # 租约过期后最多重新领取的次数
+QUEUE_POLL_INTERVAL = float(os.getenv("QUEUE_POLL_INTERVAL", "5"))  # 等待其他工作进程时的查询间隔 (秒)
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+SUCCESS = "success"
+FAILURE = "failure"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    task TEXT NOT NULL,
+    status TEXT NOT NULL,
+    task_id TEXT,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL,
+    rank INTEGER NOT NULL DEFAULT 0,
+    deadline REAL NOT NULL DEFAULT 1e999,
+    images INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status);
+CREATE INDEX IF NOT EXISTS tasks_schedule ON tasks (status, rank DESC, deadline, images, id);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    task INTEGER NOT NULL,
+    time REAL NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    detail TEXT
+);
+"""
+
+def default_worker_id():
+    """工作进程标识：主机名、进程ID和随机后缀"""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+class TaskQueue:
+    """SQLite 任务队列。不保存数据库连接，每次操作单独连接，可以作为参数传给子进程"""
+
+    def __init__(self, path, worker=None, lease=QUEUE_LEASE, max_attempts=QUEUE_MAX_ATTEMPTS):
+        self.path = path
+        self.worker = worker or default_worker_id()
+        self.lease = lease
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        db = self._connect()
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    @contextmanager
+    def _transaction(self):
+        """写事务：BEGIN IMMEDIATE 在开始时获取写锁，多个工作进程的领取不会交错"""
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    @staticmethod
+    def _event(db, task, status, now, worker=None, detail=None):
+        db.execute("INSERT INTO events (task, time, status, worker, detail) VALUES (?, ?, ?, ?, ?)",
+                   (task, now, status, worker, detail))
+
+    def add(self, tasks):
+        """导入任务，返回(新加入数, 已在队列中而跳过的数量)"""
+        keys = TaskKeyGenerator()
+        added = skipped = 0
+        now = time.time()
+        with self._transaction() as db:
+            for task in tasks:
+                cursor = db.execute("INSERT OR IGNORE INTO tasks (key, task, status, updated, rank, deadline, images) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (keys.key(task), json.dumps(task, ensure_ascii=False), QUEUED, now,
+                                     *schedule_key(task, now)))
+                if cursor.rowcount:
+                    self._event(db, cursor.lastrowid, QUEUED, now)
+                    added += 1
+                else:
+                    skipped += 1
+        return added, skipped
+
+    def _requeue_expired(self, db, now):
+        """租约已过期的任务放回队列，过期次数达到上限的标记为失败"""
+        expired = db.execute("SELECT id, attempts, worker FROM tasks WHERE status = ? AND lease_until < ?",
+                             (RUNNING, now)).fetchall()
+        for task, attempts, worker in expired:
+            if attempts >= self.max_attempts:
+                db.execute("UPDATE tasks SET status = ?, lease_until = NULL, error = ?, updated = ? WHERE id = ?",
+                           (FAILURE, "租约多次过期", now, task))
+                self._event(db, task, FAILURE, now, worker, "租约多次过期")
+            else:
+                db.execute("UPDATE tasks SET status = ?, worker = NULL, lease_until = NULL, updated = ? WHERE id = ?",
+                           (QUEUED, now, task))
+                self._event(db, task, QUEUED, now, worker, "租约过期")
+
+    def claim(self):
+        """按优先级和截止时间领取一个任务并持有租约，没有可领取的任务时返回None
+
+        返回的 job 格式同 JobPlanner，另含 queue_id 和 worker。任务ID在第一次领取时生成，重新领取时沿用
+        """
+        now = time.time()
+        with self._transaction() as db:
+            self._requeue_expired(db, now)
+            row = db.execute("SELECT id, key, task, task_id FROM tasks WHERE status = ? "
+                             "ORDER BY rank DESC, deadline, images, id LIMIT 1",
+                             (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            task, key, data, task_id = row
+            task_id = task_id or f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{task}"
+            db.execute("UPDATE tasks SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, "
+                       "task_id = ?, updated = ? WHERE id = ?",
+                       (RUNNING, self.worker, now + self.lease, task_id, now, task))
+            self._event(db, task, RUNNING, now, self.worker)
+        return {"task": json.loads(data), "idx": task, "key": key, "task_id": task_id,
+                "queue_id": task, "worker": self.worker}
+
+    def jobs(self):
+        """逐个领取任务，直到没有可领取的任务"""
+        while True:
+            job = self.claim()
+            if job is None:
+                return
+            yield job
+
+    def complete(self, job, success, error=None):
+        """记录任务结果。成功总是生效；失败只在仍持有租约时生效，租约已被其他进程接手时以对方的结果为准"""
+        now = time.time()
+        with self._transaction() as db:
+            if success:
+                cursor = db.execute("UPDATE tasks SET status = ?, worker = ?, lease_until = NULL, error = NULL, "
+                                    "updated = ? WHERE id = ? AND status != ?",
+                                    (SUCCESS, job["worker"], now, job["queue_id"], SUCCESS))
+            else:
+                cursor = db.execute("UPDATE tasks SET status = ?, lease_until = NULL, error = ?, updated = ? "
+                                    "WHERE id = ? AND worker = ? AND status = ?",
+                                    (FAILURE, error, now, job["queue_id"], job["worker"], RUNNING))
+            if cursor.rowcount:
+                self._event(db, job["queue_id"], SUCCESS if success else FAILURE, now, job["worker"], error)
+
+    def renew(self):
+        """为本工作进程持有的所有任务续租"""
+        with self._transaction() as db:
+            db.execute("UPDATE tasks SET lease_until = ? WHERE worker = ? AND status = ?",
+                       (time.time() + self.lease, self.worker, RUNNING))
+
+    def start_heartbeat(self):
+        """启动续租线程，每隔租约时长的1/3续租一次，返回用于停止的 threading.Event"""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease / 3):
+                try:
+                    self.renew()
+                except sqlite3.Error:
+                    pass  # 数据库暂时被锁定，下一次再续租
+
+        threading.Thread(target=beat, name="queue-heartbeat", daemon=True).start()
+        return stop
+
+    def release(self):
+        """将本工作进程仍持有但未记录结果的任务（如子进程异常退出）放回队列，返回数量"""
+        now = time.time()
+        with self._transaction() as db:
+            held = [row[0] for row in db.execute("SELECT id FROM tasks WHERE worker = ? AND status = ?",
+                                                 (self.worker, RUNNING))]
+            for task in held:
+                db.execute("UPDATE tasks SET status = ?, worker = NULL, lease_until = NULL, updated = ? WHERE id = ?",
+                           (QUEUED, now, task))
+                self._event(db, task, QUEUED, now, self.worker, "未记录结果")
+        return len(held)
+
+    def requeue_failed(self):
+        """将失败的任务重新加入队列并重置领取次数，返回数量"""
+        now = time.time()
+        with self._transaction() as db:
+            failed = [row[0] for row in db.execute("SELECT id FROM tasks WHERE status = ?", (FAILURE,))]
+            for task in failed:
+                db.execute("UPDATE tasks SET status = ?, worker = NULL, attempts = 0, error = NULL, updated = ? "
+                           "WHERE id = ?", (QUEUED, now, task))
+                self._event(db, task, QUEUED, now, self.worker, "重新排队")
+        return len(failed)
+
+    def counts(self):
+        """各状态的任务数"""
+        db = self._connect()
+        try:
+            counts = dict(db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status"))
+        finally:
+            db.close()
+        return {status: counts.get(status, 0) for status in (QUEUED, RUNNING, SUCCESS, FAILURE)}
+
+    def wait_for_work(self, poll_interval=QUEUE_POLL_INTERVAL):
+        """等待其他工作进程持有的任务：有任务可以领取（如租约过期）时返回True，全部结束时返回False"""
+        while True:
+            with self._transaction() as db:
+                self._requeue_expired(db, time.time())
+            counts = self.counts()
+            if counts[QUEUED]:
+                return True
+            if not counts[RUNNING]:
+                return False
+            time.sleep(poll_interval)
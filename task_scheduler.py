@@ -0,0 +1,95 @@
+"""
+任务调度: 按优先级和截止时间决定任务的执行顺序，紧急的任务不必排在整批任务之后
+* 任务可以设置 priority（整数，越大越先执行，默认0）和 deadline（截止时间），无法解析时忽略
+* 执行顺序依次比较：有效优先级（高的先执行）、截止时间（早的先执行，未设置的最后）、
+  图片数量（少的先执行，可关闭）、任务在文件中的顺序
+* 有效优先级 = priority + 已等待的时间段数（每 SCHEDULE_AGING 秒为一段），
+  低优先级任务等待越久越靠前，不会一直被后来的高优先级任务插队
+* 逐行读取的任务文件只在预读的 SCHEDULE_LOOKAHEAD 个任务中排序
+"""
+
+import os
+import time
+import heapq
+from datetime import datetime
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量获取配置
+SCHEDULE_AGING = float(os.getenv("SCHEDULE_AGING", "60"))  # 每等待多少秒有效优先级提升1，0 表示不提升
+SCHEDULE_LOOKAHEAD = int(os.getenv("SCHEDULE_LOOKAHEAD", "1000"))  # 逐行读取任务时预读排序的任务数
+SCHEDULE_SHORTEST_FIRST = os.getenv("SCHEDULE_SHORTEST_FIRST", "1").lower() in ("1", "true", "yes")  # 同等条件下图片少的任务先执行
+
+NO_DEADLINE = float("inf")
+
+def parse_priority(value):
+    """解析任务的 priority，未设置或无法解析时为0"""
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def parse_deadline(value):
+    """解析任务的 deadline，返回时间戳，未设置或无法解析时为 NO_DEADLINE
+
+    支持时间戳（秒）和 ISO 格式的时间，如 "2025-04-01 18:00" 或 "2025-04-01T18:00:00+08:00"，未带时区时按本地时间
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str) and value.strip():
+        try:
+            return datetime.fromisoformat(value.strip().replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            pass
+    return NO_DEADLINE
+
+def aging_period(now, aging=SCHEDULE_AGING):
+    """当前所在的时间段序号，用于计算等待提升的优先级"""
+    return int(now // aging) if aging > 0 else 0
+
+def schedule_key(task, now, aging=SCHEDULE_AGING, shortest_first=SCHEDULE_SHORTEST_FIRST):
+    """任务的调度键 (等级, 截止时间, 图片数量)，等级越大、截止时间越早、图片越少越先执行
+
+    等级 = priority - 加入时的时间段序号：等待的时间段数相同的任务之间只比较 priority，
+    早加入的任务每早一个时间段相当于 priority 高1，排序键不随时间变化
+    """
+    images = len(task.get("images") or []) if shortest_first else 0
+    return (parse_priority(task.get("priority")) - aging_period(now, aging),
+            parse_deadline(task.get("deadline")), images)
+
+class JobScheduler:
+    """按调度键依次产出 job（JobPlanner 的格式）；lookahead 为0时读入全部任务再排序"""
+
+    def __init__(self, jobs, lookahead=SCHEDULE_LOOKAHEAD, aging=SCHEDULE_AGING, shortest_first=SCHEDULE_SHORTEST_FIRST):
+        self.jobs = jobs
+        self.lookahead = lookahead
+        self.aging = aging
+        self.shortest_first = shortest_first
+        self.heap = []
+        self.count = 0
+        self.late = 0  # 开始执行时已超过截止时间的任务数
+
+    def _push(self, job):
+        rank, deadline, images = schedule_key(job["task"], time.monotonic(), self.aging, self.shortest_first)
+        self.count += 1
+        heapq.heappush(self.heap, (-rank, deadline, images, self.count, job))
+
+    def __iter__(self):
+        source = iter(self.jobs)
+        exhausted = False
+        while True:
+            # 补充预读的任务，再取出调度键最小的一个
+            while not exhausted and (self.lookahead <= 0 or len(self.heap) < self.lookahead):
+                job = next(source, None)
+                if job is None:
+                    exhausted = True
+                else:
+                    self._push(job)
+            if not self.heap:
+                return
+            _, deadline, _, _, job = heapq.heappop(self.heap)
+            if deadline < time.time():
+                self.late += 1
+            yield job
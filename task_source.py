@@ -0,0 +1,61 @@
+"""
+任务来源: 支持 tasks.json（JSON数组）和 tasks.jsonl（JSON Lines，每行一个任务）两种格式
+* tasks.json 在启动时整体读入，可以提前得到任务总数
+* tasks.jsonl 在处理过程中逐行读取，启动时不解析整个文件，读到第一行即可开始处理，
+  内存占用与任务总数无关，适合数十万规模的任务
+* 两种格式的任务字段相同：name、prompt、images、model
+"""
+
+import os
+import json
+
+def default_tasks_file(input_dir):
+    """默认任务文件：存在 tasks.jsonl 时优先使用，否则使用 tasks.json"""
+    jsonl_file = os.path.join(input_dir, "tasks.jsonl")
+    if os.path.exists(jsonl_file):
+        return jsonl_file
+    return os.path.join(input_dir, "tasks.json")
+
+def is_jsonl(path):
+    return path.lower().endswith((".jsonl", ".ndjson"))
+
+class TaskSource:
+    """可迭代的任务来源，JSON Lines 文件每次迭代时重新逐行读取"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tasks = None
+        self.invalid_lines = []  # JSON Lines 中无法解析而跳过的行号（最近一次迭代）
+        if is_jsonl(path):
+            # 只检查文件能否打开，不在启动时读取内容
+            with open(path, "r", encoding="utf-8"):
+                pass
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                self.tasks = json.load(f)
+            if not isinstance(self.tasks, list):
+                raise ValueError("任务文件应为任务数组")
+
+    @property
+    def total(self):
+        """任务总数，逐行读取时未知，返回None"""
+        return None if self.tasks is None else len(self.tasks)
+
+    def __iter__(self):
+        if self.tasks is not None:
+            yield from self.tasks
+            return
+        self.invalid_lines = []  # 只记录本次读取的结果，重复迭代时行号不会重复
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    task = json.loads(line)
+                except ValueError:
+                    task = None
+                if not isinstance(task, dict):
+                    self.invalid_lines.append(line_no)
+                    continue
+                yield task
@@ -0,0 +1,97 @@
+"""
+fetch_to_file 的断点续传：服务端返回的 206 范围与请求的不符时不能把数据接在错位的位置上
+"""
+
+import os
+import sys
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from downloader import fetch_to_file
+
+DATA = bytes(range(251)) * 4096  # 约1MB，大于下载的块大小；251为质数，错位后内容必然不同
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """第一次请求中途断开连接；带 Range 的请求按 server.range_offset 返回错误的起始位置"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.headers.get("Range"))
+            number = len(server.requests)
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"][6:].split("-")[0]) + server.range_offset
+            body = DATA[start:]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(DATA) - 1}/{len(DATA)}")
+        else:
+            body = DATA
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if number <= server.truncate_requests:
+            # 只发送一半数据后断开连接，触发续传
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+class FetchToFileTest(unittest.TestCase):
+
+    def start_server(self, range_offset, truncate_requests):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+        server.daemon_threads = True
+        server.lock = threading.Lock()
+        server.requests = []
+        server.range_offset = range_offset
+        server.truncate_requests = truncate_requests
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, f"http://127.0.0.1:{server.server_address[1]}/image.png"
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        self.output = os.path.join(self.workdir, "image.png")
+
+    def test_resume(self):
+        server, url = self.start_server(range_offset=0, truncate_requests=1)
+        self.assertEqual(fetch_to_file(url, self.output, requests.Session()), len(DATA))
+        with open(self.output, "rb") as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertEqual(len(server.requests), 2)
+        self.assertIsNone(server.requests[0])
+        self.assertRegex(server.requests[1], r"^bytes=[1-9]\d*-$")
+
+    def test_wrong_range_restarts_from_scratch(self):
+        server, url = self.start_server(range_offset=100, truncate_requests=1)
+        self.assertEqual(fetch_to_file(url, self.output, requests.Session()), len(DATA))
+        with open(self.output, "rb") as f:
+            self.assertEqual(f.read(), DATA)
+        # 续传返回的范围不符，下一次请求不带 Range 从头下载
+        self.assertEqual(len(server.requests), 3)
+        self.assertRegex(server.requests[1], r"^bytes=[1-9]\d*-$")
+        self.assertIsNone(server.requests[2])
+
+    def test_wrong_range_every_time_fails_without_partial_file(self):
+        server, url = self.start_server(range_offset=100, truncate_requests=100)
+        with self.assertRaises(requests.RequestException):
+            fetch_to_file(url, self.output, requests.Session())
+        self.assertEqual(os.listdir(self.workdir), [])
+
+if __name__ == "__main__":
+    unittest.main()
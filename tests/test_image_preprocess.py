@@ -0,0 +1,53 @@
+"""
+图片预处理只是优化：无法解码的图片应当原样上传，而不是让任务失败
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_preprocess import ImagePreprocessor, Image
+
+@unittest.skipIf(Image is None, "需要安装 Pillow")
+class PrepareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir, True)
+        self.cache_dir = os.path.join(self.workdir, "cache")
+        self.warnings = []
+        self.preprocessor = ImagePreprocessor(enabled=True, cache_dir=self.cache_dir, max_edge=64, workers=1,
+                                              warn=self.warnings.append)
+        self.addCleanup(self.preprocessor.shutdown)
+
+    def write(self, name, data):
+        path = os.path.join(self.workdir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_undecodable_image_is_uploaded_unchanged(self):
+        path = self.write("broken.jpg", b"\xff\xd8\xff" + os.urandom(4096))
+        self.assertEqual(self.preprocessor.prepare(path), path)
+        self.assertEqual(len(self.warnings), 1)
+        self.assertEqual(self.preprocessor.failures, 1)
+        # 失败不缓存：缓存目录中没有结果或临时文件，再次调用时重新尝试
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertEqual(self.preprocessor.prepare(path), path)
+        self.assertEqual(self.preprocessor.failures, 2)
+
+    def test_valid_image_is_resized(self):
+        path = os.path.join(self.workdir, "large.png")
+        Image.new("RGB", (256, 128), (200, 30, 30)).save(path)
+        prepared = self.preprocessor.prepare(path)
+        self.assertNotEqual(prepared, path)
+        with Image.open(prepared) as image:
+            self.assertEqual(image.size, (64, 32))
+        self.assertEqual(self.warnings, [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+STREAM_RESPONSE=1 但服务端忽略 stream 参数、返回普通 JSON 时，仍应从响应中提取图片链接并下载
+（用 bench/mock_server.py 的 --ignore-stream 模拟，分别运行批处理版本和并发版本的两种引擎）
+"""
+
+import os
+import sys
+import glob
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from mock_server import MockServer, build_parser
+
+TASKS = 3
+LINKS = 2
+
+class StreamFallbackTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        options = build_parser().parse_args(["--port", "0", "--latency", "0", "--download-latency", "0",
+                                             "--links", str(LINKS), "--image-kb", "4", "--ignore-stream"])
+        cls.server = MockServer(("127.0.0.1", 0), options)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.workdir, "input"))
+        tasks = [{"name": f"任务{i}", "prompt": f"提示词{i}", "images": []} for i in range(TASKS)]
+        with open(os.path.join(self.workdir, "input", "tasks.json"), "w", encoding="utf-8") as f:
+            json.dump(tasks, f, ensure_ascii=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def run_script(self, script, *args):
+        host, port = self.server.server_address[:2]
+        env = dict(os.environ, API_URL=f"http://{host}:{port}/v1/chat/completions", API_TOKEN="test",
+                   STREAM_RESPONSE="1", API_DELAY="0", API_RATE_LIMIT="0", RESULT_CACHE="0", LOG_FILE="")
+        env.pop("TASKS_FILE", None)
+        completed = subprocess.run([sys.executable, os.path.join(ROOT, script), *args], cwd=self.workdir, env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=120)
+        output = completed.stdout.decode("utf-8", "replace")
+        self.assertEqual(completed.returncode, 0, output)
+        return output
+
+    def assert_images_downloaded(self, output):
+        images = glob.glob(os.path.join(self.workdir, "output", "*", "*.png"))
+        self.assertEqual(len(images), TASKS * LINKS, output)
+        self.assertNotIn("未成功下载任何图片", output)
+
+    def test_batch(self):
+        self.assert_images_downloaded(self.run_script("gpt-4o-batch.py"))
+
+    def test_concurrent_thread(self):
+        self.assert_images_downloaded(self.run_script("gpt-4o-concurrent.py", "--engine", "thread"))
+
+    def test_concurrent_asyncio(self):
+        self.assert_images_downloaded(self.run_script("gpt-4o-concurrent.py", "--engine", "asyncio"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,225 @@
+"""
+API 密钥池: 同时使用多个 API 密钥，每个密钥有独立的限流器和并发上限
+* API_TOKENS 中用逗号分隔多个密钥，每个密钥可以用分号附加单独的配置，例如
+  sk-aaa;interval=0.25;rpm=100;concurrency=10,sk-bbb
+  未单独配置的项使用 API_RATE_LIMIT、API_BURST、API_RPM 和 KEY_CONCURRENCY
+* 每次请求选择可用密钥中负载最低的一个：优先选择现在就有限流令牌的密钥，再按处理中的请求数和该密钥的限流速率估算，
+  负载相同时选择最久未使用的密钥（轮换使用）
+* 连续 KEY_FAILURE_THRESHOLD 次遇到 401/403、429 或额度不足的错误时，密钥暂停使用 KEY_COOLDOWN 秒
+* 按密钥统计请求数、成功数和各类错误数
+"""
+
+import os
+import time
+import asyncio
+import threading
+from dotenv import load_dotenv
+from rate_limiter import create_rate_limiter
+from retry_policy import error_message
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量获取配置
+KEY_CONCURRENCY = int(os.getenv("KEY_CONCURRENCY", "0"))  # 每个密钥默认的并发上限，0 表示不限制
+KEY_FAILURE_THRESHOLD = int(os.getenv("KEY_FAILURE_THRESHOLD", "3"))  # 连续多少次密钥错误后暂停使用
+KEY_COOLDOWN = float(os.getenv("KEY_COOLDOWN", "60"))  # 暂停使用的时长 (秒)
+KEY_QUOTA_KEYWORDS = [k.strip().lower() for k in os.getenv(
+    "KEY_QUOTA_KEYWORDS", "quota,insufficient,余额,额度,欠费"
+).split(",") if k.strip()]
+
+# 与密钥相关的错误分类
+AUTH_ERROR = "auth"
+RATE_LIMITED = "429"
+QUOTA_EXCEEDED = "quota"
+KEY_ERRORS = (AUTH_ERROR, RATE_LIMITED, QUOTA_EXCEEDED)
+OTHER_ERROR = "error"  # 与密钥无关的失败（连接错误、5xx等）
+
+# 单个密钥可以配置的项及其类型
+KEY_OPTIONS = {"interval": float, "burst": int, "rpm": int, "concurrency": int}
+
+def key_error(status_code, response_text):
+    """判断响应是否为与密钥相关的错误，返回错误分类或None"""
+    if status_code in (401, 403):
+        return AUTH_ERROR
+    if status_code == 429:
+        return RATE_LIMITED
+    if '"error"' in (response_text or ""):
+        message = error_message(response_text)
+        if message and any(keyword in message.lower() for keyword in KEY_QUOTA_KEYWORDS):
+            return QUOTA_EXCEEDED
+    return None
+
+def request_outcome(status_code, response_text):
+    """请求结果分类：成功返回None，密钥相关的错误返回 KEY_ERRORS 中的分类，其他失败返回 OTHER_ERROR
+
+    status_code 为None表示请求未得到响应
+    """
+    if status_code is None:
+        return OTHER_ERROR
+    category = key_error(status_code, response_text)
+    if category is not None:
+        return category
+    if status_code == 200 and ('"error"' not in response_text or error_message(response_text) is None):
+        return None
+    return OTHER_ERROR
+
+def failure_cause(category, status_code=None, response_text=None):
+    """请求失败的原因（用于指标），成功时返回None
+
+    依次取重试分类（category）、密钥相关的错误分类、exception（未得到响应）、http_状态码或 api_error
+    """
+    outcome = request_outcome(status_code, response_text)
+    if outcome is None:
+        return None
+    if category:
+        return category
+    if outcome in KEY_ERRORS:
+        return outcome
+    if status_code is None:
+        return "exception"
+    return "api_error" if status_code == 200 else f"http_{status_code}"
+
+def mask_token(token):
+    """输出时只显示密钥的首尾几位"""
+    if len(token) <= 12:
+        return token[:2] + "***"
+    return f"{token[:6]}...{token[-4:]}"
+
+def parse_tokens(value):
+    """解析 API_TOKENS，返回 [(密钥, 配置)]"""
+    entries = []
+    for item in (value or "").split(","):
+        parts = [part.strip() for part in item.split(";") if part.strip()]
+        if not parts:
+            continue
+        options = {}
+        for part in parts[1:]:
+            name, sep, option = part.partition("=")
+            name = name.strip()
+            if not sep or name not in KEY_OPTIONS:
+                raise ValueError(f"无法识别的密钥配置: {part}")
+            options[name] = KEY_OPTIONS[name](option.strip())
+        entries.append((parts[0], options))
+    return entries
+
+class ApiKey:
+    """密钥池中的一个密钥及其状态，状态由 TokenPool 加锁修改"""
+
+    def __init__(self, token, limiter, concurrency, rate):
+        self.token = token
+        self.name = mask_token(token)
+        self.limiter = limiter
+        self.concurrency = concurrency  # 0 表示不限制
+        self.rate = rate  # 每秒请求数，用于估算负载
+        self.in_flight = 0
+        self.last_used = 0.0  # 上次被选中的时间，负载相同时轮换使用
+        self.failures = 0  # 连续的密钥错误次数
+        self.cooldown_until = 0.0
+        self.stats = {"requests": 0, "success": 0, OTHER_ERROR: 0, "cooldowns": 0,
+                      AUTH_ERROR: 0, RATE_LIMITED: 0, QUOTA_EXCEEDED: 0}
+
+    def load(self):
+        """负载估算：依次比较等待限流令牌的时间、排在此密钥上的请求全部发出所需的时间、处理中的请求数和上次使用时间"""
+        return self.limiter.wait_time(), (self.in_flight + 1) / self.rate, self.in_flight, self.last_used
+
+class TokenPool:
+    """线程安全的密钥池；asyncio 引擎使用 acquire_async，以轮询方式等待，不阻塞事件循环"""
+
+    def __init__(self, keys, failure_threshold=KEY_FAILURE_THRESHOLD, cooldown=KEY_COOLDOWN):
+        self.keys = list(keys)
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.condition = threading.Condition()
+
+    def __getstate__(self):
+        # 传给子进程时不包含锁，每个进程分别计算并发数和暂停状态（限流器可以是跨进程共享的）
+        state = self.__dict__.copy()
+        del state["condition"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.condition = threading.Condition()
+
+    def _try_select(self):
+        """调用方持有锁：选出负载最低的可用密钥并占用名额，没有时返回(None, 建议等待秒数)"""
+        now = time.monotonic()
+        available = [key for key in self.keys
+                     if key.cooldown_until <= now and (not key.concurrency or key.in_flight < key.concurrency)]
+        if not available:
+            cooling = [key.cooldown_until - now for key in self.keys if key.cooldown_until > now]
+            return None, min(cooling) if len(cooling) == len(self.keys) else None
+        key = min(available, key=ApiKey.load)
+        key.in_flight += 1
+        key.last_used = now
+        key.stats["requests"] += 1
+        return key, None
+
+    def acquire(self):
+        """等待可用的密钥并等待其限流令牌，返回 ApiKey，请求结束后需调用 release"""
+        with self.condition:
+            while True:
+                key, wait = self._try_select()
+                if key is not None:
+                    break
+                self.condition.wait(wait)
+        key.limiter.acquire()
+        return key
+
+    async def acquire_async(self, poll_interval=0.05):
+        """acquire 的 asyncio 版本"""
+        while True:
+            with self.condition:
+                key, wait = self._try_select()
+            if key is not None:
+                break
+            await asyncio.sleep(min(wait, poll_interval) if wait else poll_interval)
+        await key.limiter.acquire_async()
+        return key
+
+    def release(self, key, category):
+        """归还名额并记录结果（category 为 request_outcome 的返回值），返回密钥是否因此暂停使用"""
+        with self.condition:
+            key.in_flight -= 1
+            paused = False
+            if category is None:
+                key.failures = 0
+                key.stats["success"] += 1
+            elif category in KEY_ERRORS:
+                key.stats[category] += 1
+                key.failures += 1
+                if key.failures >= self.failure_threshold:
+                    key.failures = 0
+                    key.cooldown_until = time.monotonic() + self.cooldown
+                    key.stats["cooldowns"] += 1
+                    paused = True
+            else:
+                key.stats[OTHER_ERROR] += 1
+            self.condition.notify_all()
+            return paused
+
+    def stats(self):
+        """各密钥的使用统计 {密钥名称: 统计}"""
+        with self.condition:
+            return {key.name: dict(key.stats) for key in self.keys}
+
+def create_token_pool(value, interval, burst=1, per_minute=0, concurrency=KEY_CONCURRENCY, shared=False):
+    """根据 API_TOKENS 创建密钥池，未配置时返回None；shared 为 True 时各密钥的限流器可在多个进程间共用"""
+    entries = parse_tokens(value)
+    if not entries:
+        return None
+    keys = []
+    for token, options in entries:
+        key_interval = options.get("interval", interval)
+        key_rpm = options.get("rpm", per_minute)
+        limiter = create_rate_limiter(key_interval, options.get("burst", burst), key_rpm, shared=shared)
+        rates = [rate for rate in (1.0 / key_interval if key_interval > 0 else 0, key_rpm / 60.0) if rate > 0]
+        keys.append(ApiKey(token, limiter, options.get("concurrency", concurrency), min(rates, default=float("inf"))))
+    return TokenPool(keys)
+
+def format_key_stats(name, stats):
+    """一行密钥使用统计"""
+    return (f"密钥 {name}: 请求 {stats['requests']} 次，成功 {stats['success']}，"
+            f"401/403 {stats[AUTH_ERROR]}，429 {stats[RATE_LIMITED]}，额度不足 {stats[QUOTA_EXCEEDED]}，"
+            f"其他失败 {stats[OTHER_ERROR]}，暂停 {stats['cooldowns']} 次")
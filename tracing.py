@@ -0,0 +1,169 @@
+"""
+阶段耗时追踪: 记录每个任务在各阶段的耗时，用于判断瓶颈在限流、上游、CDN 还是本地读写
+* 阶段包括：准备任务、图片读取和编码、等待并发名额、等待限流令牌、上传请求体、等待服务端响应、
+  读取响应、解析响应、写文件、重试退避、下载图片
+* TRACE_FILE 或 --trace 指定输出文件时开启，未开启时不记录
+* 输出 Chrome trace-event JSON，可以在 https://ui.perfetto.dev 或 chrome://tracing 中打开；每个线程一行，
+  asyncio 引擎的任务在同一线程中交替执行，每个任务单独一行
+* 运行结束时输出各阶段的耗时汇总表
+"""
+
+import os
+import json
+import time
+import threading
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+# 从环境变量获取配置
+TRACE_FILE = os.getenv("TRACE_FILE", "")  # 阶段耗时追踪的输出文件，为空表示不记录
+
+UPLOAD_CHUNK_SIZE = 64 * 1024  # 追踪时请求体按块发送，以便记录发送完毕的时间
+TASK_TRACK_BASE = 1 << 40  # asyncio 任务所在行的编号起点，避免与线程ID冲突
+
+# 阶段名称及说明（汇总表按此顺序输出）
+STAGES = {
+    "prepare": "准备任务（含图片编码）",
+    "encode_image": "图片读取和编码",
+    "concurrency_wait": "等待并发名额",
+    "rate_limit_wait": "等待限流令牌",
+    "upload": "上传请求体",
+    "server_wait": "等待服务端响应",
+    "response": "读取响应",
+    "request_error": "请求出错",
+    "parse": "解析响应",
+    "write": "写文件",
+    "retry_wait": "重试退避",
+    "download": "下载图片",
+}
+
+class NullSpan:
+    """未开启追踪时使用的空记录"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span:
+    """with 语句块结束时记录耗时"""
+
+    def __init__(self, tracer, name, track, args):
+        self.tracer = tracer
+        self.name = name
+        self.track = track
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.monotonic(), self.track, **self.args)
+        return False
+
+class Tracer:
+    """收集本进程的阶段耗时（线程安全），时间使用 time.monotonic，同一台机器上的多个进程可以合并"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []
+        self.tracks = {}  # 行编号 -> 名称
+
+    def task_track(self, idx):
+        """asyncio 引擎中为任务分配单独的一行，未开启追踪时返回None"""
+        if not self.enabled:
+            return None
+        track = TASK_TRACK_BASE + idx
+        self.tracks[track] = f"任务 {idx}"
+        return track
+
+    def span(self, name, track=None, **args):
+        """记录 with 语句块的耗时；track 为None时记录在当前线程所在的行"""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, track, args)
+
+    def record(self, name, start, end, track=None, **args):
+        """记录一段已知起止时间（time.monotonic）的耗时"""
+        if not self.enabled:
+            return
+        if track is None:
+            thread = threading.current_thread()
+            track = thread.ident
+            if track not in self.tracks:
+                self.tracks[track] = thread.name
+        self.events.append({"name": name, "cat": "stage", "ph": "X", "ts": start * 1e6,
+                            "dur": max(0.0, end - start) * 1e6, "pid": os.getpid(), "tid": track, "args": args})
+
+    def export(self):
+        """本进程的全部事件（含行名称），可以发送给主进程合并"""
+        pid = os.getpid()
+        names = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": track, "args": {"name": name}}
+                 for track, name in list(self.tracks.items())]
+        names.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"进程 {pid}"}})
+        return names + list(self.events)
+
+def write_trace(path, events):
+    """写入 Chrome trace-event JSON 文件"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+class TracedBody:
+    """包装请求体并记录发送完毕的时间（sent），用于区分上传和等待服务端；可重复迭代"""
+
+    def __init__(self, body):
+        self.body = body
+        self.sent = None
+
+    def __len__(self):
+        return len(self.body)
+
+    def _chunks(self):
+        if isinstance(self.body, bytes):
+            return (self.body[i:i + UPLOAD_CHUNK_SIZE] for i in range(0, len(self.body), UPLOAD_CHUNK_SIZE))
+        return iter(self.body)
+
+    def __iter__(self):
+        self.sent = None
+        yield from self._chunks()
+        self.sent = time.monotonic()
+
+    async def aiter(self):
+        """asyncio 引擎使用的异步迭代器"""
+        self.sent = None
+        if isinstance(self.body, bytes):
+            for chunk in self._chunks():
+                yield chunk
+        else:
+            async for chunk in self.body.aiter():
+                yield chunk
+        self.sent = time.monotonic()
+
+def percentile(values, q):
+    """已排序列表的分位数（取最近的排名）"""
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def summary_lines(events):
+    """各阶段耗时汇总表"""
+    durations = {}
+    for event in events:
+        if event.get("ph") == "X":
+            durations.setdefault(event["name"], []).append(event["dur"] / 1e6)
+    # 中文字符占两列，表头的宽度相应减小
+    lines = [f"{'阶段':<16}{'次数':>6}{'合计(秒)':>11}{'平均(秒)':>9}{'p50':>9}{'p95':>9}{'最大':>7}  说明"]
+    for name in list(STAGES) + sorted(set(durations) - set(STAGES)):
+        values = sorted(durations.get(name, []))
+        if not values:
+            continue
+        total = sum(values)
+        lines.append(f"{name:<18}{len(values):>8}{total:>14.1f}{total / len(values):>12.2f}"
+                     f"{percentile(values, 0.5):>9.2f}{percentile(values, 0.95):>9.2f}{values[-1]:>9.2f}  "
+                     f"{STAGES.get(name, '')}")
+    return lines